@@ -0,0 +1,871 @@
+#-*- coding:utf-8 -*-
+
+# MIT Licensed
+
+""" PatchServer's operations as coroutines, so many installations can be patched in one event loop. """
+
+import os, ssl, logging
+import io
+import time
+import asyncio
+import http.client
+import urllib.parse
+import functools
+import concurrent.futures
+
+from download import (PatchServer, PatchServerError, HTTPStatusError, PartDecoder, PartDecoderError, PartWriteError,
+	ManifestDecoder, NexonAPI)
+
+
+async def _timeout(awaitable, seconds):
+	""" Await with a time limit, raising the builtin TimeoutError (an OSError) like sockets do. """
+	try:
+		return await asyncio.wait_for(awaitable, seconds)
+	except asyncio.TimeoutError:
+		raise TimeoutError("timed out")
+	#endtry
+#enddef
+
+class AsyncResponse:
+	""" A response body read from an asyncio stream. The connection goes back to the pool once it's all read. """
+
+	def __init__(self, pool, key, conn, status, reason, headers, willClose):
+		self.pool = pool
+		self.key = key
+		self.conn = conn
+		self.status = status
+		self.reason = reason
+		self.headers = headers
+		self.willClose = willClose
+
+		self.chunked = "chunked" in headers.get("Transfer-Encoding", "").lower()
+		self.length = None
+		if status in (204, 304) or 100 <= status < 200:
+			self.length = 0
+		elif not self.chunked and headers.get("Content-Length"):
+			self.length = int(headers["Content-Length"])
+		#endif
+
+		# Bytes left in the current chunk of a chunked body.
+		self.chunkLeft = 0
+		self.done = False
+		if self.length == 0: self._finish()
+	#enddef
+
+	def _finish(self):
+		self.done = True
+		if self.conn is not None:
+			self.pool.release(self.key, self.conn, not self.willClose)
+			self.conn = None
+		#endif
+	#enddef
+
+	async def _readChunked(self, amt):
+		reader, timeout = self.conn[0], self.pool.timeout
+		if not self.chunkLeft:
+			line = await _timeout(reader.readline(), timeout)
+			try:
+				self.chunkLeft = int(line.split(b";", 1)[0], 16)
+			except ValueError:
+				raise http.client.IncompleteRead(b"")
+			#endtry
+
+			if not self.chunkLeft:
+				# Skip any trailers.
+				while line not in (b"\r\n", b"\n", b""):
+					line = await _timeout(reader.readline(), timeout)
+				#endwhile
+				self._finish()
+				return b""
+			#endif
+		#endif
+
+		data = await _timeout(reader.read(min(amt, self.chunkLeft)), timeout)
+		if not data: raise http.client.IncompleteRead(b"", self.chunkLeft)
+		self.chunkLeft -= len(data)
+		if not self.chunkLeft: await _timeout(reader.readline(), timeout)
+		return data
+	#enddef
+
+	async def read(self, amt=None):
+		""" Read up to amt bytes of the body, or all of the rest of it. Returns b"" at the end. """
+		if amt is None:
+			data = []
+			while True:
+				chunk = await self.read(PatchServer.CHUNK_SIZE)
+				if not chunk: return b"".join(data)
+				data.append(chunk)
+			#endwhile
+		#endif
+
+		if self.done: return b""
+
+		try:
+			if self.chunked:
+				data = b""
+				while not data and not self.done: data = await self._readChunked(amt)
+				return data
+			#endif
+
+			reader = self.conn[0]
+			if self.length is None:
+				# The body runs until the server closes the connection.
+				data = await _timeout(reader.read(amt), self.pool.timeout)
+				if not data: self._finish()
+				return data
+			#endif
+
+			data = await _timeout(reader.read(min(amt, self.length)), self.pool.timeout)
+			if not data: raise http.client.IncompleteRead(b"", self.length)
+			self.length -= len(data)
+			if not self.length: self._finish()
+			return data
+		except:
+			self.close()
+			raise
+		#endtry
+	#enddef
+
+	def close(self):
+		""" Close the response, discarding the connection if it wasn't fully read. """
+		if self.conn is not None:
+			self.willClose = True
+			self._finish()
+		#endif
+		self.done = True
+	#enddef
+
+	def __enter__(self): return self
+	def __exit__(self, *exc): self.close()
+#endclass
+
+class AsyncConnectionPool:
+	""" Keep-alive HTTP/1.1 connections over asyncio streams, reused per host. """
+
+	TIMEOUT = 60
+	MAX_REDIRECTS = 5
+
+	def __init__(self, timeout=None, hostLimit=None):
+		self.timeout = timeout or self.TIMEOUT
+		self.idle = {}
+		self.sslContext = None
+
+		# Requests in progress to one host are limited to this, if given.
+		self.hostLimit = hostLimit
+		self.hostSlots = {}
+
+		self.requests = 0
+		self.opened = 0
+		self.reused = 0
+	#enddef
+
+	async def _acquire(self, key, parts):
+		if self.hostLimit:
+			await self.hostSlots.setdefault(key, asyncio.Semaphore(self.hostLimit)).acquire()
+		#endif
+
+		try:
+			idle = self.idle.get(key)
+			while idle:
+				conn = idle.pop()
+				if not conn[0].at_eof():
+					self.reused += 1
+					return conn, True
+				#endif
+				conn[1].close()
+			#endwhile
+
+			self.opened += 1
+			context = None
+			if parts.scheme == "https":
+				if self.sslContext is None: self.sslContext = ssl.create_default_context()
+				context = self.sslContext
+			#endif
+
+			port = parts.port or (443 if context else 80)
+			return await _timeout(asyncio.open_connection(parts.hostname, port, ssl=context), self.timeout), False
+		except:
+			if self.hostLimit: self.hostSlots[key].release()
+			raise
+		#endtry
+	#enddef
+
+	def release(self, key, conn, reusable=True):
+		""" Return a connection to the pool, or close it. """
+		if reusable:
+			self.idle.setdefault(key, []).append(conn)
+		else:
+			conn[1].close()
+		#endif
+
+		if self.hostLimit: self.hostSlots[key].release()
+	#enddef
+
+	async def _send(self, key, conn, parts, headers):
+		""" Send a GET and read the response's status and headers. """
+		reader, writer = conn
+		target = parts.path or "/"
+		if parts.query: target += "?" + parts.query
+
+		lines = ["GET {} HTTP/1.1".format(target), "Host: " + parts.netloc, "Accept-Encoding: identity"]
+		lines.extend("{}: {}".format(name, value) for name, value in (headers or {}).items())
+		writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+		await _timeout(writer.drain(), self.timeout)
+
+		line = await _timeout(reader.readline(), self.timeout)
+		if not line: raise http.client.RemoteDisconnected("Remote end closed connection without response")
+		try:
+			version, status, reason = (line.decode("latin-1").rstrip("\r\n").split(None, 2) + [""])[:3]
+			status = int(status)
+		except ValueError:
+			raise http.client.BadStatusLine(line)
+		#endtry
+
+		head = []
+		while True:
+			line = await _timeout(reader.readline(), self.timeout)
+			head.append(line)
+			if line in (b"\r\n", b"\n", b""): break
+		#endwhile
+		headers = http.client.parse_headers(io.BytesIO(b"".join(head)))
+
+		connection = headers.get("Connection", "").lower()
+		willClose = "close" in connection or (version == "HTTP/1.0" and "keep-alive" not in connection)
+		if not headers.get("Content-Length") and "chunked" not in headers.get("Transfer-Encoding", "").lower():
+			willClose = willClose or status not in (204, 304)
+		#endif
+
+		return AsyncResponse(self, key, conn, status, reason, headers, willClose)
+	#enddef
+
+	async def request(self, url, headers=None):
+		""" GET a URL, following redirects. Raises HTTPStatusError for error statuses and OSError on connection failures. """
+		for _ in range(self.MAX_REDIRECTS + 1):
+			parts = urllib.parse.urlsplit(url)
+			key = (parts.scheme, parts.netloc)
+			self.requests += 1
+
+			while True:
+				conn, reused = await self._acquire(key, parts)
+				try:
+					response = await self._send(key, conn, parts, headers)
+				except (http.client.HTTPException, OSError):
+					self.release(key, conn, False)
+					# The server may have dropped an idle connection, try again with a fresh one.
+					if reused: continue
+					raise
+				#endtry
+				break
+			#endwhile
+
+			if response.status in (301, 302, 303, 307, 308) and "Location" in response.headers:
+				with response: await response.read()
+				url = urllib.parse.urljoin(url, response.headers["Location"])
+				continue
+			elif response.status >= 400:
+				with response: await response.read()
+				raise HTTPStatusError("HTTP Error {}: {}".format(response.status, response.reason))
+			#endif
+
+			return response
+		#endfor
+
+		raise HTTPStatusError("Too many redirects")
+	#enddef
+
+	def close(self):
+		""" Close all idle connections. This has to be called while their loop is still running. """
+		idle, self.idle = self.idle, {}
+		for conns in idle.values():
+			for reader, writer in conns: writer.close()
+		#endfor
+	#enddef
+
+	def report(self):
+		logging.info("Made {} requests over {} connections ({} reused).".format(self.requests, self.opened, self.reused))
+	#enddef
+#endclass
+
+class AsyncPatchServer:
+	""" The operations of a PatchServer as coroutines, with the network done through asyncio.
+
+	    The PatchServer it wraps (made from the same arguments, if not given) holds the settings
+	    and does the work that isn't network I/O. Scanning the installation and the manifest store
+	    run on the default executor, and parts are written where they're decoded.
+
+	    progress, if given, is called with ("part", object name, metrics) as each part finishes,
+	    and with ("file" or "failed", filename, metrics) as each file does. """
+
+	def __init__(self, *args, patcher=None, progress=None, pool=None, **kwargs):
+		self.patcher = patcher or PatchServer(*args, **kwargs)
+		# Servers patching different installations may share one pool.
+		self.pool = pool or AsyncConnectionPool(hostLimit=self.patcher.pool.hostLimit)
+		self.progress = progress
+
+		# Parts transferring at once.
+		self.fetchSlots = asyncio.Semaphore(self.patcher.connections)
+	#enddef
+
+	def _report(self, kind, name):
+		if self.progress: self.progress(kind, name, self.patcher.metrics)
+	#enddef
+
+	async def _getURL(self, url, fileName=None, serverName=None, headers=None):
+		try:
+			return await self.pool.request(url, headers)
+		except HTTPStatusError as err:
+			if fileName is None: fileName = url.split("/")[-1]
+			raise PatchServerError("Error retrieving {}: {}".format(fileName, str(err)))
+		except (http.client.HTTPException, OSError) as err:
+			if serverName is None: serverName = url.split("/", maxsplit=3)[2]
+			raise PatchServerError("Could not connect {}: {}".format(serverName, str(err)))
+		#endtry
+	#enddef
+
+	async def _getFromMirrors(self, name, fileName):
+		""" Fetch a file from the best mirror that has it. """
+		mirrors = self.patcher.getMirrors()
+		err = None
+		for mirror in mirrors.ranked():
+			try:
+				return await self._getURL(mirror.url + name, fileName + " (" + mirror.url + name + ")", mirror.host)
+			except PatchServerError as e:
+				mirrors.failed(mirror)
+				err = e
+			#endtry
+		#endfor
+		raise err
+	#enddef
+
+	async def _read(self, url, fileName):
+		try:
+			with await self._getURL(url, fileName) as conn:
+				return await conn.read()
+			#endwith
+		except (http.client.HTTPException, OSError) as err:
+			raise PatchServerError("Error retrieving {}: {}".format(fileName, str(err)))
+		#endtry
+	#enddef
+
+	async def getWebLaunchStatus(self):
+		""" Returns true if the web launcher thinks the game is up. """
+		return self.patcher._parseLaunchStatus(await self._read(self.patcher.STATUS_URL, "status file"))
+	#enddef
+
+	async def getLatestVersion(self):
+		""" Get the latest version as reported by some server. """
+		if NexonAPI is None:
+			ver = self.patcher._parsePatchInfo(await self._read(self.patcher.PATCH_INFO_URL, "patch info file"))
+		else:
+			ver = await asyncio.to_thread(NexonAPI.getLatestVersion)
+		#endif
+
+		logging.info("Read latest version as {}.".format(ver))
+		self.patcher.target_version = ver
+		return ver
+	#enddef
+
+	async def getManifest(self, version=None):
+		""" Get the manifest file from the server and decode it. """
+		patcher = self.patcher
+		version = version or patcher.target_version
+
+		if version == patcher.manifestVersion:
+			logging.debug("Reusing manifest from cache.")
+			return patcher.manifest
+		#endif
+
+		properties = {
+			"gameID": patcher.GAME_ID,
+			"version": version
+		}
+
+		try:
+			with await self._getFromMirrors(patcher.HASH_URL.format(**properties), "hash file") as conn:
+				properties["hash"] = (await conn.read()).strip().decode("utf8")
+			#endwith
+		except (http.client.HTTPException, OSError) as err:
+			raise PatchServerError("Error retrieving hash file: " + str(err))
+		#endtry
+
+		manifest = patcher.manifests and await asyncio.to_thread(patcher.manifests.load, version, properties["hash"])
+		if manifest is None:
+			manifest = await self._downloadManifest(properties)
+			if patcher.manifests: await asyncio.to_thread(patcher.manifests.save, version, properties["hash"], manifest)
+		#endif
+
+		patcher.manifest = manifest
+		patcher.manifestVersion = version
+
+		return manifest
+	#enddef
+
+	async def _downloadManifest(self, properties):
+		""" Download and decode the manifest with the given hash, a chunk at a time as it arrives. """
+		decoder = ManifestDecoder()
+		try:
+			with await self._getFromMirrors(self.patcher.MANIFEST_URL.format(**properties), "manifest file") as conn:
+				await self._streamPart(conn, decoder)
+			#endwith
+		except (http.client.HTTPException, OSError) as err:
+			raise PatchServerError("Error retrieving manifest file: " + str(err))
+		#endtry
+
+		manifest = await asyncio.to_thread(decoder.finish)
+		logging.debug("Manifest decoded.")
+
+		return manifest
+	#enddef
+
+	async def diffManifests(self, m1, m2):
+		return await asyncio.to_thread(self.patcher.diffManifests, m1, m2)
+	#enddef
+
+	async def diffManifestWithFileSystem(self, base, manifest=None):
+		return await asyncio.to_thread(self.patcher.diffManifestWithFileSystem, base, manifest)
+	#enddef
+
+	async def diffInstallation(self, base, manifest=None, version=None):
+		return await asyncio.to_thread(self.patcher.diffInstallation, base, manifest, version)
+	#enddef
+
+	async def deltaParts(self, path, old, changes, statuses):
+		return await asyncio.to_thread(self.patcher.deltaParts, path, old, changes, statuses)
+	#enddef
+
+	async def _installedFiles(self, path, version):
+		""" As PatchServer._installedFiles, fetching the manifest through the loop. """
+		patcher = self.patcher
+		if not patcher.delta: return None
+
+		try: local = patcher.local_version or patcher.getLocalVersion(path)
+		except PatchServerError: return None
+
+		if local == version: return None
+		return patcher.selectFiles(await self.getManifest(local))["files"]
+	#enddef
+
+	async def _inThread(self, fun, *args):
+		""" Like asyncio.to_thread, but if the caller is cancelled it still waits for fun to finish before raising,
+		    so nothing fun writes can land in a file after its part is given up on. """
+		future = asyncio.ensure_future(asyncio.to_thread(fun, *args))
+		try:
+			return await asyncio.shield(future)
+		except asyncio.CancelledError:
+			while not future.done():
+				try: await asyncio.wait([future])
+				except asyncio.CancelledError: pass
+			#endwhile
+			raise
+		#endtry
+	#enddef
+
+	async def _streamPart(self, src, decoder):
+		""" Feed everything left in the response to the decoder as it arrives. Decoding and
+		    writing happen on a thread, so a slow disk doesn't hold up the event loop. """
+		patcher = self.patcher
+		while True:
+			chunk = await src.read(patcher.CHUNK_SIZE)
+			if not chunk: break
+			if patcher.limiter:
+				wait = patcher.limiter.reserve(len(chunk))
+				if wait: await asyncio.sleep(wait)
+			#endif
+			patcher.metrics.add("downloaded_bytes", len(chunk))
+			await self._inThread(decoder.feed, chunk)
+		#endwhile
+	#enddef
+
+	async def _fetchPart(self, obj, f, offset):
+		""" Write a single part into f at offset, from the cache if possible. Returns the compressed and decompressed sizes. """
+		patcher = self.patcher
+		name = patcher.PART_URL.format(gameID = patcher.GAME_ID, part = obj)
+
+		if patcher.cache:
+			sizes = await self._inThread(patcher._readCachedPart, name, obj, f, offset)
+			if sizes: return sizes
+		#endif
+
+		mirrors = patcher.getMirrors()
+		tee = await asyncio.to_thread(patcher.cache.store, name) if patcher.cache else None
+		decoder = PartDecoder(patcher, obj, f, offset, tee)
+		tried = set()
+		try:
+			async with self.fetchSlots:
+				for attempt in range(patcher.RETRIES + 1):
+					mirror = mirrors.pick(tried)
+
+					# If the connection dropped partway, only ask for the rest. Mirrors all have the same bytes.
+					start = decoder.clen
+					began = time.perf_counter()
+					try:
+						conn = await self._getURL(mirror.url + name, obj, mirror.host, {"Range": "bytes={}-".format(start)} if start else None)
+						with conn:
+							mirrors.responded(mirror, time.perf_counter() - began)
+							patcher.metrics.observe("request", time.perf_counter() - began)
+							if start and conn.status != 206:
+								# The server sent the whole thing instead.
+								decoder.restart()
+							elif start and not conn.headers.get("Content-Range", "").startswith("bytes {}-".format(start)):
+								decoder.restart()
+								raise http.client.HTTPException("resumed at the wrong place")
+							#endif
+
+							start = decoder.clen
+							await self._streamPart(conn, decoder)
+						#endwith
+						if not decoder.decompressor.eof: raise PartDecoderError("Part {} ended early.".format(obj))
+					except (PatchServerError, http.client.HTTPException, OSError) as err:
+						# Failing to write isn't the mirror's fault, and another mirror wouldn't help.
+						if isinstance(err, PartWriteError): raise
+						if isinstance(err, PartDecoderError):
+							# The mirror sent bad data, so none of it can be kept.
+							await self._inThread(decoder.restart)
+						#endif
+						mirrors.failed(mirror)
+						tried.add(mirror)
+
+						if attempt == patcher.RETRIES:
+							raise PatchServerError("Error downloading {}: {}".format(obj, str(err)))
+						#endif
+
+						logging.warn("  Part {} failed on {} after {} bytes, retrying: {}".format(obj, mirror.host, decoder.clen, str(err)))
+						await asyncio.sleep(patcher.RETRY_DELAY * 2 ** attempt)
+						continue
+					#endtry
+
+					mirrors.succeeded(mirror, decoder.clen - start, time.perf_counter() - began)
+					break
+				#endfor
+			#endwith
+
+			sizes = await self._inThread(decoder.finish)
+		except:
+			decoder.settle()
+			if tee: await asyncio.to_thread(tee.abort)
+			raise
+		#endtry
+		if tee: await asyncio.to_thread(tee.commit)
+
+		logging.info("  Downloaded part " + obj)
+
+		return sizes
+	#enddef
+
+	async def _copyPart(self, obj, source, f, offset):
+		""" Write a part that's also being written elsewhere by copying it from there once it's done. """
+		task, spath, soffset = source
+		try:
+			sizes = await asyncio.shield(task)
+		except (Exception, asyncio.CancelledError):
+			raise PatchServerError("Part {} failed elsewhere.".format(obj))
+		#endtry
+
+		done = concurrent.futures.Future()
+		done.set_result(sizes)
+		return await self._inThread(self.patcher._copyPart, obj, (done, spath, soffset), f, offset)
+	#enddef
+
+	async def _reusePart(self, obj, source, f, offset, size):
+		""" Write a part by copying it from the old version of the file, or download it if that fails. """
+		try:
+			await self._inThread(self.patcher._copyOld, obj, source, f, offset, size)
+		except (OSError, EOFError) as err:
+			logging.warn("  Couldn't reuse part {}, downloading it: {}".format(obj, str(err)))
+			return await self._fetchPart(obj, f, offset)
+		#endtry
+		return size, size
+	#enddef
+
+	async def _runPart(self, obj, job):
+		""" Run a part job, timing and counting it. """
+		metrics = self.patcher.metrics
+		began = time.perf_counter()
+		try:
+			result = await job
+		except:
+			metrics.add("parts_failed")
+			raise
+		#endtry
+		metrics.observe("part", time.perf_counter() - began)
+		metrics.add("parts_done")
+		self._report("part", obj)
+		return result
+	#enddef
+
+	async def _finishFile(self, path, fn, data, f, parts, state, version, setAside=False):
+		""" Wait for the parts of a file, check them and finish it off. setAside says whether its old
+		    version was moved out of the way for reuse, and should be removed once it's done or has failed. """
+		patcher = self.patcher
+		fpath = os.path.join(path, fn)
+		try:
+			with f:
+				try:
+					logging.info("Downloading file " + fn)
+					for obj, size, part in zip(data["objects"], data["objects_fsize"], parts):
+						clen, dlen = await part
+
+						# I dunno man
+						if clen != size and dlen != size:
+							logging.warn("  Unexpected filesize {} for part {}, expecting {}.".format(dlen, obj, size))
+						#endif
+					#endfor
+					if patcher.dropCache: await asyncio.to_thread(patcher._dropCache, f)
+				finally:
+					# Nothing may write into the file once it's closed.
+					for part in parts: part.cancel()
+					await asyncio.gather(*parts, return_exceptions=True)
+				#endtry
+			#endwith
+
+			await asyncio.to_thread(os.utime, fpath, times=(data["mtime"], data["mtime"]))
+
+			if state: await asyncio.to_thread(state.record, fn, version, data)
+			patcher.metrics.add("files_done")
+			self._report("file", fn)
+		except PatchServerError as err:
+			logging.error("Failed to download file {}: {}".format(fn, str(err)))
+			patcher.metrics.add("files_failed")
+			if state:
+				# Keep what was written, the journal knows which parts are good.
+				await asyncio.to_thread(state.forget, fn, keepParts=True)
+			else:
+				try: await asyncio.to_thread(os.remove, fpath)
+				except OSError: pass
+			#endif
+			self._report("failed", fn)
+		except:
+			# Cut short, so leave the installed version set aside for the next run to put back.
+			setAside = False
+			raise
+		finally:
+			if setAside: await asyncio.to_thread(patcher._removeAside, path, fn)
+		#endtry
+	#enddef
+
+	async def _startParts(self, fn, fpath, data, f, done, kept, parts, shared, sources, slots, state):
+		""" Start the part jobs of one file, adding them to parts, without exceeding the in-flight limit.
+		    kept maps the indexes of parts to copy from the file's old version to where they are. """
+		patcher = self.patcher
+		release = lambda task: slots.release()
+
+		# Each part goes right after the expected sizes of the ones before it.
+		offset = 0
+		for i, (obj, size) in enumerate(zip(data["objects"], data["objects_fsize"])):
+			if i in done:
+				part = asyncio.get_running_loop().create_future()
+				part.set_result((size, size))
+				patcher.metrics.plan(-size)
+				if obj in shared: sources.setdefault(obj, (part, fpath, offset))
+			else:
+				await slots.acquire()
+				if i in kept:
+					job = self._reusePart(obj, kept[i], f, offset, size)
+				elif obj in sources:
+					job = self._copyPart(obj, sources[obj], f, offset)
+				else:
+					job = self._fetchPart(obj, f, offset)
+				#endif
+
+				part = asyncio.ensure_future(self._runPart(obj, job))
+				part.add_done_callback(release)
+				if obj in shared: sources.setdefault(obj, (part, fpath, offset))
+				if state: part.add_done_callback(functools.partial(patcher._recordPart, state, fn, i, obj, offset, size))
+			#endif
+
+			parts.append(part)
+			offset += size
+		#endfor
+	#enddef
+
+	async def downloadFiles(self, path, files, version=None, skip=None, reuse=None, installed=None, keepJournal=True):
+		""" The file list to download to path. skip may give sets of part indexes known to already be written for some files,
+		    and reuse, from deltaParts, the parts to copy from the files' installed versions. Those are in the installation
+		    at installed when downloading somewhere else. Without keepJournal, for download folders, the journal is deleted
+		    once every file is downloaded. Until then it's there to resume from. """
+		patcher = self.patcher
+		version = version or patcher.manifestVersion
+		skip, reuse = skip or {}, reuse or {}
+		state = await asyncio.to_thread(patcher.openState, path)
+		failed = patcher.metrics.counters["files_failed"]
+
+		# Parts started but not yet waited for, as in PatchServer.downloadFiles.
+		slots = asyncio.Semaphore(patcher.connections * 2)
+
+		patcher.metrics.plan(sum(sum(data["objects_fsize"]) for data in files.values()
+			if not (len(data["objects"]) and data["objects"][0] == "__DIR__")))
+
+		# Objects used more than once are only fetched the first time, then copied from there.
+		shared = patcher.indexObjects(files)
+		sources = {}
+		finishing = []
+
+		try:
+			for fn, data in patcher.orderFiles(files):
+				fpath = os.path.join(path, fn)
+
+				# Don't worry about creating new folders, whatever checks the statuses should do that.
+				if len(data["objects"]) and data["objects"][0] == "__DIR__":
+					await asyncio.to_thread(os.makedirs, fpath, exist_ok=True)
+					if state: await asyncio.to_thread(state.record, fn, version, data)
+					continue
+				#endif
+
+				if fn not in reuse: old = None
+				elif installed: old = os.path.join(installed, fn)
+				else: old = await asyncio.to_thread(patcher._setAside, path, fn)
+				kept = {i: (old, offset) for i, offset in reuse[fn].items()} if old else {}
+				setAside = bool(old and not installed)
+				try:
+					f, done = await asyncio.to_thread(patcher._openForParts, state, fn, fpath, data, skip)
+				except IsADirectoryError:
+					logging.error("Tried to overwrite a folder with the file " + fn)
+					if setAside: await asyncio.to_thread(patcher._removeAside, path, fn)
+					continue
+				#endtry
+
+				parts = []
+				try:
+					await self._startParts(fn, fpath, data, f, done, kept, parts, shared, sources, slots, state)
+				except:
+					# Nothing is going to finish this file, so stop its parts before closing it.
+					for part in parts: part.cancel()
+					await asyncio.gather(*parts, return_exceptions=True)
+					f.close()
+					raise
+				#endtry
+
+				task = asyncio.ensure_future(self._finishFile(path, fn, data, f, parts, state, version, setAside))
+				finishing.append(task)
+			#endfor
+
+			await asyncio.gather(*finishing)
+		finally:
+			for task in finishing: task.cancel()
+			await asyncio.gather(*finishing, return_exceptions=True)
+		#endtry
+
+		if reuse and not installed: await asyncio.to_thread(patcher._removeAsideDirs, path)
+		if state and not keepJournal and patcher.metrics.counters["files_failed"] == failed: await asyncio.to_thread(patcher.dropState, path)
+		elif state: await asyncio.to_thread(state.seal)
+		if patcher.cache: await asyncio.to_thread(patcher.cache.trim)
+	#enddef
+
+	async def updateFileSystem(self, base, statuses):
+		""" Create new directories and delete files. """
+		await asyncio.to_thread(self.patcher.updateFileSystem, base, statuses)
+	#enddef
+
+	async def writeChanges(self, path, changes, statuses, version, reuse=None, keepJournal=True):
+		""" Make the changes to the installation, or stage them to be applied later.
+		    keepJournal is False when path is a download folder rather than an installation, so its journal only lasts until it's complete. """
+		patcher = self.patcher
+		if patcher.stage:
+			files, todo = await asyncio.to_thread(patcher.prepareStage, path, changes, statuses, version)
+			await self.downloadFiles(files, todo, version, reuse=reuse, installed=path)
+			await asyncio.to_thread(patcher.finishStage, path, changes)
+		else:
+			await self.updateFileSystem(path, statuses)
+			await self.downloadFiles(path, changes, version, reuse=reuse, keepJournal=keepJournal)
+		#endif
+	#enddef
+
+	async def applyStage(self, path):
+		await asyncio.to_thread(self.patcher.applyStage, path)
+	#enddef
+
+	async def rollbackStage(self, path):
+		await asyncio.to_thread(self.patcher.rollbackStage, path)
+	#enddef
+
+	async def update(self, path):
+		""" Update the installation. """
+		patcher = self.patcher
+		ver = await self.getLatestVersion()
+
+		old = await self._installedFiles(path, ver)
+		manifest = patcher.selectFiles(await self.getManifest(ver))
+
+		changes, statuses = await self.diffInstallation(path, manifest, ver)
+		reuse = await self.deltaParts(path, old, changes, statuses) if old else {}
+
+		await self.writeChanges(path, changes, statuses, ver, reuse)
+	#enddef
+
+	async def _ver(self, path, f, t):
+		patcher = self.patcher
+		if f and t is None:
+			f, t = f - 1, f
+		else:
+			try:
+				f = f or patcher.local_version or patcher.getLocalVersion(path)
+			except PatchServerError:
+				f = t - 1
+			#endtry
+
+			t = t or patcher.target_version or await self.getLatestVersion()
+		#endif
+
+		return (f - 1 if f == t else f), t
+	#enddef
+
+	async def download(self, path, f=None, t=None):
+		""" Download patch f_to_t. """
+		f, t = await self._ver(path, f, t)
+
+		m1 = self.patcher.selectFiles(await self.getManifest(f))
+		m2 = self.patcher.selectFiles(await self.getManifest(t))
+
+		changes, statuses = await self.diffManifests(m1, m2)
+		reuse = await self.deltaParts(path, m1["files"], changes, statuses) if self.patcher.delta else {}
+
+		await self.writeChanges(path, changes, statuses, t, reuse, keepJournal=False)
+	#enddef
+
+	async def downloadFull(self, path, version=None):
+		""" Download all the files for this version. """
+		patcher = self.patcher
+		version = version or patcher.target_version or await self.getLatestVersion()
+
+		files = patcher.selectFiles(await self.getManifest(version))["files"]
+
+		await self.writeChanges(path, files, {name: "create" for name in files.keys()}, version, keepJournal=False)
+	#enddef
+
+	async def continueDownload(self, path, f=None, t=None):
+		""" Continue downloading an update. """
+		f, t = await self._ver(path, f, t)
+
+		m1 = self.patcher.selectFiles(await self.getManifest(f))
+		m2 = self.patcher.selectFiles(await self.getManifest(t))
+
+		changes, statuses = await self.diffManifests(m1, m2)
+		changes, statuses = await self.diffInstallation(path, {"files": changes}, t)
+		reuse = await self.deltaParts(path, m1["files"], changes, statuses) if self.patcher.delta else {}
+
+		await self.writeChanges(path, changes, statuses, t, reuse)
+	#enddef
+
+	async def continueDownloadFull(self, path, version=None):
+		""" Continue downloading an update. """
+		patcher = self.patcher
+		version = version or patcher.target_version or await self.getLatestVersion()
+
+		old = await self._installedFiles(path, version)
+		manifest = patcher.selectFiles(await self.getManifest(version))
+
+		changes, statuses = await self.diffInstallation(path, manifest, version)
+		reuse = await self.deltaParts(path, old, changes, statuses) if old else {}
+
+		await self.writeChanges(path, changes, statuses, version, reuse)
+	#enddef
+
+	def close(self):
+		""" Close idle connections and the installation journal. """
+		self.pool.close()
+		if self.patcher.state:
+			self.patcher.state.close()
+			self.patcher.state = None
+		#endif
+	#enddef
+#endclass
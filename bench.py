@@ -0,0 +1,453 @@
+#!/usr/bin/env python3
+#-*- coding:utf-8 -*-
+
+# MIT Licensed
+
+""" Benchmarks for download.py that don't need Nexon's servers. """
+
+import os, sys, argparse, logging
+import json
+import time
+import zlib
+import base64
+import random
+import shutil
+import hashlib
+import tempfile
+import threading
+import subprocess
+import http.server
+
+from download import PatchServer, RateLimiter, parseRate
+
+
+def timeit(fun, *args, repeat=3):
+	""" Run fun a few times, returning the best time and the last result. """
+	best, result = None, None
+	for _ in range(repeat):
+		start = time.perf_counter()
+		result = fun(*args)
+		took = time.perf_counter() - start
+		if best is None or took < best: best = took
+	#endfor
+	return best, result
+#enddef
+
+def makeTree(base, count, perDir=100):
+	""" Create count small files under base and a manifest file table describing them.
+	    About 1% are given the wrong mtime and 1% aren't created at all. """
+	files = {}
+	for i in range(count):
+		fn = os.path.join("dir{:04}".format(i // perDir), "file{:06}.dat".format(i))
+		size = i % 64
+		mtime = 1500000000 + i
+
+		if i % 100 != 50:
+			path = os.path.join(base, fn)
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+			with open(path, "wb") as f: f.write(b"\0" * size)
+			os.utime(path, times=(mtime, mtime + (i % 100 == 25)))
+		#endif
+
+		files[fn] = {"fsize": size, "mtime": mtime, "objects": [], "objects_fsize": []}
+	#endfor
+	return {"files": files}
+#enddef
+
+def benchScan(args):
+	""" Compare diffManifestWithFileSystem against the one-stat-at-a-time method. """
+	base = tempfile.mkdtemp(prefix="mabi-bench-", dir=args.dir)
+	try:
+		print("Creating {} files in {}...".format(args.files, base))
+		manifest = makeTree(base, args.files)
+
+		patcher = PatchServer()
+		legacy, expected = timeit(patcher.legacyDiffManifestWithFileSystem, base, manifest)
+		scan, result = timeit(patcher.diffManifestWithFileSystem, base, manifest)
+
+		if result != expected:
+			print("Results differ!")
+			return 1
+		#endif
+
+		print("legacy: {:.3f}s".format(legacy))
+		print("scan:   {:.3f}s ({:.1f}x)".format(scan, legacy / scan))
+	finally:
+		shutil.rmtree(base)
+	#endtry
+
+	return 0
+#enddef
+
+class FakePatchFiles:
+	""" Synthetic manifests and parts in the patch server's format, written to a folder. """
+
+	ENCODING = "utf-16le"
+
+	def __init__(self, root, gameID=PatchServer.GAME_ID, seed=0):
+		self.root = root
+		self.gameID = gameID
+		self.random = random.Random(seed)
+	#enddef
+
+	def addPart(self, data):
+		""" Store a part, named by the hash of its contents. """
+		obj = hashlib.new(PatchServer.OBJECT_HASH, data).hexdigest()
+		path = os.path.join(self.root, *PatchServer.PART_URL.format(gameID = self.gameID, part = obj).split("/"))
+		if not os.path.exists(path):
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+			with open(path, "wb") as f: f.write(zlib.compress(data))
+		#endif
+		return obj
+	#enddef
+
+	def addFile(self, content, mtime, partSize):
+		""" Store the parts of a file's contents and return its manifest entry. """
+		objects, sizes = [], []
+		for i in range(0, len(content), partSize):
+			chunk = content[i : i + partSize]
+			objects.append(self.addPart(chunk))
+			sizes.append(len(chunk))
+		#endfor
+		return {"fsize": len(content), "mtime": mtime, "objects": objects, "objects_fsize": sizes}
+	#enddef
+
+	def encodeManifest(self, files):
+		""" Compress a manifest for files, which is {backslashed filename: entry}. """
+		encoded = {
+			base64.b64encode(fn.encode(self.ENCODING)).decode("ascii"): data
+			for fn, data in files.items()
+		}
+		return zlib.compress(json.dumps({"filepath_encoding": self.ENCODING, "files": encoded}).encode("utf8"))
+	#enddef
+
+	def addManifest(self, version, files):
+		""" Write a manifest for files and its hash file. """
+		raw = self.encodeManifest(files)
+		mhash = hashlib.sha1(raw).hexdigest()
+
+		with open(os.path.join(self.root, PatchServer.MANIFEST_URL.format(hash = mhash)), "wb") as f: f.write(raw)
+		with open(os.path.join(self.root, PatchServer.HASH_URL.format(gameID = self.gameID, version = version)), "w") as f: f.write(mhash)
+
+		return len(raw)
+	#enddef
+
+	def generate(self, count, fileSize=4096, partSize=1024, perDir=200):
+		""" Create versions 1 and 2 of a game with count files.
+		    Version 2 changes about 5% of the files, adds 1% and deletes 1%. """
+		rand = self.random
+		dirs = ["data", "package", "data\\gfx", "data\\sound", "data\\local"]
+		v1, v2 = {}, {}
+
+		for d in dirs:
+			v1[d] = v2[d] = {"fsize": 0, "mtime": 1500000000, "objects": ["__DIR__"], "objects_fsize": []}
+		#endfor
+
+		for i in range(count):
+			fn = "{}\\{:03}\\file{:07}.dat".format(dirs[i % len(dirs)], i // perDir, i)
+			size = rand.randint(fileSize // 2, fileSize * 3 // 2)
+			entry = self.addFile(rand.randbytes(size), 1500000000 + i, partSize)
+			v1[fn] = entry
+
+			roll = rand.random()
+			if roll < 0.05:
+				v2[fn] = self.addFile(rand.randbytes(size), 1600000000 + i, partSize)
+			elif roll >= 0.06:
+				v2[fn] = entry
+			#endif
+			if roll < 0.01:
+				v2[fn + ".new"] = self.addFile(rand.randbytes(size), 1600000000 + i, partSize)
+			#endif
+		#endfor
+
+		self.addManifest(1, v1)
+		self.addManifest(2, v2)
+	#enddef
+#endclass
+
+class FakePatchServer(http.server.ThreadingHTTPServer):
+	""" Serves a folder like the patch server does, with added latency and a bandwidth cap. """
+
+	daemon_threads = True
+
+	def __init__(self, root, latency=0, bandwidth=0, port=0):
+		self.root = root
+		self.latency = latency
+		self.limiter = RateLimiter(bandwidth) if bandwidth else None
+		super().__init__(("127.0.0.1", port), FakePatchHandler)
+
+		self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+		self.thread.start()
+	#enddef
+
+	@property
+	def url(self):
+		return "http://127.0.0.1:{}/".format(self.server_address[1])
+	#enddef
+
+	def stop(self):
+		self.shutdown()
+		self.server_close()
+	#enddef
+#endclass
+
+class FakePatchHandler(http.server.BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+
+	# Otherwise the headers and body go out in separate small packets and wait on delayed ACKs.
+	disable_nagle_algorithm = True
+
+	def log_message(self, *args): pass
+
+	def do_GET(self):
+		server = self.server
+		if server.latency: time.sleep(server.latency)
+
+		path = os.path.join(server.root, *self.path.lstrip("/").split("/"))
+		try:
+			with open(path, "rb") as f: data = f.read()
+		except OSError:
+			self.send_error(404)
+			return
+		#endtry
+
+		start = 0
+		rng = self.headers.get("Range", "")
+		if rng.startswith("bytes=") and rng.endswith("-"):
+			start = min(int(rng[6:-1]), len(data))
+			self.send_response(206)
+			self.send_header("Content-Range", "bytes {}-{}/{}".format(start, len(data) - 1, len(data)))
+		else:
+			self.send_response(200)
+		#endif
+
+		body = memoryview(data)[start:]
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+
+		for i in range(0, len(body), 16384):
+			chunk = body[i : i + 16384]
+			if server.limiter: server.limiter.consume(len(chunk))
+			self.wfile.write(chunk)
+		#endfor
+	#enddef
+#endclass
+
+def peakRSS():
+	""" This process's peak resident set size in bytes. """
+	try:
+		# Unlike ru_maxrss this starts over at exec, rather than carrying over the parent's peak.
+		with open("/proc/self/status") as f:
+			for line in f:
+				if line.startswith("VmHWM:"): return int(line.split()[1]) * 1024
+			#endfor
+		#endwith
+	except OSError:
+		pass
+	#endtry
+
+	import resource
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+#enddef
+
+def decodeManifestOnce(args):
+	""" Decode one manifest file and report the time taken and the growth in peak RSS, as JSON.
+	    Run in its own process for each measurement, since peak RSS can't be reset. """
+	patcher = PatchServer()
+	decode = patcher.decodeManifest if args.decode == "stream" else patcher.legacyDecodeManifest
+
+	with open(args.input, "rb") as f:
+		before = peakRSS()
+		start = time.perf_counter()
+		manifest = decode(f)
+		took = time.perf_counter() - start
+		peak = peakRSS()
+	#endwith
+
+	print(json.dumps({"time": took, "rss": peak - before, "files": len(manifest["files"])}))
+	return 0
+#enddef
+
+def benchManifest(args):
+	""" Compare streaming manifest decoding against decoding it all at once. """
+	if args.decode: return decodeManifestOnce(args)
+
+	base = tempfile.mkdtemp(prefix="mabi-bench-", dir=args.dir)
+	try:
+		print("Generating a manifest of {} files...".format(args.files))
+		rand = random.Random(0)
+		files = {}
+		for i in range(args.files):
+			parts = rand.randint(1, 4)
+			files["data\\{:04}\\file{:07}.dat".format(i // 100, i)] = {
+				"fsize": parts * 500000,
+				"mtime": 1500000000 + i,
+				"objects": ["{:040x}".format(rand.getrandbits(160)) for _ in range(parts)],
+				"objects_fsize": [500000] * parts,
+			}
+		#endfor
+
+		path = os.path.join(base, "manifest.dat")
+		with open(path, "wb") as f: f.write(FakePatchFiles(base).encodeManifest(files))
+		del files
+		print("Compressed size: {:.1f} MiB".format(os.path.getsize(path) / 1024 ** 2))
+
+		results = {}
+		for method in ("legacy", "stream"):
+			runs = []
+			for _ in range(args.repeat):
+				out = subprocess.run([sys.executable, os.path.abspath(__file__), "manifest", "--decode", method, "--input", path],
+					capture_output=True, text=True, check=True).stdout
+				runs.append(json.loads(out))
+			#endfor
+			results[method] = (min(r["time"] for r in runs), min(r["rss"] for r in runs))
+		#endfor
+
+		for method, (took, rss) in results.items():
+			print("{:7} {:.3f}s, peak RSS +{:.1f} MiB".format(method + ":", took, rss / 1024 ** 2))
+		#endfor
+	finally:
+		shutil.rmtree(base)
+	#endtry
+
+	return 0
+#enddef
+
+def gitRevision():
+	try:
+		return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+			cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+	except OSError:
+		return None
+	#endtry
+#enddef
+
+def benchSuite(args):
+	""" Time the main operations against a local stand-in patch server at several manifest sizes. """
+	logging.getLogger().setLevel(logging.ERROR)
+	results = {}
+	params = {"sizes": args.sizes, "latency": args.latency, "bandwidth": args.bandwidth, "connections": args.connections}
+
+	for count in args.sizes:
+		base = tempfile.mkdtemp(prefix="mabi-bench-", dir=args.dir)
+		server = None
+		try:
+			print("Generating {} files...".format(count))
+			www = os.path.join(base, "www")
+			install = os.path.join(base, "install")
+			os.makedirs(www)
+			os.makedirs(install)
+			FakePatchFiles(www).generate(count)
+
+			server = FakePatchServer(www, args.latency / 1000, args.bandwidth)
+
+			def patcher():
+				p = PatchServer(args.connections, journal=False)
+				p.BASE_URL = server.url
+				return p
+			#enddef
+
+			took, m1 = timeit(lambda: patcher().getManifest(1), repeat=args.repeat)
+			results["getManifest[{}]".format(count)] = took
+			m2 = patcher().getManifest(2)
+
+			p = patcher()
+			took, _ = timeit(p.diffManifests, m1, m2, repeat=args.repeat)
+			results["diffManifests[{}]".format(count)] = took
+
+			p = patcher()
+			p.updateFileSystem(install, {fn: "create" for fn in m1["files"].keys()})
+			start = time.perf_counter()
+			p.downloadFiles(install, m1["files"], 1)
+			results["downloadFiles[{}]".format(count)] = time.perf_counter() - start
+
+			took, _ = timeit(p.diffManifestWithFileSystem, install, m2, repeat=args.repeat)
+			results["diffManifestWithFileSystem[{}]".format(count)] = took
+		finally:
+			if server: server.stop()
+			shutil.rmtree(base)
+		#endtry
+	#endfor
+
+	# Compare against the last run with the same settings.
+	previous = None
+	if args.results and os.path.exists(args.results):
+		with open(args.results) as f:
+			for line in f:
+				record = json.loads(line)
+				if record.get("params") == params: previous = record
+			#endfor
+		#endwith
+	#endif
+
+	for name, took in results.items():
+		line = "{:40} {:9.3f}s".format(name, took)
+		if previous and name in previous["results"]:
+			old = previous["results"][name]
+			line += "  {:+.1%} vs {}".format((took - old) / old, previous.get("revision") or "last run")
+		#endif
+		print(line)
+	#endfor
+
+	if args.results:
+		with open(args.results, "a") as f:
+			f.write(json.dumps({"time": time.time(), "revision": gitRevision(), "params": params, "results": results}) + "\n")
+		#endwith
+	#endif
+
+	return 0
+#enddef
+
+
+def main(args):
+	parser = argparse.ArgumentParser(description="Benchmark the patcher.")
+	sub = parser.add_subparsers(dest="bench", required=True)
+
+	scan = sub.add_parser("scan", help="Time scanning an installation for changes.")
+	scan.add_argument("-n", "--files", type=int, default=100000,
+		help="Number of files in the synthetic installation.")
+	scan.add_argument("--dir", default=None,
+		help="Where to create the synthetic installation, to test a particular disk.")
+	scan.set_defaults(run=benchScan)
+
+	manifest = sub.add_parser("manifest", help="Time decoding a large manifest and measure its peak memory use.")
+	manifest.add_argument("-n", "--files", type=int, default=200000,
+		help="Number of files in the synthetic manifest.")
+	manifest.add_argument("-r", "--repeat", type=int, default=3,
+		help="Take the best of this many runs.")
+	manifest.add_argument("--dir", default=None,
+		help="Where to create the temporary files.")
+	manifest.add_argument("--decode", choices=("legacy", "stream"), help=argparse.SUPPRESS)
+	manifest.add_argument("--input", help=argparse.SUPPRESS)
+	manifest.set_defaults(run=benchManifest)
+
+	suite = sub.add_parser("suite", help="Time the main operations against a local stand-in patch server.")
+	suite.add_argument("-n", "--sizes", type=lambda x: [int(n) for n in x.split(",")], default=[1000, 10000],
+		help="Comma separated numbers of files in the manifests to test.")
+	suite.add_argument("--latency", type=float, default=0,
+		help="Milliseconds the server waits before each response.")
+	suite.add_argument("--bandwidth", type=parseRate, default=0,
+		help="Cap on the server's total bandwidth, like 10M.")
+	suite.add_argument("-c", "--connections", type=int, default=PatchServer.CONNECTIONS,
+		help="Number of parts to download at once.")
+	suite.add_argument("-r", "--repeat", type=int, default=3,
+		help="Take the best of this many runs, except for downloads.")
+	suite.add_argument("--results", default=None,
+		help="File to record results in and compare against, like bench_results.jsonl. Not recorded by default.")
+	suite.add_argument("--dir", default=None,
+		help="Where to create the temporary files.")
+	suite.set_defaults(run=benchSuite)
+
+	args = parser.parse_args(args)
+
+	logging.basicConfig(level=logging.WARNING)
+
+	return args.run(args)
+#enddef
+
+if __name__ == "__main__":
+	try: sys.exit(main(sys.argv[1:]))
+	except KeyboardInterrupt:
+		print("\nProgram terminated by user.")
+	#endtry
+#endif
@@ -4,13 +4,32 @@
 # Copyright 2017 Sapphire Becker (logicplace.com)
 # MIT Licensed
 
-import os, sys, argparse, logging
+import os, re, sys, argparse, logging
 import json
+import mmap
 import zlib
+import codecs
+import copy
+import bisect
+import fnmatch
+import hashlib
+import sqlite3
+import queue
+import random
+import shutil
 import base64
+import binascii
+import time
+import array
 import struct
-import urllib.request
-import urllib.error
+import itertools
+import threading
+import http.client
+import http.server
+import urllib.parse
+import functools
+import collections.abc
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, CancelledError, wait
 
 
 try: import NexonAPI
@@ -20,294 +39,3554 @@ else:
 	import getpass
 #endtry
 
+try: import numpy
+except ImportError:
+	numpy = None
+#endtry
+
+try: import fcntl
+except ImportError:
+	fcntl = None
+#endtry
+
 
 class PatchServerError(Exception): pass
 
-class PatchServer:
-	# Ideally one would log in and retrieve this from the Nexon API, but I'm not going to publish that!
-	GAME_ID = "10200"
-	BASE_URL = "https://download2.nexon.net/Game/nxl/games/" + GAME_ID + "/"
+class HTTPStatusError(Exception): pass
 
-	HASH_URL = "{gameID}.{version}R.manifest.hash"
-	MANIFEST_URL = "{hash}"
-	PART_URL = "{gameID}/{part:.2}/{part}"
+class PartDecoderError(PatchServerError): pass
 
-	def __init__(self):
-		# But if you have a library for it already...
-		if NexonAPI:
-			self.BASE_URL = NexonAPI.getBaseURL()
+class PartWriteError(PartDecoderError): pass
+
+class ManifestDecoderError(PatchServerError): pass
+
+class PooledResponse:
+	""" A response which hands its connection back to the pool once fully read. """
+
+	def __init__(self, pool, key, conn, response):
+		self.pool = pool
+		self.key = key
+		self.conn = conn
+		self.response = response
+		self.status = response.status
+		self.headers = response.headers
+	#enddef
+
+	def _done(self):
+		if self.conn is not None and self.response.isclosed():
+			self.pool.release(self.key, self.conn, not self.response.will_close)
+			self.conn = None
 		#endif
+	#enddef
 
-		self.local_version = None
-		self.target_version = None
+	def read(self, amt=None):
+		try:
+			data = self.response.read(amt)
+		except:
+			# A broken read leaves the connection unusable. Close it so its host slot is given back.
+			self.close()
+			raise
+		#endtry
+		self._done()
+		return data
+	#enddef
 
-		self.manifest = None
-		self.manifestVersion = None
+	def readinto(self, b):
+		try:
+			n = self.response.readinto(b)
+		except:
+			self.close()
+			raise
+		#endtry
+		if not n and len(b) and self.response.length:
+			# http.client doesn't complain about this itself.
+			self.close()
+			raise http.client.IncompleteRead(b"", self.response.length)
+		#endif
+		self._done()
+		return n
+	#enddef
+
+	def close(self):
+		""" Close the response, discarding the connection if it wasn't fully read. """
+		if self.conn is not None:
+			self.response.close()
+			self.pool.release(self.key, self.conn, False)
+			self.conn = None
+		#endif
+	#enddef
+
+	def __enter__(self): return self
+	def __exit__(self, *exc): self.close()
+#endclass
+
+class ConnectionPool:
+	""" Keep-alive HTTP(S) connections, reused per host. """
+
+	TIMEOUT = 60
+	MAX_REDIRECTS = 5
+
+	def __init__(self, timeout=None, hostLimit=None):
+		self.timeout = timeout or self.TIMEOUT
+		self.lock = threading.Lock()
+		self.idle = {}
+
+		# Requests in progress to one host are limited to this, if given.
+		self.hostLimit = hostLimit
+		self.hostSlots = {}
+
+		self.requests = 0
+		self.opened = 0
+		self.reused = 0
+	#enddef
+
+	def _acquire(self, key):
+		if self.hostLimit:
+			with self.lock:
+				slots = self.hostSlots.setdefault(key, threading.Semaphore(self.hostLimit))
+			#endwith
+			slots.acquire()
+		#endif
+
+		with self.lock:
+			idle = self.idle.get(key)
+			if idle:
+				self.reused += 1
+				return idle.pop(), True
+			#endif
+			self.opened += 1
+		#endwith
+
+		scheme, host = key
+		if scheme == "https":
+			return http.client.HTTPSConnection(host, timeout=self.timeout), False
+		#endif
+		return http.client.HTTPConnection(host, timeout=self.timeout), False
+	#enddef
+
+	def release(self, key, conn, reusable=True):
+		""" Return a connection to the pool, or close it. """
+		if reusable:
+			with self.lock:
+				self.idle.setdefault(key, []).append(conn)
+			#endwith
+		else:
+			conn.close()
+		#endif
+
+		if self.hostLimit: self.hostSlots[key].release()
+	#enddef
+
+	def request(self, url, headers=None):
+		""" GET a URL, following redirects. Raises HTTPStatusError for error statuses and OSError on connection failures. """
+		for _ in range(self.MAX_REDIRECTS + 1):
+			parts = urllib.parse.urlsplit(url)
+			key = (parts.scheme, parts.netloc)
+			target = parts.path or "/"
+			if parts.query: target += "?" + parts.query
+
+			with self.lock: self.requests += 1
+
+			while True:
+				conn, reused = self._acquire(key)
+				try:
+					conn.request("GET", target, headers=headers or {})
+					response = conn.getresponse()
+				except (http.client.HTTPException, OSError):
+					self.release(key, conn, False)
+					# The server may have dropped an idle connection, try again with a fresh one.
+					if reused: continue
+					raise
+				#endtry
+				break
+			#endwhile
+
+			response = PooledResponse(self, key, conn, response)
+			if response.status in (301, 302, 303, 307, 308) and "Location" in response.headers:
+				with response: response.read()
+				url = urllib.parse.urljoin(url, response.headers["Location"])
+				continue
+			elif response.status >= 400:
+				with response: response.read()
+				raise HTTPStatusError("HTTP Error {}: {}".format(response.status, response.response.reason))
+			#endif
+
+			return response
+		#endfor
+
+		raise HTTPStatusError("Too many redirects")
+	#enddef
+
+	def close(self):
+		""" Close all idle connections. """
+		with self.lock:
+			idle, self.idle = self.idle, {}
+		#endwith
+		for conns in idle.values():
+			for conn in conns: conn.close()
+		#endfor
+	#enddef
+
+	def report(self):
+		logging.info("Made {} requests over {} connections ({} reused).".format(self.requests, self.opened, self.reused))
+	#enddef
+#endclass
+
+def parseRate(text):
+	""" Parse a rate like 500K, 2.5M or 1G (bytes per second). 0 means unlimited. """
+	text = text.strip().upper().rstrip("/S").rstrip("B")
+	scale = 1
+	if text and text[-1] in "KMG":
+		scale = 1024 ** ("KMG".index(text[-1]) + 1)
+		text = text[:-1]
+	#endif
+	return int(float(text) * scale)
+#enddef
+
+def loadJSON(filename):
+	""" Read a JSON file written by saveJSON, or return None if there isn't one. """
+	try:
+		with open(filename, "r") as f:
+			return json.load(f)
+		#endwith
+	except FileNotFoundError:
+		return None
+	#endtry
+#enddef
+
+def saveJSON(filename, data):
+	""" Write a JSON file whole or not at all. Mappings, like file tables, are written as objects. """
+	tmp = filename + ".tmp"
+	with open(tmp, "w") as f:
+		json.dump(data, f, default=dict)
+		# It's renamed over the old one only once it's surely on disk.
+		f.flush()
+		os.fsync(f.fileno())
+	#endwith
+	os.replace(tmp, filename)
+#enddef
+
+class RateLimiter:
+	""" A token bucket shared by every download, capping the total bytes per second. """
+
+	# The bucket holds this many seconds' worth of tokens.
+	BURST = 0.25
+
+	# How often to look at the rate file, in seconds.
+	WATCH_INTERVAL = 1
+
+	def __init__(self, rate=0, watch=None):
+		self.lock = threading.Lock()
+		self.rate = 0
+		self.tokens = 0
+		self.last = time.monotonic()
+		self.setRate(rate)
+
+		# A file holding the rate, reread whenever it changes.
+		self.watch = watch
+		self.watchChecked = 0
+		self.watchMtime = None
 	#enddef
 
-	def _getURL(self, url, fileName=None, serverName=None):
+	def setRate(self, rate):
+		""" Change the cap, in bytes per second. Takes effect immediately, even mid-run. """
+		with self.lock:
+			if rate != self.rate: logging.info("Bandwidth limit set to {}.".format(
+				"{:.1f} KiB/s".format(rate / 1024) if rate else "unlimited"))
+			self.rate = rate
+			self.tokens = min(self.tokens, rate * self.BURST)
+		#endwith
+	#enddef
+
+	def _checkWatch(self, now):
+		if not self.watch or now - self.watchChecked < self.WATCH_INTERVAL: return
+		self.watchChecked = now
+
 		try:
-			return urllib.request.urlopen(url)
-		except urllib.error.HTTPError as err:
-			if fileName is None: fileName = url.split("/")[-1]
-			raise PatchServerError("Error retrieving {}: {}".format(fileName, str(err)))
-		except urllib.error.URLError as err:
-			if serverName is None: serverName = url.split("/", maxsplit=3)[2]
-			raise PatchServerError("Could not connect {}: {}".format(serverName, str(err)))
+			mtime = os.stat(self.watch).st_mtime
+			if mtime == self.watchMtime: return
+			self.watchMtime = mtime
+			with open(self.watch) as f: rate = parseRate(f.read() or "0")
+		except (OSError, ValueError) as err:
+			logging.debug("Couldn't read the rate file: " + str(err))
+			return
 		#endtry
-	#enddfe
 
-	def getWebLaunchStatus(self):
-		""" Returns true if the web launcher thinks the game is up. """
-		conn = self._getURL("http://www.nexon.net/json/game_status.js", "status file")
+		self.setRate(rate)
+	#enddef
 
-		# Have to de-JSONp this.
-		response = json.loads(conn.read()[len("nexon.games.playGame(") : -2].decode("utf8"))
+	def reserve(self, n):
+		""" Take n bytes worth of tokens. Returns how many seconds to wait before using them. """
+		self._checkWatch(time.monotonic())
+
+		with self.lock:
+			if not self.rate: return 0
+			# Read under the lock, so a thread that got here earlier can't set last back and refill less than nothing.
+			now = time.monotonic()
+			self.tokens = min(self.tokens + (now - self.last) * self.rate, self.rate * self.BURST)
+			self.last = now
+			# Go into debt and wait it off, so large chunks still get through.
+			self.tokens -= n
+			return -self.tokens / self.rate if self.tokens < 0 else 0
+		#endwith
+	#enddef
 
-		# This is Mabi's ID here
-		status = response["SVG012"]
-		logging.info("Web launch status is: {}.".format("UP" if status else "DOWN"))
-		return status
+	def consume(self, n):
+		""" Take n bytes worth of tokens, waiting if there aren't enough. """
+		wait = self.reserve(n)
+		if wait: time.sleep(wait)
 	#enddef
+#endclass
 
-	def legacyGetLatestVersion(self):
-		""" Get the latest version as reported by the legacy launcher info. """
-		conn = self._getURL("http://mabipatchinfo.nexon.net/patch/patch.txt", "patch info file")
+class RunMetrics:
+	""" Counters and latency histograms for a run, with a live progress line and exports. """
 
-		# Format is a list of var=val, one per line.
-		txt = conn.read().decode("utf8").split("\n")
-		for line in txt:
-			var, val = line.split("=", maxsplit=1)
-			if var.strip() == "main_version": return int(val.strip())
+	# Histogram bucket upper bounds, in seconds.
+	BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60)
+
+	# Phases timed: waiting for a response, a whole part, decompressing a chunk, writing a chunk.
+	PHASES = ("request", "part", "decompress", "write")
+
+	COUNTERS = ("downloaded_bytes", "written_bytes", "reused_bytes", "shared_bytes", "copied_bytes", "peer_bytes",
+		"parts_done", "parts_failed", "files_done", "files_failed")
+
+	# Seconds between progress line updates.
+	PROGRESS_INTERVAL = 1
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.started = time.time()
+		self.counters = dict.fromkeys(self.COUNTERS, 0)
+		self.planned = 0
+		self.histograms = {phase: [0] * (len(self.BUCKETS) + 1) for phase in self.PHASES}
+		self.sums = dict.fromkeys(self.PHASES, 0.0)
+		self.progressThread = None
+		self.progressStop = threading.Event()
+	#enddef
+
+	def add(self, counter, n=1):
+		with self.lock: self.counters[counter] += n
+	#enddef
+
+	def plan(self, size):
+		""" Expect size more bytes to be written. Negative when it turns out they needn't be. """
+		with self.lock: self.planned += size
+	#enddef
+
+	def observe(self, phase, seconds):
+		i = 0
+		while i < len(self.BUCKETS) and seconds > self.BUCKETS[i]: i += 1
+		with self.lock:
+			self.histograms[phase][i] += 1
+			self.sums[phase] += seconds
+		#endwith
+	#enddef
+
+	def summary(self):
+		""" A dict of everything, including rates and ETA. """
+		with self.lock:
+			elapsed = max(time.time() - self.started, 1e-9)
+			written = self.counters["written_bytes"]
+			rate = written / elapsed
+			left = max(self.planned - written, 0)
+			return {
+				"started": self.started,
+				"elapsed": elapsed,
+				"counters": dict(self.counters),
+				"planned_bytes": self.planned,
+				"progress": written / self.planned if self.planned else 1.0,
+				"download_rate": self.counters["downloaded_bytes"] / elapsed,
+				"write_rate": rate,
+				"parts_rate": self.counters["parts_done"] / elapsed,
+				"eta": left / rate if rate else None,
+				"phases": {phase: {
+					"count": sum(self.histograms[phase]),
+					"seconds": self.sums[phase],
+					"buckets": dict(zip([str(b) for b in self.BUCKETS] + ["+Inf"], self.histograms[phase])),
+				} for phase in self.PHASES},
+			}
+		#endwith
+	#enddef
+
+	def progressLine(self):
+		stats = self.summary()
+		eta = stats["eta"]
+		return "{:5.1%} {:.1f}/{:.1f} MiB, {:.2f} MiB/s down, {:.1f} parts/s, ETA {}".format(
+			stats["progress"], stats["counters"]["written_bytes"] / 1024 ** 2, stats["planned_bytes"] / 1024 ** 2,
+			stats["download_rate"] / 1024 ** 2, stats["parts_rate"],
+			"?" if eta is None else "{}:{:02}:{:02}".format(int(eta) // 3600, int(eta) // 60 % 60, int(eta) % 60))
+	#enddef
+
+	def _showProgress(self):
+		while not self.progressStop.wait(self.PROGRESS_INTERVAL):
+			sys.stderr.write("\r" + self.progressLine() + "\x1b[K")
+			sys.stderr.flush()
+		#endwhile
+		sys.stderr.write("\r" + self.progressLine() + "\x1b[K\n")
+	#enddef
+
+	def startProgress(self):
+		""" Keep a progress line updated on stderr until stopProgress. """
+		if self.progressThread: return
+		self.progressStop.clear()
+		self.progressThread = threading.Thread(target=self._showProgress, daemon=True)
+		self.progressThread.start()
+	#enddef
+
+	def stopProgress(self):
+		if not self.progressThread: return
+		self.progressStop.set()
+		self.progressThread.join()
+		self.progressThread = None
+	#enddef
+
+	def writeJSON(self, filename, extra=None):
+		extra = extra or {}
+		stats = self.summary()
+		stats.update(extra)
+		with open(filename, "w") as f:
+			json.dump(stats, f, indent=4, sort_keys=True)
+		#endwith
+	#enddef
+
+	def writePrometheus(self, filename, extra=None):
+		""" Write a file for node_exporter's textfile collector. extra is more gauges by name. """
+		extra = extra or {}
+		stats = self.summary()
+		lines = []
+		for name, value in stats["counters"].items():
+			lines.append("# TYPE mabi_patch_{}_total counter".format(name))
+			lines.append("mabi_patch_{}_total {}".format(name, value))
+		#endfor
+
+		gauges = {
+			"planned_bytes": stats["planned_bytes"],
+			"progress_ratio": stats["progress"],
+			"elapsed_seconds": stats["elapsed"],
+			"eta_seconds": -1 if stats["eta"] is None else stats["eta"],
+			"last_run_timestamp_seconds": time.time(),
+		}
+		gauges.update(extra)
+		for name, value in gauges.items():
+			lines.append("# TYPE mabi_patch_{} gauge".format(name))
+			lines.append("mabi_patch_{} {}".format(name, value))
+		#endfor
+
+		lines.append("# TYPE mabi_patch_phase_seconds histogram")
+		for phase, data in stats["phases"].items():
+			total = 0
+			for le, count in data["buckets"].items():
+				total += count
+				lines.append('mabi_patch_phase_seconds_bucket{{phase="{}",le="{}"}} {}'.format(phase, le, total))
+			#endfor
+			lines.append('mabi_patch_phase_seconds_sum{{phase="{}"}} {}'.format(phase, data["seconds"]))
+			lines.append('mabi_patch_phase_seconds_count{{phase="{}"}} {}'.format(phase, data["count"]))
+		#endfor
+
+		# The collector may read at any time, so never let it see half a file.
+		tmp = filename + ".tmp"
+		with open(tmp, "w") as f:
+			f.write("\n".join(lines) + "\n")
+		#endwith
+		os.replace(tmp, filename)
+	#enddef
+#endclass
+
+class Mirror:
+	""" A base URL to fetch parts from, and how well it's been doing. """
+
+	def __init__(self, url):
+		self.url = url
+		self.host = url.split("/", maxsplit=3)[2]
+
+		# Smoothed seconds to first byte and bytes per second, None until measured.
+		self.latency = None
+		self.throughput = None
+
+		self.failures = 0
+		self.until = 0
+		self.requests = 0
+		self.bytes = 0
+	#enddef
+#endclass
+
+class MirrorSet:
+	""" Spreads requests across mirrors by their measured speed, and benches ones that fail. """
+
+	# Weight of a new measurement in the smoothed values.
+	SMOOTHING = 0.2
+
+	# Seconds a failed mirror is benched for, doubling with each failure in a row.
+	BACKOFF = 2
+	MAX_BACKOFF = 300
+
+	# Assumed part size when comparing latency against throughput.
+	PART_SIZE = 1024 ** 2
+
+	def __init__(self, urls):
+		self.mirrors = [Mirror(url) for url in urls]
+		self.lock = threading.Lock()
+	#enddef
+
+	def _expected(self, mirror):
+		""" Estimated seconds for this mirror to deliver a part. Unmeasured mirrors are assumed to be as good as the best. """
+		latencies = [m.latency for m in self.mirrors if m.latency is not None]
+		throughputs = [m.throughput for m in self.mirrors if m.throughput]
+		latency = mirror.latency if mirror.latency is not None else min(latencies, default=0.1)
+		throughput = mirror.throughput or max(throughputs, default=self.PART_SIZE)
+		return latency + self.PART_SIZE / throughput
+	#enddef
+
+	def ranked(self):
+		""" Mirrors from best to worst, benched ones last. """
+		now = time.monotonic()
+		with self.lock:
+			return sorted(self.mirrors, key=lambda m: (m.until > now, self._expected(m)))
+		#endwith
+	#enddef
+
+	def pick(self, exclude=()):
+		""" Choose a mirror at random, weighted towards the faster ones, avoiding excluded and benched ones if possible. """
+		now = time.monotonic()
+		with self.lock:
+			candidates = [m for m in self.mirrors if m not in exclude and m.until <= now]
+			if not candidates: candidates = [m for m in self.mirrors if m not in exclude] or self.mirrors
+			weights = [1 / self._expected(m) for m in candidates]
+			mirror = random.choices(candidates, weights)[0]
+			mirror.requests += 1
+			return mirror
+		#endwith
+	#enddef
+
+	def _smooth(self, old, new):
+		return new if old is None else old + self.SMOOTHING * (new - old)
+	#enddef
+
+	def responded(self, mirror, latency):
+		with self.lock:
+			mirror.latency = self._smooth(mirror.latency, latency)
+		#endwith
+	#enddef
+
+	def succeeded(self, mirror, size, took):
+		with self.lock:
+			mirror.failures = 0
+			mirror.bytes += size
+			if took > 0 and size: mirror.throughput = self._smooth(mirror.throughput, size / took)
+		#endwith
+	#enddef
+
+	def failed(self, mirror):
+		with self.lock:
+			mirror.failures += 1
+			mirror.until = time.monotonic() + min(self.BACKOFF * 2 ** (mirror.failures - 1), self.MAX_BACKOFF)
+		#endwith
+	#enddef
+
+	def report(self):
+		if len(self.mirrors) < 2: return
+		for m in self.mirrors:
+			logging.info("Mirror {}: {} requests, {:.1f} MiB, {} latency, {} throughput.".format(
+				m.url, m.requests, m.bytes / 1024 ** 2,
+				"?" if m.latency is None else "{:.0f}ms".format(m.latency * 1000),
+				"?" if m.throughput is None else "{:.1f} MiB/s".format(m.throughput / 1024 ** 2)))
+		#endfor
+	#enddef
+#endclass
+
+class CachedObjectWriter:
+	""" Collects an object being downloaded and adds it to the cache once it's complete. """
+
+	def __init__(self, cache, name, path):
+		self.cache = cache
+		self.path = path
+		# Unique per writer so processes sharing the cache never collide.
+		self.tmp = "{}.{}.{}.{:x}.tmp".format(path, os.getpid(), threading.get_ident(), id(self))
+		self.size = 0
+
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		self.f = open(self.tmp, "wb")
+	#enddef
+
+	def write(self, data):
+		self.f.write(data)
+		self.size += len(data)
+	#enddef
+
+	def reset(self):
+		self.f.seek(0)
+		self.f.truncate()
+		self.size = 0
+	#enddef
+
+	def commit(self):
+		self.f.close()
+		try:
+			# Atomic, so readers see either nothing or the whole object.
+			os.replace(self.tmp, self.path)
+		except OSError:
+			# Probably someone else is storing or reading the same object.
+			self.abort()
+		else:
+			self.cache.added(self.size)
+		#endtry
+	#enddef
+
+	def abort(self):
+		self.f.close()
+		try: os.remove(self.tmp)
+		except OSError: pass
+	#enddef
+#endclass
+
+class ObjectCache:
+	""" On-disk store of compressed objects, keyed by their part URL, with LRU eviction by mtime. """
+
+	# Default size limit, in bytes.
+	LIMIT = 4 * 1024 ** 3
+
+	# Leftover temporary files older than this (in seconds) are from dead processes.
+	STALE = 24 * 60 * 60
+
+	def __init__(self, root, limit=None):
+		self.root = root
+		self.limit = limit or self.LIMIT
+		self.lock = threading.Lock()
+		self.trimLock = threading.Lock()
+		self.sinceTrim = 0
+
+		self.hits = 0
+		self.misses = 0
+		self.hitBytes = 0
+
+		os.makedirs(root, exist_ok=True)
+	#enddef
+
+	def _path(self, name):
+		return os.path.join(self.root, *name.split("/"))
+	#enddef
+
+	def open(self, name):
+		""" Open a cached object for reading, or return None if it's not cached. """
+		path = self._path(name)
+		try:
+			f = open(path, "rb")
+		except OSError:
+			with self.lock: self.misses += 1
+			return None
+		#endtry
+
+		# Mark it as recently used. Another process may have evicted it already, which is fine.
+		try: os.utime(path)
+		except OSError: pass
+
+		with self.lock:
+			self.hits += 1
+			self.hitBytes += os.fstat(f.fileno()).st_size
+		#endwith
+		return f
+	#enddef
+
+	def has(self, name):
+		""" Whether an object is cached, without counting it as a lookup. """
+		return os.path.isfile(self._path(name))
+	#enddef
+
+	def discard(self, name):
+		""" Drop a bad object that was counted as a hit. """
+		path = self._path(name)
+		try:
+			size = os.path.getsize(path)
+			os.remove(path)
+		except OSError:
+			size = 0
+		#endtry
+
+		with self.lock:
+			self.hits -= 1
+			self.misses += 1
+			self.hitBytes -= size
+		#endwith
+	#enddef
+
+	def store(self, name):
+		""" Start storing an object. """
+		return CachedObjectWriter(self, name, self._path(name))
+	#enddef
+
+	def added(self, size):
+		with self.lock:
+			self.sinceTrim += size
+			full = self.sinceTrim >= self.limit // 4
+		#endwith
+		if full: self.trim()
+	#enddef
+
+	def trim(self):
+		""" Evict the least recently used objects until the cache is under its limit. """
+		# If another thread is already trimming, there's no need to do it twice.
+		if not self.trimLock.acquire(blocking=False): return
+		try:
+			with self.lock: self.sinceTrim = 0
+
+			entries, total = [], 0
+			now = time.time()
+			stack = [self.root]
+			while stack:
+				for entry in os.scandir(stack.pop()):
+					try:
+						if entry.is_dir(follow_symlinks=False):
+							stack.append(entry.path)
+							continue
+						#endif
+
+						st = entry.stat(follow_symlinks=False)
+						if entry.name.endswith(".tmp"):
+							if now - st.st_mtime > self.STALE: os.remove(entry.path)
+							continue
+						#endif
+					except OSError:
+						continue
+					#endtry
+
+					entries.append((st.st_mtime, st.st_size, entry.path))
+					total += st.st_size
+				#endfor
+			#endwhile
+
+			if total <= self.limit: return
+
+			entries.sort()
+			evicted = 0
+			for mtime, size, path in entries:
+				if total <= self.limit: break
+				# Other processes may be evicting as well, or still reading it.
+				try: os.remove(path)
+				except OSError: continue
+				total -= size
+				evicted += 1
+			#endfor
+
+			logging.debug("Evicted {} objects from the cache.".format(evicted))
+		finally:
+			self.trimLock.release()
+		#endtry
+	#enddef
+
+	def report(self):
+		lookups = self.hits + self.misses
+		if lookups:
+			logging.info("Object cache: {} hits, {} misses ({:.1%} hit rate), {:.1f} MiB from cache.".format(
+				self.hits, self.misses, self.hits / lookups, self.hitBytes / 1024 ** 2))
+		#endif
+	#enddef
+#endclass
+
+class PartRequestHandler(http.server.BaseHTTPRequestHandler):
+	""" Sends cached objects from their PART_URL paths, whole or from an offset. """
+
+	protocol_version = "HTTP/1.1"
+
+	# Only paths like 10200/ab/ab12..., so nothing else in the folder can be asked for.
+	PATH = re.compile(r"^/\w+/([0-9a-f]{2})/\1[0-9a-f]+$")
+
+	def log_message(self, format, *args):
+		logging.debug("Peer {}: {}".format(self.address_string(), format % args))
+	#enddef
+
+	def do_GET(self):
+		parts = self.server.parts
+		path = self.path.split("?", 1)[0]
+		f = parts.cache.open(path[1:]) if self.PATH.match(path) else None
+		if f is None:
+			parts.missed()
+			self.send_error(404)
+			return
+		#endif
+
+		with f:
+			size = os.fstat(f.fileno()).st_size
+			start = 0
+			match = re.match(r"bytes=(\d+)-$", self.headers.get("Range", ""))
+			if match and int(match.group(1)) < size:
+				start = int(match.group(1))
+				self.send_response(206)
+				self.send_header("Content-Range", "bytes {}-{}/{}".format(start, size - 1, size))
+			else:
+				self.send_response(200)
+			#endif
+			self.send_header("Content-Type", "application/octet-stream")
+			self.send_header("Content-Length", str(size - start))
+			self.end_headers()
+			self.wfile.flush()
+
+			try:
+				self.connection.sendfile(f, start, size - start)
+			except OSError:
+				# The client went away.
+				self.close_connection = True
+				return
+			#endtry
+		#endwith
+
+		parts.served(self.client_address[0], size - start)
+	#enddef
+#endclass
+
+class PartHTTPServer(http.server.ThreadingHTTPServer):
+	# Many clients may start updating at once.
+	request_queue_size = 128
+	daemon_threads = True
+#endclass
+
+class PartServer:
+	""" Serves the object cache over HTTP in the PART_URL layout, so other patchers on the network can use it as a peer. """
+
+	# Seconds between reports of what's been served.
+	REPORT_INTERVAL = 60
+
+	def __init__(self, cache, address):
+		self.cache = cache
+		self.lock = threading.Lock()
+		self.servedBytes = 0
+		self.servedParts = 0
+		self.misses = 0
+		self.clients = set()
+
+		self.httpd = PartHTTPServer(address, PartRequestHandler)
+		self.httpd.parts = self
+		self.thread = None
+		self.stopReports = threading.Event()
+	#enddef
+
+	def served(self, client, size):
+		with self.lock:
+			self.servedBytes += size
+			self.servedParts += 1
+			self.clients.add(client)
+		#endwith
+	#enddef
+
+	def missed(self):
+		with self.lock: self.misses += 1
+	#enddef
+
+	def summary(self):
+		""" What's been served. Every byte served is one a peer didn't download from the internet. """
+		with self.lock:
+			return "Served {} parts ({:.1f} MiB of internet traffic saved) to {} peers, {} weren't cached.".format(
+				self.servedParts, self.servedBytes / 1024 ** 2, len(self.clients), self.misses)
+		#endwith
+	#enddef
+
+	def _report(self):
+		last = None
+		while not self.stopReports.wait(self.REPORT_INTERVAL):
+			line = self.summary()
+			if line != last: logging.info(line)
+			last = line
+		#endwhile
+	#enddef
+
+	def start(self):
+		""" Serve on background threads until stop. """
+		host, port = self.httpd.server_address[:2]
+		logging.info("Serving parts from {} on {}:{}".format(self.cache.root, host, port))
+		self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+		self.thread.start()
+		threading.Thread(target=self._report, daemon=True).start()
+	#enddef
+
+	def wait(self):
+		# Wake up now and then, so KeyboardInterrupt gets through.
+		while self.thread.is_alive(): self.thread.join(1)
+	#enddef
+
+	def stop(self):
+		self.stopReports.set()
+		self.httpd.shutdown()
+		self.httpd.server_close()
+	#enddef
+#endclass
+
+class FileWriter:
+	""" Writes data at offsets in files on threads of its own, so downloads don't wait on the disk. """
+
+	# Most writes to queue before whoever's adding more has to wait.
+	BACKLOG = 64
+
+	# Smaller writes are quicker to do than to hand off.
+	MIN_SIZE = 16 * 1024
+
+	def __init__(self, patcher, threads):
+		self.patcher = patcher
+		self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="writer")
+		self.slots = threading.Semaphore(self.BACKLOG)
+	#enddef
+
+	def write(self, f, data, offset):
+		""" Queue writing data, which mustn't change until it's written, at offset in f. Returns a Future. """
+		self.slots.acquire()
+		try:
+			future = self.pool.submit(self.patcher._writeAt, f, data, offset)
+		except:
+			self.slots.release()
+			raise
+		#endtry
+		future.add_done_callback(lambda future: self.slots.release())
+		return future
+	#enddef
+
+	def close(self):
+		self.pool.shutdown()
+	#enddef
+#endclass
+
+class PartDecoder:
+	""" Decompresses a part into its place in a file as its compressed data arrives.
+	    Without a file, the part is only decoded and checked, for whatever the tee keeps of it. """
+
+	def __init__(self, patcher, obj, f, offset, tee=None):
+		self.patcher = patcher
+		self.obj = obj
+		self.f = f
+		self.offset = offset
+		self.tee = tee
+		# Writes handed to the patcher's FileWriter and not yet waited on.
+		self.writes = collections.deque()
+		# Whether to check the part against its object ID, and the most it may write, for sources that aren't trusted.
+		self.verify = False
+		self.limit = None
+		self.restart()
+	#enddef
+
+	def restart(self):
+		""" Start over from the beginning of the part. """
+		self.settle()
+		self.decompressor = zlib.decompressobj()
+		self.hasher = hashlib.new(self.patcher.OBJECT_HASH) if self.verify else None
+		self.clen, self.dlen = 0, 0
+		if self.tee: self.tee.reset()
+	#enddef
+
+	def feed(self, chunk):
+		self.clen += len(chunk)
+		size = self.patcher.CHUNK_SIZE
+		metrics = self.patcher.metrics
+		try:
+			if self.tee: self.tee.write(chunk)
+
+			# Bound the output so memory use stays at about one chunk each way.
+			began = time.perf_counter()
+			data = self.decompressor.decompress(chunk, size)
+			metrics.observe("decompress", time.perf_counter() - began)
+			while data:
+				self._write(data)
+
+				began = time.perf_counter()
+				data = self.decompressor.decompress(self.decompressor.unconsumed_tail, size)
+				metrics.observe("decompress", time.perf_counter() - began)
+			#endwhile
+		except zlib.error as err:
+			raise PartDecoderError("Error decompressing {}: {}".format(self.obj, str(err)))
+		except OSError as err:
+			raise PartWriteError("Error writing {}: {}".format(self.obj, str(err)))
+		#endtry
+	#enddef
+
+	def _write(self, data):
+		if self.limit is not None and self.dlen + len(data) > self.limit:
+			raise PartDecoderError("Part {} is bigger than expected.".format(self.obj))
+		#endif
+		if self.hasher: self.hasher.update(data)
+		writer = self.patcher.writer
+		if self.f is None:
+			pass
+		elif writer and len(data) >= writer.MIN_SIZE:
+			# Surface any failed writes before queueing more.
+			while self.writes and self.writes[0].done():
+				self.writes.popleft().result()
+			#endwhile
+			self.writes.append(writer.write(self.f, data, self.offset + self.dlen))
+		else:
+			self.patcher._writeAt(self.f, data, self.offset + self.dlen)
+		#endif
+		self.dlen += len(data)
+	#enddef
+
+	def settle(self):
+		""" Wait for this part's writes in progress. Returns the first error among them, if any. """
+		error = None
+		while self.writes:
+			try: self.writes.popleft().result()
+			except (OSError, ValueError) as err: error = error or err
+		#endwhile
+		return error
+	#enddef
+
+	def finish(self):
+		""" Flush the rest of the part. Returns the compressed and decompressed sizes. """
+		try:
+			data = self.decompressor.flush()
+			if data: self._write(data)
+			error = self.settle()
+			if error: raise error
+		except zlib.error as err:
+			raise PartDecoderError("Error decompressing {}: {}".format(self.obj, str(err)))
+		except (OSError, ValueError) as err:
+			raise PartWriteError("Error writing {}: {}".format(self.obj, str(err)))
+		#endtry
+
+		if not self.decompressor.eof:
+			raise PartDecoderError("Part {} ended early.".format(self.obj))
+		elif self.hasher and self.hasher.hexdigest() != self.obj:
+			raise PartDecoderError("Part {} doesn't match its ID.".format(self.obj))
+		#endif
+
+		return self.clen, self.dlen
+	#enddef
+#endclass
+
+class ManifestDecoder:
+	""" Decodes a manifest as its compressed data arrives.
+	    File entries are parsed one at a time out of a small text buffer and stored under their
+	    decoded filenames straight away, so the whole text is never held at once. """
+
+	WHITESPACE = json.decoder.WHITESPACE.match
+
+	def __init__(self):
+		self.decompressor = zlib.decompressobj()
+		self.text = codecs.getincrementaldecoder("utf8")()
+		self.json = json.JSONDecoder()
+		self.buffer = ""
+		self.state = "start"
+		self.batch = True
+
+		self.manifest = {}
+		self.files = ManifestFiles()
+		self.encoding = None
+		# Entries seen before filepath_encoding, as (encoded filename, entry).
+		self.pending = []
+	#enddef
+
+	def feed(self, chunk):
+		try:
+			data = self.decompressor.decompress(chunk)
+			text = self.text.decode(data)
+		except zlib.error as err:
+			raise ManifestDecoderError("Error decompressing manifest: " + str(err))
+		except UnicodeDecodeError as err:
+			raise ManifestDecoderError("Error decoding manifest: " + str(err))
+		#endtry
+		if text:
+			self.buffer += text
+			self._parse(False)
+		#endif
+	#enddef
+
+	def finish(self):
+		""" Parse the rest of the manifest and return it. """
+		try:
+			data = self.decompressor.flush()
+			self.buffer += self.text.decode(data, True)
+		except zlib.error as err:
+			raise ManifestDecoderError("Error decompressing manifest: " + str(err))
+		except UnicodeDecodeError as err:
+			raise ManifestDecoderError("Error decoding manifest: " + str(err))
+		#endtry
+
+		if not self.decompressor.eof:
+			raise ManifestDecoderError("Manifest ended early.")
+		#endif
+
+		self._parse(True)
+		if self.state != "done":
+			raise ManifestDecoderError("Manifest ended early.")
+		elif self.encoding is None:
+			raise ManifestDecoderError("Manifest has no filepath_encoding.")
+		#endif
+
+		return self.manifest
+	#enddef
+
+	def _value(self, buf, pos, final):
+		""" Parse the JSON value at pos. Returns it and where it ends, or None if it isn't all here yet. """
+		try:
+			value, end = self.json.raw_decode(buf, pos)
+		except json.JSONDecodeError as err:
+			if final: raise ManifestDecoderError("Error parsing manifest: " + str(err))
+			return None
+		#endtry
+
+		# A number running up to the end of the buffer might continue in the next chunk.
+		if end >= len(buf) and not final: return None
+		return value, end
+	#enddef
+
+	def _pair(self, buf, pos, final):
+		""" Parse a "key": value pair at pos, or return None if it isn't all here yet. """
+		key = self._value(buf, pos, final)
+		if key is None: return None
+		key, pos = key
+		if not isinstance(key, str):
+			raise self._expected("a key", pos)
+		#endif
+
+		pos = self.WHITESPACE(buf, pos).end()
+		if pos >= len(buf):
+			if final: raise ManifestDecoderError("Error parsing manifest: missing value")
+			return None
+		elif buf[pos] != ":":
+			raise self._expected(":", pos)
+		#endif
+
+		pos = self.WHITESPACE(buf, pos + 1).end()
+		value = self._value(buf, pos, final)
+		if value is None: return None
+		return key, value[0], value[1]
+	#enddef
+
+	def _expected(self, what, pos):
+		return ManifestDecoderError("Error parsing manifest: expected {} at {}".format(what, pos))
+	#enddef
+
+	def _addFile(self, key, entry):
+		if self.encoding is None:
+			self.pending.append((key, entry))
+			return
+		#endif
+
+		try:
+			filename = base64.b64decode(key).decode(self.encoding)
+		except (binascii.Error, UnicodeDecodeError) as err:
+			raise ManifestDecoderError("Bad filename {} in manifest: {}".format(key, str(err)))
+		#endtry
+		self.files.add(os.path.join(*filename.split("\\")), entry)
+	#enddef
+
+	def _parse(self, final):
+		buf, pos = self.buffer, 0
+		ws = self.WHITESPACE
+
+		while True:
+			pos = ws(buf, pos).end()
+			if pos >= len(buf): break
+			c = buf[pos]
+			state = self.state
+
+			if state == "fileKey" or state == "fileNext":
+				# Inside files, where nearly all the time is spent.
+				if c == "}":
+					pos += 1
+					self.state = "next"
+				elif state == "fileNext" and c != ",":
+					raise self._expected(", or }", pos)
+				else:
+					if state == "fileNext":
+						pos = ws(buf, pos + 1).end()
+						self.state = "fileKey"
+					#endif
+
+					# Hand the C parser every whole entry in the buffer at once. Cutting after the last
+					# "}," only gives valid JSON if it ends an entry, otherwise parse them one at a time.
+					end = buf.rfind("},", pos) + 1 if self.batch else 0
+					if end > pos:
+						try:
+							entries = json.loads("{" + buf[pos:end] + "}")
+						except ValueError:
+							self.batch = False
+						else:
+							for key, entry in entries.items(): self._addFile(key, entry)
+							pos = end
+							self.state = "fileNext"
+							continue
+						#endtry
+					#endif
+
+					pair = self._pair(buf, pos, final)
+					if pair is None: break
+					key, entry, pos = pair
+					self._addFile(key, entry)
+					self.state = "fileNext"
+				#endif
+			elif state == "start":
+				if c != "{": raise self._expected("{", pos)
+				pos += 1
+				self.state = "key"
+			elif state == "key" or state == "next":
+				if c == "}":
+					pos += 1
+					self.state = "done"
+					continue
+				elif state == "next":
+					if c != ",": raise self._expected(", or }", pos)
+					pos = ws(buf, pos + 1).end()
+					self.state = "key"
+				#endif
+
+				key = self._value(buf, pos, final)
+				if key is None: break
+				if key[0] == "files":
+					# Stream the files object rather than parsing it whole.
+					start = ws(buf, key[1]).end()
+					if start < len(buf):
+						if buf[start] != ":": raise self._expected(":", start)
+						start = ws(buf, start + 1).end()
+					#endif
+					if start >= len(buf):
+						if final: raise self._expected("{", start)
+						break
+					elif buf[start] != "{":
+						raise self._expected("{", start)
+					#endif
+
+					pos = start + 1
+					self.manifest["files"] = self.files
+					self.state = "fileKey"
+					continue
+				#endif
+
+				pair = self._pair(buf, pos, final)
+				if pair is None: break
+				key, value, pos = pair
+				self.manifest[key] = value
+
+				if key == "filepath_encoding":
+					self.encoding = value
+					pending, self.pending = self.pending, []
+					for key, entry in pending: self._addFile(key, entry)
+				#endif
+				self.state = "next"
+			else:
+				raise ManifestDecoderError("Error parsing manifest: extra data at {}".format(pos))
+			#endif
+		#endwhile
+
+		self.buffer = buf[pos:]
+	#enddef
+#endclass
+
+class ManifestFiles(collections.abc.Mapping):
+	""" A manifest's file table, kept as columns instead of a dict per file.
+	    Filenames and part names are interned, so versions loaded side by side share them.
+	    It reads like the {filename: entry} dict it replaces, building entries as they're accessed. """
+
+	FIELDS = ("fsize", "mtime", "objects", "objects_fsize")
+
+	# Compare columns with NumPy, if it's installed.
+	NUMPY = numpy is not None
+
+	def __init__(self, entries=()):
+		self.index = {}
+		self.fsize = array.array("q")
+		self.mtime = array.array("q")
+
+		# Each row's parts are objects[objectsStart[row] : objectsStart[row + 1]], and the same for sizes.
+		self.objects = []
+		self.objectsStart = array.array("q", [0])
+		self.sizes = array.array("q")
+		self.sizesStart = array.array("q", [0])
+
+		# Other keys in an entry, by row, and whole entries that don't fit the columns.
+		self.extra = {}
+		self.odd = {}
+
+		# PathIndex of the filenames, made when first needed.
+		self.paths = None
+
+		for fn, entry in (entries.items() if isinstance(entries, collections.abc.Mapping) else entries):
+			self.add(fn, entry)
+		#endfor
+	#enddef
+
+	def add(self, fn, entry):
+		""" Add a file's entry, replacing any earlier one. """
+		row = len(self.fsize)
+		try:
+			head = array.array("q", (entry["fsize"], entry["mtime"]))
+			objects = [sys.intern(obj) for obj in entry["objects"]]
+			sizes = array.array("q", entry["objects_fsize"])
+		except (KeyError, TypeError, OverflowError):
+			self.odd[row] = entry
+			head, objects, sizes = (0, 0), [], ()
+		#endtry
+
+		self.fsize.append(head[0])
+		self.mtime.append(head[1])
+		self.objects.extend(objects)
+		self.objectsStart.append(len(self.objects))
+		self.sizes.extend(sizes)
+		self.sizesStart.append(len(self.sizes))
+
+		if row not in self.odd and len(entry) > len(self.FIELDS):
+			self.extra[row] = {key: value for key, value in entry.items() if key not in self.FIELDS}
+		#endif
+
+		self.index[sys.intern(fn)] = row
+		self.paths = None
+	#enddef
+
+	def subset(self, names):
+		""" A table of just the given files. It shares this one's columns, which rows are only ever added to. """
+		sub = copy.copy(self)
+		sub.index = {fn: self.index[fn] for fn in names}
+		sub.paths = None
+		return sub
+	#enddef
+
+	def pathIndex(self):
+		if self.paths is None: self.paths = PathIndex(self)
+		return self.paths
+	#enddef
+
+	def entry(self, row):
+		if row in self.odd: return self.odd[row]
+
+		entry = {
+			"fsize": self.fsize[row],
+			"mtime": self.mtime[row],
+			"objects": self.objects[self.objectsStart[row] : self.objectsStart[row + 1]],
+			"objects_fsize": self.sizes[self.sizesStart[row] : self.sizesStart[row + 1]].tolist(),
+		}
+		if row in self.extra: entry.update(self.extra[row])
+		return entry
+	#enddef
+
+	def __getitem__(self, fn): return self.entry(self.index[fn])
+	def __contains__(self, fn): return fn in self.index
+	def __iter__(self): return iter(self.index)
+	def __len__(self): return len(self.index)
+
+	def __repr__(self):
+		return "<ManifestFiles of {} files>".format(len(self))
+	#enddef
+
+	def compare(self, new):
+		""" Join this table with a newer one on filename.
+		    Returns [(fn, "update" or "create")] in the new table's order, and the filenames it no longer has. """
+		names = list(new.index)
+		same = len(names) == len(self.index) and names == list(self.index)
+		if same:
+			# Versions usually list the same files in the same order, so the join is already done.
+			rows = list(self.index.values())
+		else:
+			rows = list(map(self.index.get, names, itertools.repeat(-1)))
+		#endif
+		changed = []
+
+		if self.odd or new.odd:
+			# Some entries aren't in the columns, so compare the entries themselves.
+			for fn, row in zip(names, rows):
+				if row < 0: changed.append((fn, "create"))
+				elif self.entry(row)["mtime"] != new[fn]["mtime"]: changed.append((fn, "update"))
+			#endfor
+		elif self.NUMPY:
+			old = numpy.array(rows, dtype=numpy.int64)
+			found = old >= 0
+			differs = ~found
+			differs[found] = (
+				numpy.frombuffer(self.mtime, numpy.int64)[old[found]] !=
+				numpy.frombuffer(new.mtime, numpy.int64)[numpy.fromiter(new.index.values(), numpy.int64, len(names))[found]]
+			)
+			which = numpy.flatnonzero(differs)
+			changed = [(names[i], "update" if f else "create") for i, f in zip(which.tolist(), found[which].tolist())]
+		else:
+			m1, m2 = self.mtime, new.mtime
+			for fn, r1, r2 in zip(names, rows, new.index.values()):
+				if r1 < 0: changed.append((fn, "create"))
+				elif m1[r1] != m2[r2]: changed.append((fn, "update"))
+			#endfor
+		#endif
+
+		deleted = [] if same else list(itertools.filterfalse(new.index.__contains__, self.index))
+		return changed, deleted
+	#enddef
+#endclass
+
+class PathIndex:
+	""" A file table's filenames in sorted order, so everything under a path is one range found by bisection. """
+
+	def __init__(self, files):
+		entries = sorted((os.path.normcase(fn), i, fn) for i, fn in enumerate(files))
+		self.keys = [key for key, i, fn in entries]
+		self.positions = [i for key, i, fn in entries]
+		self.names = [fn for key, i, fn in entries]
+	#enddef
+
+	def under(self, prefix):
+		""" (normalized filename, position in the table, filename) for every file starting with prefix. """
+		start = bisect.bisect_left(self.keys, prefix)
+		end = bisect.bisect_left(self.keys, prefix + chr(sys.maxunicode), start)
+		return zip(self.keys[start:end], self.positions[start:end], self.names[start:end])
+	#enddef
+#endclass
+
+class PathFilter:
+	""" Selects files by glob. A pattern selects a file if it matches it or any folder it's in. """
+
+	def __init__(self, include=(), exclude=()):
+		self.include = [self._compile(pattern) for pattern in include]
+		self.exclude = [self._compile(pattern) for pattern in exclude]
+	#enddef
+
+	def _compile(self, pattern):
+		""" Normalize a pattern, and return its literal start and a regex for it. """
+		pattern = os.path.normcase(os.path.normpath(os.path.join(*re.split(r"[\\/]+", pattern.strip("\\/")))))
+		prefix = re.split(r"[*?[]", pattern, maxsplit=1)[0]
+
+		# The regex can stop at any separator, so it also matches the files in matching folders.
+		regex = re.sub(r"\\[Zz]$", "", fnmatch.translate(pattern))
+		return prefix, re.compile(regex + r"(?:{}|\Z)".format(re.escape(os.sep)))
+	#enddef
+
+	def select(self, files):
+		""" Return the selected part of a file table, in its original order. """
+		index = files.pathIndex() if isinstance(files, ManifestFiles) else PathIndex(files)
+
+		if self.include:
+			# Only look through the range of files starting with each pattern's literal part.
+			selected = {}
+			for prefix, regex in self.include:
+				selected.update((i, fn) for key, i, fn in index.under(prefix) if regex.match(key))
+			#endfor
+			selected = selected.items()
+		else:
+			selected = ((i, fn) for key, i, fn in index.under(""))
+		#endif
+
+		names = [
+			fn for i, fn in sorted(selected)
+			if not any(regex.match(os.path.normcase(fn)) for prefix, regex in self.exclude)
+		]
+
+		if isinstance(files, ManifestFiles): return files.subset(names)
+		return {fn: files[fn] for fn in names}
+	#enddef
+#endclass
+
+class ManifestStore:
+	""" On-disk store of decoded manifests, keyed by version and hash.
+	    Manifests are kept as JSON of their file table's columns, so a store shared between
+	    hosts can't be made to run anything. """
+
+	# Default limits on how many manifests to keep and their total size in bytes.
+	COUNT = 16
+	LIMIT = 1024 ** 3
+
+	# First line of every stored manifest. Files without it, or from another format version, are ignored.
+	HEADER = b"ManifestStore 1\n"
+
+	def __init__(self, root, count=None, limit=None):
+		self.root = root
+		self.count = count or self.COUNT
+		self.limit = limit or self.LIMIT
+		self.lock = threading.Lock()
+
+		os.makedirs(root, exist_ok=True)
+	#enddef
+
+	def _path(self, version, hash):
+		return os.path.join(self.root, "{}.{}.manifest".format(version, hash))
+	#enddef
+
+	def load(self, version, hash):
+		""" Load a stored manifest, or return None if it's not here. """
+		path = self._path(version, hash)
+		try:
+			with open(path, "rb") as f:
+				if f.readline() != self.HEADER:
+					logging.debug("Ignoring stored manifest for version {} in another format.".format(version))
+					return None
+				#endif
+				manifest = self._decode(json.load(f))
+			#endwith
+		except FileNotFoundError:
+			return None
+		except (OSError, ValueError, KeyError, TypeError, OverflowError) as err:
+			logging.warn("Stored manifest for version {} is unreadable: {}".format(version, str(err)))
+			return None
+		#endtry
+
+		# Mark it as recently used.
+		try: os.utime(path)
+		except OSError: pass
+
+		logging.debug("Loaded manifest for version {} from the store.".format(version))
+		return manifest
+	#enddef
+
+	def save(self, version, hash, manifest):
+		""" Store a decoded manifest and evict old ones if there are too many. """
+		# The hash comes from the server and ends up in a filename.
+		if not hash.isalnum():
+			logging.debug("Not storing manifest with odd hash " + hash)
+			return
+		#endif
+
+		path = self._path(version, hash)
+		tmp = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+		try:
+			data = json.dumps(self._encode(manifest)).encode("utf8")
+			with open(tmp, "wb") as f:
+				f.write(self.HEADER)
+				f.write(data)
+			#endwith
+			os.replace(tmp, path)
+		except OSError as err:
+			logging.warn("Could not store manifest for version {}: {}".format(version, str(err)))
+			try: os.remove(tmp)
+			except OSError: pass
+			return
+		#endtry
+
+		self.trim()
+	#enddef
+
+	def _encode(self, manifest):
+		""" A manifest as plain JSON values, with its file table as columns. """
+		files = manifest["files"]
+		if not isinstance(files, ManifestFiles): files = ManifestFiles(files)
+
+		return {
+			"manifest": {key: value for key, value in manifest.items() if key != "files"},
+			"files": {
+				"names": list(files.index),
+				"rows": list(files.index.values()),
+				"fsize": files.fsize.tolist(),
+				"mtime": files.mtime.tolist(),
+				"objects": files.objects,
+				"objectsStart": files.objectsStart.tolist(),
+				"sizes": files.sizes.tolist(),
+				"sizesStart": files.sizesStart.tolist(),
+				"extra": [[row, entry] for row, entry in files.extra.items()],
+				"odd": [[row, entry] for row, entry in files.odd.items()],
+			},
+		}
+	#enddef
+
+	def _decode(self, data):
+		""" The manifest _encode made data from. Raises ValueError if the columns don't fit together. """
+		columns = data["files"]
+		files = ManifestFiles()
+		files.fsize = array.array("q", columns["fsize"])
+		files.mtime = array.array("q", columns["mtime"])
+		files.objects = [sys.intern(obj) for obj in columns["objects"]]
+		files.objectsStart = array.array("q", columns["objectsStart"])
+		files.sizes = array.array("q", columns["sizes"])
+		files.sizesStart = array.array("q", columns["sizesStart"])
+		files.extra = {row: entry for row, entry in columns["extra"]}
+		files.odd = {row: entry for row, entry in columns["odd"]}
+
+		rows = len(files.fsize)
+		if (len(files.mtime) != rows or len(files.objectsStart) != rows + 1 or len(files.sizesStart) != rows + 1
+				or files.objectsStart[-1] != len(files.objects) or files.sizesStart[-1] != len(files.sizes)
+				or len(columns["names"]) != len(columns["rows"]) or not all(0 <= row < rows for row in columns["rows"])):
+			raise ValueError("its file table doesn't fit together")
+		#endif
+		files.index = {sys.intern(fn): row for fn, row in zip(columns["names"], columns["rows"])}
+
+		manifest = dict(data["manifest"])
+		manifest["files"] = files
+		return manifest
+	#enddef
+
+	def trim(self):
+		""" Evict the least recently used manifests until within the count and size limits. """
+		with self.lock:
+			entries, total = [], 0
+			for entry in os.scandir(self.root):
+				if not entry.name.endswith(".manifest"): continue
+				try: st = entry.stat()
+				except OSError: continue
+				entries.append((st.st_mtime, st.st_size, entry.path))
+				total += st.st_size
+			#endfor
+
+			entries.sort()
+			for mtime, size, path in entries[:-1]:
+				if len(entries) <= self.count and total <= self.limit: break
+				try: os.remove(path)
+				except OSError: pass
+				entries.pop(0)
+				total -= size
+			#endfor
+		#endwith
+	#enddef
+#endclass
+
+class InstallState:
+	""" Journal of what this patcher wrote into an installation, kept next to version.dat. """
+
+	FILENAME = "patchstate.db"
+
+	# Commit after this many recorded files.
+	BATCH = 500
+
+	def __init__(self, base):
+		self.base = base
+		self.lock = threading.Lock()
+		self.pending = 0
+
+		self.db = sqlite3.connect(os.path.join(base, self.FILENAME), check_same_thread=False)
+		self.db.execute("CREATE TABLE IF NOT EXISTS files (name TEXT PRIMARY KEY, version INTEGER, mtime INTEGER, size INTEGER, objects TEXT)")
+		self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+		self.db.execute("CREATE TABLE IF NOT EXISTS parts (name TEXT, idx INTEGER, offset INTEGER, size INTEGER, object TEXT, PRIMARY KEY (name, idx))")
+		self.db.commit()
+	#enddef
+
+	def _versionStamp(self):
+		""" Something that changes whenever anything else rewrites version.dat. """
+		try: st = os.stat(os.path.join(self.base, "version.dat"))
+		except OSError: return ""
+		return "{}:{}".format(st.st_mtime_ns, st.st_size)
+	#enddef
+
+	def trusted(self):
+		""" Whether the journal is still believable, that is version.dat is as we last saw it. """
+		with self.lock:
+			row = self.db.execute("SELECT value FROM meta WHERE key = 'version.dat'").fetchone()
+		#endwith
+		return row is not None and row[0] == self._versionStamp()
+	#enddef
+
+	def seal(self):
+		""" Note the current version.dat and commit everything recorded. """
+		with self.lock:
+			self.db.execute("INSERT OR REPLACE INTO meta VALUES ('version.dat', ?)", (self._versionStamp(),))
+			self.db.commit()
+			self.pending = 0
+		#endwith
+	#enddef
+
+	def matches(self, fn, data):
+		""" Whether the journal says fn is already as described by data. """
+		with self.lock:
+			row = self.db.execute("SELECT mtime, size, objects FROM files WHERE name = ?", (fn,)).fetchone()
+		#endwith
+		return row is not None and row == self.describe(data)
+	#enddef
+
+	@staticmethod
+	def describe(data):
+		""" How the journal describes a file table entry, to compare with what known returns. """
+		return (data["mtime"], data["fsize"], " ".join(data["objects"]))
+	#enddef
+
+	def known(self):
+		""" Everything recorded, as {fn: describe(data)}, in one query rather than one per file. """
+		with self.lock:
+			return {name: (mtime, size, objects) for name, mtime, size, objects in self.db.execute("SELECT name, mtime, size, objects FROM files")}
+		#endwith
+	#enddef
+
+	def record(self, fn, version, data):
+		""" Note that fn now is as described by data, from the given version. """
+		with self.lock:
+			self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+				(fn, version, data["mtime"], data["fsize"], " ".join(data["objects"])))
+			self.db.execute("DELETE FROM parts WHERE name = ?", (fn,))
+			self.pending += 1
+			if self.pending >= self.BATCH:
+				self.db.commit()
+				self.pending = 0
+			#endif
+		#endwith
+	#enddef
+
+	def forget(self, fn, keepParts=False):
+		with self.lock:
+			self.db.execute("DELETE FROM files WHERE name = ?", (fn,))
+			if not keepParts: self.db.execute("DELETE FROM parts WHERE name = ?", (fn,))
+			self.pending += 1
+		#endwith
+	#enddef
+
+	def completedParts(self, fn, data):
+		""" Which parts of fn, as described by data, were already written. """
+		with self.lock:
+			rows = self.db.execute("SELECT idx, offset, size, object FROM parts WHERE name = ?", (fn,)).fetchall()
+		#endwith
+
+		objects, fsize = data["objects"], data["objects_fsize"]
+		offsets = list(itertools.accumulate(fsize, initial=0)) if rows else []
+
+		# Only trust parts that are still the same object in the same place.
+		return {idx for idx, offset, size, obj in rows
+			if idx < len(objects) and objects[idx] == obj and fsize[idx] == size and offsets[idx] == offset}
+	#enddef
+
+	def completePart(self, fn, idx, offset, size, obj):
+		""" Note that a part of fn has been written. """
+		with self.lock:
+			self.db.execute("INSERT OR REPLACE INTO parts VALUES (?, ?, ?, ?, ?)", (fn, idx, offset, size, obj))
+			self.pending += 1
+			if self.pending >= self.BATCH:
+				self.db.commit()
+				self.pending = 0
+			#endif
+		#endwith
+	#enddef
+
+	def clearParts(self, fn):
+		with self.lock:
+			self.db.execute("DELETE FROM parts WHERE name = ?", (fn,))
+			self.pending += 1
+		#endwith
+	#enddef
+
+	def clear(self):
+		""" Forget everything, the installation is going to be rescanned. """
+		with self.lock:
+			self.db.execute("DELETE FROM files")
+			self.db.execute("DELETE FROM meta")
+			self.db.commit()
+		#endwith
+	#enddef
+
+	def close(self):
+		with self.lock:
+			self.db.commit()
+			self.db.close()
+		#endwith
+	#enddef
+
+	def remove(self):
+		""" Close the journal and delete it, it's no longer needed. """
+		self.close()
+		for suffix in ("", "-journal"):
+			try: os.remove(os.path.join(self.base, self.FILENAME + suffix))
+			except FileNotFoundError: pass
+		#endfor
+	#enddef
+#endclass
+
+def verifyFile(path, objects, sizes, algorithm):
+	""" Check each part of a file against its object ID, made with algorithm (PatchServer.OBJECT_HASH), or only that it's all there if algorithm is None.
+	    Runs in a worker process. Returns the indexes of the damaged parts, or None if the file is missing, and its mtime. """
+	try:
+		with open(path, "rb") as f:
+			st = os.fstat(f.fileno())
+			# mmap can't map an empty file.
+			mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if st.st_size else b""
+			try:
+				view = memoryview(mm)
+				bad, offset = [], 0
+				for i, (obj, size) in enumerate(zip(objects, sizes)):
+					if offset + size > st.st_size or (algorithm and hashlib.new(algorithm, view[offset : offset + size]).hexdigest() != obj):
+						bad.append(i)
+					#endif
+					offset += size
+				#endfor
+				view.release()
+			finally:
+				if st.st_size: mm.close()
+			#endtry
+		#endwith
+	except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+		return None, None
+	#endtry
+
+	# Trailing junk doesn't break any parts, but the file still needs to be cut down.
+	if offset != st.st_size and not bad and objects: bad.append(len(objects) - 1)
+
+	return bad, int(st.st_mtime)
+#enddef
+
+class PatchServer:
+	# Ideally one would log in and retrieve this from the Nexon API, but I'm not going to publish that!
+	GAME_ID = "10200"
+	BASE_URL = "https://download2.nexon.net/Game/nxl/games/" + GAME_ID + "/"
+
+	STATUS_URL = "http://www.nexon.net/json/game_status.js"
+	PATCH_INFO_URL = "http://mabipatchinfo.nexon.net/patch/patch.txt"
+
+	HASH_URL = "{gameID}.{version}R.manifest.hash"
+	MANIFEST_URL = "{hash}"
+	PART_URL = "{gameID}/{part:.2}/{part}"
+
+	# How many part requests may be in flight at once.
+	CONNECTIONS = 8
+
+	# How many threads check an installation's files at once. More only add overhead once the disk cache is warm.
+	SCAN_THREADS = 4
+
+	# Object IDs are this hash of the part's contents.
+	OBJECT_HASH = "sha1"
+
+	# How many times to pick a part back up after losing the connection partway.
+	RETRIES = 3
+
+	# Seconds to wait before retrying a part, doubling with each attempt.
+	RETRY_DELAY = 0.5
+
+	# Size of the buffers parts are streamed through.
+	CHUNK_SIZE = 64 * 1024
+
+	# How many threads write decompressed parts to disk. 0 writes on the download threads.
+	WRITERS = 2
+
+	# Seconds between checks for a new patch when watching.
+	WATCH_INTERVAL = 300
+
+	# Peers are on the local network, so give up on them quickly, and leave a failed one alone for a while.
+	PEER_TIMEOUT = 5
+	PEER_BACKOFF = 30
+
+	# Where installed files are moved while their new versions are built from them, inside the installation.
+	OLD_DIR = ".patch-old"
+
+	# Where updates are staged, inside the installation so applying them is only renames.
+	STAGE_DIR = ".patch-stage"
+
+	# Added to a file's name while it's being placed into another installation.
+	NEW_SUFFIX = ".new~"
+
+	# Linux's ioctl to make one file share all of another's data.
+	FICLONE = 0x40049409
+
+	def __init__(self, connections=None, cache=None, manifests=None, journal=True, rescan=False, verifyProcesses=None, mirrors=(),
+			limiter=None, hostLimit=None, order="largest", progress=False, paths=None, writers=None, dropCache=False, delta=False,
+			stage=False, link="reflink", peers=()):
+		# But if you have a library for it already...
+		if NexonAPI:
+			self.BASE_URL = NexonAPI.getBaseURL()
+		#endif
+
+		self.connections = connections or self.CONNECTIONS
+		self.pool = ConnectionPool(hostLimit=hostLimit)
+		self.limiter = limiter
+		self.order = order
+		self.metrics = RunMetrics()
+		self.progress = progress
+		self.writeLock = threading.Lock()
+		self.writers = self.WRITERS if writers is None else writers
+		self.writer = None
+		# Whether to drop finished files from the page cache.
+		self.dropCache = dropCache
+		# Whether to build updated files from the unchanged parts of the installed ones.
+		self.delta = delta
+		# Whether to download into the staging area instead of over the installation.
+		self.stage = stage
+		# How to share a file between installations: "reflink" or "copy", or "hard" to hard link them.
+		self.link = link
+		self.copyRange = hasattr(os, "copy_file_range")
+		self.cache = cache
+		self.manifests = manifests
+
+		# Whether to keep an InstallState in installations, and whether to ignore what it says.
+		self.journal = journal
+		self.rescan = rescan
+		self.state = None
+
+		# None means one per CPU.
+		self.verifyProcesses = verifyProcesses
+		# Whether object IDs were found to really be OBJECT_HASH of the part, once checked.
+		self.objectHashOK = None
+
+		# Base URLs to use alongside BASE_URL.
+		self.extraMirrors = list(mirrors)
+		self.mirrors = None
+
+		# PartServers to ask for parts, in order, before the mirrors.
+		self.peers = [peer.rstrip("/") + "/" for peer in peers]
+		self.peerPool = ConnectionPool(self.PEER_TIMEOUT)
+		self.peersDown = {}
+
+		self.local_version = None
+		self.target_version = None
+
+		self.manifest = None
+		self.manifestVersion = None
+
+		# PathFilter limiting which files to work on, if any.
+		self.paths = paths
+	#enddef
+
+	def _getURL(self, url, fileName=None, serverName=None, headers=None):
+		try:
+			return self.pool.request(url, headers)
+		except HTTPStatusError as err:
+			if fileName is None: fileName = url.split("/")[-1]
+			raise PatchServerError("Error retrieving {}: {}".format(fileName, str(err)))
+		except (http.client.HTTPException, OSError) as err:
+			if serverName is None: serverName = url.split("/", maxsplit=3)[2]
+			raise PatchServerError("Could not connect {}: {}".format(serverName, str(err)))
+		#endtry
+	#enddfe
+
+	def runStats(self):
+		""" Extra gauges about the connections, cache and mirrors, to go with the metrics. """
+		stats = {
+			"http_requests": self.pool.requests,
+			"http_connections_opened": self.pool.opened,
+			"http_connections_reused": self.pool.reused,
+		}
+		if self.cache:
+			stats["cache_hits"] = self.cache.hits
+			stats["cache_misses"] = self.cache.misses
+			stats["cache_hit_bytes"] = self.cache.hitBytes
+		#endif
+		return stats
+	#enddef
+
+	def getMirrors(self):
+		""" The MirrorSet for BASE_URL and any extra mirrors. """
+		if self.mirrors is None or self.mirrors.mirrors[0].url != self.BASE_URL:
+			self.mirrors = MirrorSet([self.BASE_URL] + self.extraMirrors)
+		#endif
+		return self.mirrors
+	#enddef
+
+	def _getFromMirrors(self, name, fileName):
+		""" Fetch a file from the best mirror that has it. """
+		err = None
+		for mirror in self.getMirrors().ranked():
+			try:
+				return self._getURL(mirror.url + name, fileName + " (" + mirror.url + name + ")", mirror.host)
+			except PatchServerError as e:
+				self.mirrors.failed(mirror)
+				err = e
+			#endtry
+		#endfor
+		raise err
+	#enddef
+
+	def getWebLaunchStatus(self):
+		""" Returns true if the web launcher thinks the game is up. """
+		with self._getURL(self.STATUS_URL, "status file") as conn:
+			return self._parseLaunchStatus(conn.read())
+		#endwith
+	#enddef
+
+	def _parseLaunchStatus(self, data):
+		# Have to de-JSONp this.
+		response = json.loads(data[len("nexon.games.playGame(") : -2].decode("utf8"))
+
+		# This is Mabi's ID here
+		status = response["SVG012"]
+		logging.info("Web launch status is: {}.".format("UP" if status else "DOWN"))
+		return status
+	#enddef
+
+	def legacyGetLatestVersion(self):
+		""" Get the latest version as reported by the legacy launcher info. """
+		with self._getURL(self.PATCH_INFO_URL, "patch info file") as conn:
+			return self._parsePatchInfo(conn.read())
+		#endwith
+	#enddef
+
+	def _parsePatchInfo(self, data):
+		# Format is a list of var=val, one per line.
+		txt = data.decode("utf8").split("\n")
+		for line in txt:
+			var, val = line.split("=", maxsplit=1)
+			if var.strip() == "main_version": return int(val.strip())
+		#endfor
+
+		raise PatchServerError("Version not found in patch info.")
+	#enddef
+
+	def getLatestVersion(self):
+		""" Get the latest version as reported by some server. """
+		if NexonAPI is None:
+			ver = self.legacyGetLatestVersion()
+		else:
+			ver = NexonAPI.getLatestVersion()
+		#endif
+
+		logging.info("Read latest version as {}.".format(ver))
+		self.target_version = ver
+		return ver
+	#enddef
+
+	def _getIfChanged(self, url, fileName, seen):
+		""" GET a small text file, asking the server to skip the body if it hasn't changed since it was saved in seen.
+		    Returns the text either way. """
+		saved = seen.get(url, {})
+		headers = {}
+		if "etag" in saved: headers["If-None-Match"] = saved["etag"]
+		if "modified" in saved: headers["If-Modified-Since"] = saved["modified"]
+
+		with self._getURL(url, fileName, headers=headers) as conn:
+			data = conn.read()
+			if conn.status == 304 and "body" in saved:
+				logging.debug("{} is unchanged.".format(fileName))
+				return saved["body"]
+			#endif
+
+			saved = {"body": data.decode("utf8")}
+			if conn.headers.get("ETag"): saved["etag"] = conn.headers["ETag"]
+			if conn.headers.get("Last-Modified"): saved["modified"] = conn.headers["Last-Modified"]
+		#endwith
+
+		seen[url] = saved
+		return saved["body"]
+	#enddef
+
+	def pollLatestVersion(self, seen):
+		""" getLatestVersion, with conditional requests that cost next to nothing while it's unchanged. """
+		if NexonAPI is not None: return self.getLatestVersion()
+		return self._parsePatchInfo(self._getIfChanged(self.PATCH_INFO_URL, "patch info file", seen).encode("utf8"))
+	#enddef
+
+	def pollManifestHash(self, version, seen):
+		""" The manifest hash of version, with conditional requests. Raises PatchServerError if no mirror has it. """
+		name = self.HASH_URL.format(gameID = self.GAME_ID, version = version)
+		err = None
+		for mirror in self.getMirrors().ranked():
+			try:
+				return self._getIfChanged(mirror.url + name, "hash file", seen).strip()
+			except PatchServerError as e:
+				err = e
+			#endtry
+		#endfor
+		raise err
+	#enddef
+
+	def getLocalVersion(self, path):
+		""" Get the verion of the Mabinogi installed at the given path. """
+		try:
+			with open(os.path.join(path, "version.dat"), "rb") as f:
+				ver = struct.unpack("<I", f.read())[0]
+
+				self.local_version = ver
+				logging.info("Read local version as {}.".format(ver))
+				return ver
+			#endwith
+		except FileNotFoundError:
+			raise PatchServerError("Unable to find version.dat at " + path)
+		#endif
+	#enddef
+
+	def getManifest(self, version=None):
+		""" Get the manifest file from the server and decode it. """
+		version = version or self.target_version
+
+		if version == self.manifestVersion:
+			logging.debug("Reusing manifest from cache.")
+			return self.manifest
+		#endif
+
+		properties = {
+			"gameID": self.GAME_ID,
+			"version": version
+		}
+
+		# First download the hash
+		with self._getFromMirrors(self.HASH_URL.format(**properties), "hash file") as conn:
+			properties["hash"] = conn.read().strip().decode("utf8")
+		#endwith
+
+		logging.debug("Hash downloaded.")
+
+		manifest = self._manifestFor(properties)
+
+		self.manifest = manifest
+		self.manifestVersion = version
+
+		return manifest
+	#enddef
+
+	def _manifestFor(self, properties):
+		""" The manifest with the given version and hash, from the store if it's there. """
+		manifest = self.manifests and self.manifests.load(properties["version"], properties["hash"])
+		if manifest is None:
+			manifest = self._downloadManifest(properties)
+			if self.manifests: self.manifests.save(properties["version"], properties["hash"], manifest)
+		#endif
+		return manifest
+	#enddef
+
+	def _downloadManifest(self, properties):
+		""" Download and decode the manifest with the given hash. """
+		with self._getFromMirrors(self.MANIFEST_URL.format(**properties), "manifest file") as conn:
+			manifest = self.decodeManifest(conn, network=True)
+		#endwith
+
+		logging.debug("Manifest decoded.")
+
+		return manifest
+	#enddef
+
+	def decodeManifest(self, src, network=False):
+		""" Decode a manifest from a stream of its compressed data, as it arrives. """
+		decoder = ManifestDecoder()
+		self._streamPart(src, decoder, network)
+		return decoder.finish()
+	#enddef
+
+	def legacyDecodeManifest(self, src):
+		""" Decode a manifest by reading, decompressing and parsing it all at once. """
+		manifest = src.read()
+		manifest = zlib.decompress(manifest)
+
+		logging.debug("Manifest decompressed.")
+
+		manifest = json.loads(manifest.decode("utf8"))
+
+		# Decode filenames.
+		files = manifest["files"]
+		keys = list(files.keys())
+		encoding = manifest["filepath_encoding"]
+		for key in keys:
+			# Decode the filename.
+			filename = os.path.join(*base64.b64decode(key).decode(encoding).split("\\"))
+			files[filename] = files[key]
+			del files[key]
+		#endfor
+
+		return manifest
+	#enddef
+
+	def selectFiles(self, manifest):
+		""" The manifest with only the files selected by the path filter. """
+		if not self.paths: return manifest
+
+		selected = dict(manifest)
+		selected["files"] = self.paths.select(manifest["files"])
+		logging.info("Selected {} of {} files.".format(len(selected["files"]), len(manifest["files"])))
+
+		return selected
+	#enddef
+
+	def dumpManifest(self, filename, manifest=None):
+		""" Dump the given or last retrieved manifest to a file. """
+		manifest = manifest or self.manifest
+
+		with open(filename, "w") as f:
+			json.dump(manifest, f, indent=4, sort_keys=True, default=dict)
+		#endwith
+	#enddef
+
+	def diffManifests(self, m1, m2):
+		""" Diff two manifests' files and return whether to create, update, or delete each changed file. """
+		f1, f2 = m1["files"], m2["files"]
+		if isinstance(f1, ManifestFiles) and isinstance(f2, ManifestFiles):
+			return self._diffTables(f1, f2)
+		#endif
+
+		changes, statuses = {}, {}
+		updated, created, deleted = 0, 0, 0
+
+		for fn, d2 in f2.items():
+			if fn in f1:
+				# Both versions have this file, compare mtime.
+				d1 = f1[fn]
+				if d1["mtime"] != d2["mtime"]:
+					changes[fn] = d2
+					statuses[fn] = "update"
+					updated += 1
+				#endif
+			else:
+				# This is a new file.
+				changes[fn] = d2
+				statuses[fn] = "create"
+				created += 1
+			#endif
+		#endfor
+
+		for fn in f1.keys():
+			if fn not in f2:
+				# This file was deleted.
+				statuses[fn] = "delete"
+				deleted += 1
+			#endif
+		#endfor
+
+		logging.info("Files/dirs affected between the specified manifests: {} to update, {} to create, {} to delete".format(updated, created, deleted))
+
+		return changes, statuses
+	#enddef
+
+	def _diffTables(self, f1, f2):
+		""" diffManifests for two column tables, joining them all at once. """
+		changed, deleted = f1.compare(f2)
+		changes = f2.subset(fn for fn, status in changed)
+		statuses = dict(changed)
+		statuses.update((fn, "delete") for fn in deleted)
+
+		created = sum(status == "create" for fn, status in changed)
+		logging.info("Files/dirs affected between the specified manifests: {} to update, {} to create, {} to delete".format(
+			len(changed) - created, created, len(deleted)))
+
+		return changes, statuses
+	#enddef
+
+	def deltaParts(self, path, old, changes, statuses):
+		""" For each file to update whose installed copy is still the old version, map the indexes of
+		    the new parts it already has to their offsets in it. """
+		self._restoreAside(path, self.state if self.state and self.state.base == path else None)
+		reuse = {}
+		reused, total = 0, 0
+		isDir = lambda data: bool(len(data["objects"]) and data["objects"][0] == "__DIR__")
+
+		for fn, status in statuses.items():
+			if status != "update" or fn not in old or fn not in changes: continue
+			d1, d2 = old[fn], changes[fn]
+			if isDir(d1) or isDir(d2): continue
+
+			# Only trust the file on disk if it looks like the old manifest's.
+			try:
+				st = os.stat(os.path.join(path, fn))
+			except OSError:
+				continue
+			#endtry
+			if int(st.st_mtime) != d1["mtime"] or st.st_size != d1["fsize"]: continue
+
+			offsets, offset = {}, 0
+			for obj, size in zip(d1["objects"], d1["objects_fsize"]):
+				offsets.setdefault(obj, (offset, size))
+				offset += size
+			#endfor
+
+			parts = {}
+			for i, (obj, size) in enumerate(zip(d2["objects"], d2["objects_fsize"])):
+				if obj in offsets and offsets[obj][1] == size:
+					parts[i] = offsets[obj][0]
+					reused += size
+				#endif
+			#endfor
+
+			total += sum(d2["objects_fsize"])
+			if parts: reuse[fn] = parts
+		#endfor
+
+		logging.info("{:.1f} of {:.1f} MiB of updated files can be copied from the installed versions.".format(
+			reused / 1024 ** 2, total / 1024 ** 2))
+
+		return reuse
+	#enddef
+
+	def _installedFiles(self, path, version):
+		""" The manifest files of the version installed at path, for delta updates to version. None if there's nothing to reuse. """
+		if not self.delta: return None
+
+		try: local = self.local_version or self.getLocalVersion(path)
+		except PatchServerError: return None
+
+		if local == version: return None
+		return self.selectFiles(self.getManifest(local))["files"]
+	#enddef
+
+	def _scanDirectory(self, base, dirname, entries):
+		""" Stat the given entries of one directory. Returns a list of (fn, stat result or None). """
+		path = os.path.join(base, dirname)
+		fd, found = None, None
+		try:
+			if os.stat in os.supports_dir_fd:
+				# Stat relative to the open directory, so its path isn't looked up again for every file.
+				fd = os.open(path, os.O_RDONLY | getattr(os, "O_DIRECTORY", 0))
+			else:
+				# On Windows the listing comes with the stats.
+				with os.scandir(path) as it:
+					found = {os.path.normcase(entry.name): entry for entry in it}
+				#endwith
+			#endif
+		except (FileNotFoundError, NotADirectoryError):
+			return [(fn, None) for name, fn in entries]
+		except OSError:
+			# Can't open or list it, but maybe the files can still be stat'd.
+			pass
+		#endtry
+
+		results = []
+		try:
+			for name, fn in entries:
+				try:
+					if fd is not None:
+						st = os.stat(name, dir_fd=fd)
+					elif found is not None:
+						entry = found.get(os.path.normcase(name))
+						st = entry and entry.stat()
+					else:
+						st = os.stat(os.path.join(base, fn))
+					#endif
+				except (FileNotFoundError, NotADirectoryError):
+					st = None
+				#endtry
+				results.append((fn, st))
+			#endfor
+		finally:
+			if fd is not None: os.close(fd)
+		#endtry
+
+		return results
+	#enddef
+
+	def _scanDirectories(self, base, dirs):
+		""" _scanDirectory for each of a list of (dirname, entries). """
+		results = []
+		for dirname, entries in dirs: results.extend(self._scanDirectory(base, dirname, entries))
+		return results
+	#enddef
+
+	def scanFileSystem(self, base, files):
+		""" Stat every file in the file table, directory by directory, spread over a few threads. Returns {fn: stat result or None}. """
+		dirs = {}
+		for fn in files.keys():
+			# Filenames are joined with os.sep, and this is far quicker than os.path.split.
+			dirname, sep, name = fn.rpartition(os.sep)
+			dirs.setdefault(dirname, []).append((name, fn))
+		#endfor
+		if not dirs: return {}
+
+		# Each thread takes a run of directories. A task per directory costs more than the stats save.
+		dirs = list(dirs.items())
+		step = -(-len(dirs) // min(self.SCAN_THREADS, len(dirs)))
+		runs = [dirs[i : i + step] for i in range(0, len(dirs), step)]
+
+		stats = {}
+		with ThreadPoolExecutor(max_workers=len(runs)) as pool:
+			for results in pool.map(lambda run: self._scanDirectories(base, run), runs):
+				stats.update(results)
+			#endfor
+		#endwith
+
+		return stats
+	#enddef
+
+	def diffManifestWithFileSystem(self, base, manifest=None):
+		""" Check the manifest against the path for updating. """
+		manifest = manifest or self.manifest
+		files = manifest["files"]
+		changes, statuses = {}, {}
+		updated, created = 0, 0
+
+		stats = self.scanFileSystem(base, files)
+
+		for fn, data in files.items():
+			st = stats[fn]
+			if st is None:
+				changes[fn] = data
+				statuses[fn] = "create"
+				created += 1
+			elif int(st.st_mtime) != data["mtime"] or st.st_size != data["fsize"]:
+				changes[fn] = data
+				statuses[fn] = "update"
+				updated += 1
+			#endif
+		#endfor
+
+		logging.info("Files/dirs affected in update: {} to update, {} to create".format(updated, created))
+
+		return changes, statuses
+	#enddef
+
+	def openState(self, base):
+		""" Open the journal of the installation at base, if journaling. """
+		if not self.journal: return None
+
+		if self.state is None or self.state.base != base:
+			if self.state: self.state.close()
+			self.state = InstallState(base)
+		#endif
+
+		return self.state
+	#enddef
+
+	def dropState(self, base):
+		""" Delete the journal at base, once a download folder is complete and it has nothing left to resume. """
+		if self.state and self.state.base == base:
+			self.state.remove()
+			self.state = None
+		#endif
+	#enddef
+
+	def diffInstallation(self, base, manifest=None, version=None, state=None):
+		""" Check the manifest against the path for updating, only looking at files the journal can't vouch for.
+		    state is the installation's journal, if it's already open. """
+		manifest = manifest or self.manifest
+		version = version or self.manifestVersion
+		files = manifest["files"]
+		state = state or self.openState(base)
+		self._restoreAside(base, state)
+
+		if state is None:
+			return self.diffManifestWithFileSystem(base, manifest)
+		elif self.rescan or not state.trusted():
+			logging.info("Checking every file in the installation.")
+			state.clear()
+			suspect = files
+		else:
+			known = state.known()
+			suspect = {fn: data for fn, data in files.items() if known.get(fn) != state.describe(data)}
+			logging.info("Checking {} of {} files in the installation.".format(len(suspect), len(files)))
+		#endif
+
+		changes, statuses = self.diffManifestWithFileSystem(base, {"files": suspect})
+
+		# Whatever turned out to be fine can be trusted next time.
+		for fn, data in suspect.items():
+			if fn not in changes: state.record(fn, version, data)
+		#endfor
+		state.seal()
+
+		return changes, statuses
+	#enddef
+
+	def legacyDiffManifestWithFileSystem(self, base, manifest=None):
+		""" Check the manifest against the path for updating, one stat at a time. """
+		manifest = manifest or self.manifest
+		files = manifest["files"]
+		changes, statuses = {}, {}
+		updated, created = 0, 0
+
+		for fn, data in files.items():
+			path = os.path.join(base, fn)
+			try:
+				fsize = os.path.getsize(path)
+				mtime = int(os.path.getmtime(path))
+				if mtime != data["mtime"] or fsize != data["fsize"]:
+					changes[fn] = data
+					statuses[fn] = "update"
+					updated += 1
+				#endif
+
+			except (FileNotFoundError, NotADirectoryError):
+				changes[fn] = data
+				statuses[fn] = "create"
+				created += 1
+			#endtry
+		#endfor
+
+		logging.info("Files/dirs affected in update: {} to update, {} to create".format(updated, created))
+
+		return changes, statuses
+	#enddef
+
+	def _writeAt(self, f, data, offset):
+		""" Write data at the given offset without disturbing other writers. """
+		began = time.perf_counter()
+		size = len(data)
+		if hasattr(os, "pwrite"):
+			fd = f.fileno()
+			data = memoryview(data)
+			while data:
+				n = os.pwrite(fd, data, offset)
+				data, offset = data[n:], offset + n
+			#endwhile
+		else:
+			with self.writeLock:
+				f.seek(offset)
+				f.write(data)
+			#endwith
+		#endif
+		self.metrics.observe("write", time.perf_counter() - began)
+		self.metrics.add("written_bytes", size)
+	#enddef
+
+	def _preallocate(self, f, size):
+		""" Reserve a file's full size up front, so its parts can land in any order without fragmenting it. """
+		if size <= 0: return
+		if hasattr(os, "posix_fallocate"):
+			try:
+				os.posix_fallocate(f.fileno(), 0, size)
+				return
+			except OSError:
+				# Not every file system supports it.
+				pass
+			#endtry
+		#endif
+		f.truncate(size)
+	#enddef
+
+	def _dropCache(self, f):
+		""" Flush a finished file and drop it from the page cache, so patching doesn't push out other programs' data. """
+		if not hasattr(os, "posix_fadvise"): return
+		try:
+			fd = f.fileno()
+			os.fdatasync(fd)
+			os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+		except OSError as err:
+			logging.debug("Couldn't drop {} from the page cache: {}".format(f.name, str(err)))
+		#endtry
+	#enddef
+
+	def _streamPart(self, src, decoder, network=False):
+		""" Feed everything left in src to the decoder, in chunks through one buffer. """
+		buf = bytearray(self.CHUNK_SIZE)
+		view = memoryview(buf)
+		while True:
+			n = src.readinto(buf)
+			if not n: break
+			if network:
+				if self.limiter: self.limiter.consume(n)
+				self.metrics.add("downloaded_bytes", n)
+			#endif
+			decoder.feed(view[:n])
+		#endwhile
+	#enddef
+
+	def _readCachedPart(self, name, obj, f, offset):
+		""" Write a part into f at offset from the cache. Returns the compressed and decompressed sizes, or None if it's not there. """
+		src = self.cache.open(name)
+		if src is None: return None
+
+		decoder = PartDecoder(self, obj, f, offset)
+		try:
+			with src: self._streamPart(src, decoder)
+			sizes = decoder.finish()
+		except (PatchServerError, OSError) as err:
+			decoder.settle()
+			logging.warn("  Cached part {} is bad, downloading it again: {}".format(obj, str(err)))
+			self.cache.discard(name)
+			return None
+		except:
+			# Nothing may still be writing into the file once this part is given up on.
+			decoder.settle()
+			raise
+		#endtry
+
+		logging.info("  Read part {} from cache".format(obj))
+		return sizes
+	#enddef
+
+	def _fetchFromPeers(self, obj, name, decoder, size):
+		""" Try each peer in turn for a part, checking it against its object ID and keeping it to its size.
+		    Returns the compressed and decompressed sizes, or None if no peer had it intact. """
+		decoder.verify, decoder.limit = True, size
+		for peer in self.peers:
+			if self.peersDown.get(peer, 0) > time.monotonic(): continue
+
+			decoder.restart()
+			try:
+				with self.peerPool.request(peer + name) as conn:
+					self._streamPart(conn, decoder)
+				#endwith
+				sizes = decoder.finish()
+			except HTTPStatusError:
+				# It just doesn't have this one.
+				continue
+			except PartWriteError:
+				# Not the peer's fault, and no other source would fare better.
+				raise
+			except PartDecoderError as err:
+				logging.warn("  Bad part from peer {}, skipping it for a while: {}".format(peer, str(err)))
+				self.peersDown[peer] = time.monotonic() + self.PEER_BACKOFF
+				continue
+			except (http.client.HTTPException, OSError) as err:
+				logging.warn("  Peer {} failed, skipping it for a while: {}".format(peer, str(err)))
+				self.peersDown[peer] = time.monotonic() + self.PEER_BACKOFF
+				continue
+			#endtry
+
+			self.metrics.add("peer_bytes", decoder.clen)
+			logging.info("  Got part {} from peer {}".format(obj, peer))
+			return sizes
+		#endfor
+
+		decoder.verify, decoder.limit = False, None
+		decoder.restart()
+		return None
+	#enddef
+
+	def _fetchFromMirrors(self, obj, name, decoder):
+		""" Download a part into the decoder from the mirrors, picking up where it left off if a connection drops. """
+		mirrors = self.getMirrors()
+		tried = set()
+		for attempt in range(self.RETRIES + 1):
+			mirror = mirrors.pick(tried)
+
+			# If the connection dropped partway, only ask for the rest. Mirrors all have the same bytes.
+			start = decoder.clen
+			began = time.perf_counter()
+			try:
+				with self._getURL(mirror.url + name, obj, mirror.host, {"Range": "bytes={}-".format(start)} if start else None) as conn:
+					mirrors.responded(mirror, time.perf_counter() - began)
+					self.metrics.observe("request", time.perf_counter() - began)
+					if start and conn.status != 206:
+						# The server sent the whole thing instead.
+						decoder.restart()
+					elif start and not conn.headers.get("Content-Range", "").startswith("bytes {}-".format(start)):
+						decoder.restart()
+						raise http.client.HTTPException("resumed at the wrong place")
+					#endif
+
+					start = decoder.clen
+					self._streamPart(conn, decoder, True)
+				#endwith
+				if not decoder.decompressor.eof: raise PartDecoderError("Part {} ended early.".format(obj))
+			except (PatchServerError, http.client.HTTPException, OSError) as err:
+				# Failing to write isn't the mirror's fault, and another mirror wouldn't help.
+				if isinstance(err, PartWriteError): raise
+				if isinstance(err, PartDecoderError):
+					# The mirror sent bad data, so none of it can be kept.
+					decoder.restart()
+				#endif
+				mirrors.failed(mirror)
+				tried.add(mirror)
+
+				if attempt == self.RETRIES:
+					raise PatchServerError("Error downloading {}: {}".format(obj, str(err)))
+				#endif
+
+				logging.warn("  Part {} failed on {} after {} bytes, retrying: {}".format(obj, mirror.host, decoder.clen, str(err)))
+				time.sleep(self.RETRY_DELAY * 2 ** attempt)
+				continue
+			#endtry
+
+			mirrors.succeeded(mirror, decoder.clen - start, time.perf_counter() - began)
+			break
+		#endfor
+	#enddef
+
+	def _fetchPart(self, obj, f, offset, size=None):
+		""" Write a single part into f at offset, from the cache if possible. Returns the compressed and decompressed sizes.
+		    Peers are only asked if the part's size is given, so a bad one can't write past it, and once objectHashWorks
+		    has found that parts can be checked against their IDs. """
+		name = self.PART_URL.format(gameID = self.GAME_ID, part = obj)
+
+		if self.cache:
+			sizes = self._readCachedPart(name, obj, f, offset)
+			if sizes: return sizes
+		#endif
+
+		tee = self.cache.store(name) if self.cache else None
+		decoder = PartDecoder(self, obj, f, offset, tee)
+		try:
+			sizes = self._fetchFromPeers(obj, name, decoder, size) if self.peers and size is not None and self.objectHashOK else None
+			if sizes is None:
+				self._fetchFromMirrors(obj, name, decoder)
+				sizes = decoder.finish()
+			#endif
+		except:
+			# Nothing may still be writing into the file once this part is given up on.
+			decoder.settle()
+			if tee: tee.abort()
+			raise
+		#endtry
+		if tee: tee.commit()
+
+		logging.info("  Downloaded part " + obj)
+
+		return sizes
+	#enddef
+
+	def _copyPart(self, obj, source, f, offset):
+		""" Write a part that's also being written elsewhere by copying it from there once it's done. """
+		future, spath, soffset = source
+		try:
+			clen, dlen = future.result()
+		except (PatchServerError, CancelledError):
+			raise PatchServerError("Part {} failed elsewhere.".format(obj))
+		#endtry
+
+		buf = bytearray(self.CHUNK_SIZE)
+		view = memoryview(buf)
+		left = dlen
+		try:
+			with open(spath, "rb") as src:
+				src.seek(soffset)
+				while left:
+					n = src.readinto(view[:min(left, self.CHUNK_SIZE)])
+					if not n: raise PatchServerError("Part {} was cut short elsewhere.".format(obj))
+					self._writeAt(f, view[:n], offset + dlen - left)
+					left -= n
+				#endwhile
+			#endwith
+		except OSError as err:
+			raise PatchServerError("Error copying {}: {}".format(obj, str(err)))
+		#endtry
+
+		logging.info("  Copied part " + obj)
+
+		return clen, dlen
+	#enddef
+
+	def _copyRange(self, src, f, soffset, offset, size):
+		""" Copy size bytes from one file to another. The kernel does it, sharing the extents where the file system can, unless it's unsupported. """
+		left = size
+		if self.copyRange:
+			began = time.perf_counter()
+			try:
+				while left:
+					n = os.copy_file_range(src.fileno(), f.fileno(), left, soffset + size - left, offset + size - left)
+					if not n: break
+					left -= n
+				#endwhile
+			except OSError as err:
+				# Some file systems and kernels can't, so stop asking.
+				logging.debug("Copying through memory instead: " + str(err))
+				self.copyRange = False
+			#endtry
+			self.metrics.observe("write", time.perf_counter() - began)
+			self.metrics.add("written_bytes", size - left)
+		#endif
+
+		buf = bytearray(self.CHUNK_SIZE)
+		view = memoryview(buf)
+		src.seek(soffset + size - left)
+		while left:
+			n = src.readinto(view[:min(left, self.CHUNK_SIZE)])
+			if not n: raise EOFError("{} bytes short".format(left))
+			self._writeAt(f, view[:n], offset + size - left)
+			left -= n
+		#endwhile
+	#enddef
+
+	def _copyOld(self, obj, source, f, offset, size):
+		""" Copy a part from the old version of the file. Raises OSError or EOFError if it can't. """
+		spath, soffset = source
+		with open(spath, "rb") as src:
+			self._copyRange(src, f, soffset, offset, size)
+		#endwith
+
+		self.metrics.add("reused_bytes", size)
+		logging.info("  Reused part " + obj)
+	#enddef
+
+	def _clone(self, src, f):
+		""" Make f share all of src's data, on file systems that can. Returns whether it did. """
+		if fcntl is None or not sys.platform.startswith("linux"): return False
+		try:
+			fcntl.ioctl(f.fileno(), self.FICLONE, src.fileno())
+		except OSError as err:
+			logging.debug("Can't reflink {}: {}".format(src.name, str(err)))
+			return False
+		#endtry
+		return True
+	#enddef
+
+	def _placeFile(self, src, dst, data):
+		""" Put a copy of a finished file at dst, sharing its data with src where that's safe.
+		    Returns how: "linked", "cloned" or "copied". """
+		tmp = dst + self.NEW_SUFFIX
+		try: os.remove(tmp)
+		except FileNotFoundError: pass
+
+		how = None
+		if self.link == "hard":
+			try:
+				os.link(src, tmp)
+				how = "linked"
+			except OSError as err:
+				logging.debug("Can't hard link {}: {}".format(src, str(err)))
+			#endtry
+		#endif
+
+		if how is None:
+			try:
+				with open(src, "rb") as fsrc, open(tmp, "wb", buffering=0) as f:
+					if self.link != "copy" and self._clone(fsrc, f):
+						how = "cloned"
+					else:
+						self._copyRange(fsrc, f, 0, 0, data["fsize"])
+						how = "copied"
+					#endif
+				#endwith
+				os.utime(tmp, times=(data["mtime"], data["mtime"]))
+			except:
+				try: os.remove(tmp)
+				except OSError: pass
+				raise
+			#endtry
+		#endif
+
+		# Replacing rather than writing over means no other link to the old file is touched.
+		os.replace(tmp, dst)
+		return how
+	#enddef
+
+	def _reusePart(self, obj, source, f, offset, size):
+		""" Write a part by copying it from the old version of the file, or download it if that fails. """
+		try:
+			self._copyOld(obj, source, f, offset, size)
+		except (OSError, EOFError) as err:
+			logging.warn("  Couldn't reuse part {}, downloading it: {}".format(obj, str(err)))
+			return self._fetchPart(obj, f, offset, size)
+		#endtry
+		return size, size
+	#enddef
+
+	def _setAside(self, path, fn):
+		""" Move an installed file out of the way so its new version can be built from it. Returns its new path, or None. """
+		fpath, old = os.path.join(path, fn), os.path.join(path, self.OLD_DIR, fn)
+		try:
+			os.makedirs(os.path.dirname(old), exist_ok=True)
+			os.replace(fpath, old)
+		except OSError as err:
+			logging.warn("Couldn't set aside {} to reuse its parts: {}".format(fpath, str(err)))
+			return None
+		#endtry
+		return old
+	#enddef
+
+	def _removeAside(self, path, fn):
+		try: os.remove(os.path.join(path, self.OLD_DIR, fn))
+		except OSError: pass
+	#enddef
+
+	def _removeAsideDirs(self, path):
+		""" Remove the folders left empty once every set aside file is done with. """
+		for root, dirs, names in os.walk(os.path.join(path, self.OLD_DIR), topdown=False):
+			try: os.rmdir(root)
+			except OSError: pass
+		#endfor
+	#enddef
+
+	def _restoreAside(self, path, state=None):
+		""" Put back the installed files an interrupted delta update set aside, over the new versions it didn't finish. """
+		aside = os.path.join(path, self.OLD_DIR)
+		if not os.path.isdir(aside): return
+
+		for root, dirs, names in os.walk(aside, topdown=False):
+			for name in names:
+				old = os.path.join(root, name)
+				fn = os.path.relpath(old, aside)
+				try:
+					os.replace(old, os.path.join(path, fn))
+				except OSError as err:
+					logging.warn("Couldn't put back {}, set aside by an interrupted update: {}".format(fn, str(err)))
+					continue
+				#endtry
+
+				logging.info("Put back {}, set aside by an interrupted update.".format(fn))
+				# Whatever the journal says about the new version no longer applies.
+				if state: state.forget(fn)
+			#endfor
+
+			try: os.rmdir(root)
+			except OSError: pass
+		#endfor
+	#enddef
+
+	def indexObjects(self, files):
+		""" Map each object that appears more than once in the files to where it's used. """
+		index = {}
+		for fn, data in files.items():
+			if len(data["objects"]) and data["objects"][0] == "__DIR__": continue
+			for i, obj in enumerate(data["objects"]):
+				index.setdefault(obj, []).append((fn, i))
+			#endfor
+		#endfor
+
+		index = {obj: uses for obj, uses in index.items() if len(uses) > 1}
+
+		saved = sum(files[fn]["objects_fsize"][i] for uses in index.values() for fn, i in uses[1:])
+		logging.info("{} objects are used more than once, saving {:.1f} MiB of downloads.".format(len(index), saved / 1024 ** 2))
+
+		return index
+	#enddef
+
+	def _runPart(self, fun, *args):
+		""" Run a part job, timing and counting it. Jobs settle their decoder's writes before returning or raising,
+		    so once a part's future is done nothing it queued on the FileWriter is left. """
+		began = time.perf_counter()
+		try:
+			result = fun(*args)
+		except:
+			self.metrics.add("parts_failed")
+			raise
+		#endtry
+		self.metrics.observe("part", time.perf_counter() - began)
+		self.metrics.add("parts_done")
+		return result
+	#enddef
+
+	def orderFiles(self, files):
+		""" The order to download files in: directories first, then by size as set by self.order. """
+		items = list(files.items())
+		if self.order == "manifest": return items
+
+		isDir = lambda data: bool(len(data["objects"]) and data["objects"][0] == "__DIR__")
+		sign = -1 if self.order == "largest" else 1
+		# Starting with the biggest means no huge pack is left trickling in alone at the end.
+		return sorted(items, key=lambda item: (not isDir(item[1]), sign * sum(item[1]["objects_fsize"])))
+	#enddef
+
+	def _recordPart(self, state, fn, i, obj, offset, size, future):
+		""" Journal a part once it's been written, so an interrupted download can skip it. """
+		if future.cancelled() or future.exception() is not None: return
+		if future.result()[1] == size: state.completePart(fn, i, offset, size, obj)
+	#enddef
+
+	def _openForParts(self, state, fn, fpath, data, skip):
+		""" Open a file to write parts into, keeping what's there if the journal (or skip) says some of it is done. Returns the file and the done parts. """
+		if fn in skip:
+			done = skip[fn]
+		else:
+			done = state.completedParts(fn, data) if state else set()
+		#endif
+
+		if done:
+			try:
+				f = open(fpath, "r+b", buffering=0)
+			except FileNotFoundError:
+				done = set()
+			else:
+				f.truncate(sum(data["objects_fsize"]))
+				logging.info("Resuming file {} with {} of {} parts done".format(fn, len(done), len(data["objects"])))
+				return f, done
+			#endtry
+		#endif
+
+		if state: state.clearParts(fn)
+
+		# Writing through a hard link would change the other installations too.
+		try:
+			if os.stat(fpath).st_nlink > 1: os.remove(fpath)
+		except OSError:
+			pass
+		#endtry
+
+		f = open(fpath, "wb", buffering=0)
+		try:
+			self._preallocate(f, sum(data["objects_fsize"]))
+		except OSError:
+			f.close()
+			raise
+		#endtry
+		return f, done
+	#enddef
+
+	def _planParts(self, path, files, pool, jobs, slots, stop, state, skip, reuse, installed):
+		""" Queue the parts of every file, in order, without exceeding the in-flight limit. """
+		parts = None
+		try:
+			# Objects used more than once are only fetched the first time, then copied from there.
+			shared = self.indexObjects(files)
+			sources = {}
+
+			for fn, data in self.orderFiles(files):
+				parts = queue.Queue()
+
+				if len(data["objects"]) and data["objects"][0] == "__DIR__":
+					jobs.put((fn, data, None, parts))
+				else:
+					fpath = os.path.join(path, fn)
+					if fn not in reuse: old = None
+					elif installed: old = os.path.join(installed, fn)
+					else: old = self._setAside(path, fn)
+					kept = reuse[fn] if old else {}
+					try:
+						f, done = self._openForParts(state, fn, fpath, data, skip)
+					except OSError as err:
+						jobs.put((fn, data, err, parts))
+					else:
+						jobs.put((fn, data, f, parts))
+
+						# Each part goes right after the expected sizes of the ones before it.
+						offset = 0
+						for i, (obj, size) in enumerate(zip(data["objects"], data["objects_fsize"])):
+							slots.acquire()
+							if stop.is_set(): return
+
+							if i in done:
+								future = Future()
+								future.set_result((size, size))
+								self.metrics.plan(-size)
+								if obj in shared: sources.setdefault(obj, (future, fpath, offset))
+							elif i in kept:
+								future = pool.submit(self._runPart, self._reusePart, obj, (old, kept[i]), f, offset, size)
+								if obj in shared: sources.setdefault(obj, (future, fpath, offset))
+							elif obj in sources:
+								future = pool.submit(self._runPart, self._copyPart, obj, sources[obj], f, offset)
+							else:
+								future = pool.submit(self._runPart, self._fetchPart, obj, f, offset, size)
+								if obj in shared: sources[obj] = (future, fpath, offset)
+							#endif
+
+							if state and i not in done:
+								future.add_done_callback(functools.partial(self._recordPart, state, fn, i, obj, offset, size))
+							#endif
+
+							parts.put(future)
+							offset += size
+						#endfor
+					#endtry
+				#endif
+
+				parts.put(None)
+				parts = None
+			#endfor
+		finally:
+			# Always terminate the queues so the writer can't hang.
+			if parts is not None: parts.put(None)
+			jobs.put(None)
+		#endtry
+	#enddef
+
+	def _drainParts(self, parts, slots):
+		""" Cancel whatever is left of a file's parts, wait for the ones already running and release their slots.
+		    A part's job only finishes once all its writes have, so nothing writes into the file after this. """
+		running = []
+		for future in iter(parts.get, None):
+			if not future.cancel(): running.append(future)
+			slots.release()
+		#endfor
+		wait(running)
+	#enddef
+
+	def _waitParts(self, data, parts, slots):
+		""" Wait for each part of a file to finish and check its size. Whether it succeeds or not, no part
+		    of the file is still running or writing when it returns. """
+		fsize = data["objects_fsize"]
+
+		try:
+			for i, obj in enumerate(data["objects"]):
+				future = parts.get()
+				if future is None:
+					# Leave the end marker for the drain.
+					parts.put(None)
+					raise PatchServerError("Missing part " + obj)
+				#endif
+
+				try:
+					clen, dlen = future.result()
+				finally:
+					slots.release()
+				#endtry
+
+				# I dunno man
+				if clen != fsize[i] and dlen != fsize[i]:
+					logging.warn("  Unexpected filesize {} for part {}, expecting {}.".format(dlen, obj, fsize[i]))
+				#endif
+			#endfor
+		finally:
+			self._drainParts(parts, slots)
+		#endtry
+	#enddef
+
+	def downloadFiles(self, path, files, version=None, skip=None, reuse=None, installed=None, keepJournal=True):
+		""" The file list to download to path. skip may give sets of part indexes known to already be written for some files,
+		    and reuse, from deltaParts, the parts to copy from the files' installed versions. Those are in the installation
+		    at installed when downloading somewhere else. Without keepJournal, for download folders, the journal is deleted
+		    once every file is downloaded. Until then it's there to resume from. """
+		version = version or self.manifestVersion
+		skip, reuse = skip or {}, reuse or {}
+		state = self.openState(path)
+		failed = self.metrics.counters["files_failed"]
+		# Parts from peers are only trusted if they can be checked.
+		if self.peers and not self.objectHashWorks(files): logging.warn("Not using peers, their parts can't be checked.")
+		jobs = queue.Queue()
+		slots = threading.Semaphore(self.connections * 2)
+		stop = threading.Event()
+
+		self.metrics.plan(sum(sum(data["objects_fsize"]) for data in files.values()
+			if not (len(data["objects"]) and data["objects"][0] == "__DIR__")))
+		if self.progress: self.metrics.startProgress()
+
+		try:
+			self.writer = FileWriter(self, self.writers) if self.writers else None
+			with ThreadPoolExecutor(max_workers=self.connections) as pool:
+				planner = threading.Thread(target=self._planParts, args=(path, files, pool, jobs, slots, stop, state, skip, reuse, installed), daemon=True)
+				planner.start()
+
+				try:
+					for fn, data, f, parts in iter(jobs.get, None):
+						fpath = os.path.join(path, fn)
+						aside = fn in reuse and not installed
+
+						# Don't worry about creating new folders, whatever checks the statuses should do that.
+						try:
+							if f is None:
+								self._drainParts(parts, slots)
+								os.makedirs(fpath, exist_ok=True)
+								if state: state.record(fn, version, data)
+								continue
+							elif isinstance(f, OSError):
+								self._drainParts(parts, slots)
+								raise f
+							#endif
+
+							with f:
+								logging.info("Downloading file " + fn)
+								self._waitParts(data, parts, slots)
+								if self.dropCache: self._dropCache(f)
+							#endwith
+
+							# TODO: Check fsize
+
+							# TODO: Don't change access time
+							os.utime(fpath, times=(data["mtime"], data["mtime"]))
+
+							if state: state.record(fn, version, data)
+							self.metrics.add("files_done")
+						except PatchServerError as err:
+							logging.error("Failed to download file {}: {}".format(fn, str(err)))
+							self.metrics.add("files_failed")
+							if state:
+								# Keep what was written, the journal knows which parts are good.
+								state.forget(fn, keepParts=True)
+							else:
+								try: os.remove(fpath)
+								except OSError: pass
+							#endif
+						except IsADirectoryError:
+							logging.error("Tried to overwrite a folder with the file " + fn)
+						except:
+							# Cut short, so leave the installed version set aside for the next run to put back.
+							aside = False
+							raise
+						finally:
+							if aside: self._removeAside(path, fn)
+						#endtry
+					#endfor
+				finally:
+					# Unblock the planner if we're leaving early, and let it stop before anything else is
+					# done with the files, or it could still be setting some aside.
+					stop.set()
+					slots.release()
+					pool.shutdown(wait=False, cancel_futures=True)
+					planner.join()
+				#endtry
+			#endwith
+		finally:
+			if self.writer:
+				self.writer.close()
+				self.writer = None
+			#endif
+			# Stop drawing before whatever error there is gets printed.
+			self.metrics.stopProgress()
+		#endtry
+
+		if reuse and not installed: self._removeAsideDirs(path)
+		if state and not keepJournal and self.metrics.counters["files_failed"] == failed: self.dropState(path)
+		elif state: state.seal()
+		if self.cache: self.cache.trim()
+	#enddef
+
+	def updateFileSystem(self, base, statuses):
+		""" Create new directories and delete files. """
+		for fn, action in statuses.items():
+			if action in ["create", "update"]:
+				path = os.path.join(base, os.path.dirname(fn))
+				os.makedirs(path, exist_ok=True)
+			elif action == "delete":
+				path = os.path.join(base, fn)
+				try: os.remove(path)
+				except OSError: pass
+				if self.state and self.state.base == base: self.state.forget(fn)
+			#endif
 		#endfor
-
-		raise PatchServerError("Version not found in patch info.")
 	#enddef
 
-	def getLatestVersion(self):
-		""" Get the latest version as reported by some server. """
-		if NexonAPI is None:
-			ver = self.legacyGetLatestVersion()
+	def writeChanges(self, path, changes, statuses, version, reuse=None, keepJournal=True):
+		""" Make the changes to the installation, or stage them to be applied later.
+		    keepJournal is False when path is a download folder rather than an installation, so its journal only lasts until it's complete. """
+		if self.stage:
+			files, todo = self.prepareStage(path, changes, statuses, version)
+			self.downloadFiles(files, todo, version, reuse=reuse, installed=path)
+			self.finishStage(path, changes)
 		else:
-			ver = NexonAPI.getLatestVersion()
+			self.updateFileSystem(path, statuses)
+			self.downloadFiles(path, changes, version, reuse=reuse, keepJournal=keepJournal)
 		#endif
+	#enddef
 
-		logging.info("Read latest version as {}.".format(ver))
-		self.target_version = ver
-		return ver
+	def _readPlan(self, stage):
+		return loadJSON(os.path.join(stage, "plan.json"))
 	#enddef
 
-	def getLocalVersion(self, path):
-		""" Get the verion of the Mabinogi installed at the given path. """
-		try:
-			with open(os.path.join(path, "version.dat"), "rb") as f:
-				ver = struct.unpack("<I", f.read())[0]
+	def _writePlan(self, stage, plan):
+		saveJSON(os.path.join(stage, "plan.json"), plan)
+	#enddef
 
-				self.local_version = ver
-				logging.info("Read local version as {}.".format(ver))
-				return ver
-			#endwith
-		except FileNotFoundError:
-			raise PatchServerError("Unable to find version.dat at " + path)
+	def prepareStage(self, path, changes, statuses, version):
+		""" Set up the staging area beside the installation for an update to version, keeping whatever
+		    an interrupted staging of the same update finished. Returns the folder to download into and
+		    the files still to download there. """
+		stage = os.path.join(path, self.STAGE_DIR)
+		files = os.path.join(stage, "files")
+
+		plan = self._readPlan(stage)
+		if plan and plan.get("applying"):
+			raise PatchServerError("Applying version {} was interrupted. Apply again to finish it, or roll it back.".format(plan["version"]))
+		elif plan and (plan["version"] != version or plan["applied"]):
+			# Left over from another update.
+			if self.state and self.state.base == files:
+				self.state.close()
+				self.state = None
+			#endif
+			shutil.rmtree(stage)
 		#endif
-	#enddef
 
-	def getManifest(self, version=None):
-		""" Get the manifest file from the server and decode it. """
-		version = version or self.target_version
+		os.makedirs(files, exist_ok=True)
+		self._writePlan(stage, {"version": version, "complete": False, "applied": None, "applying": None, "files": changes, "statuses": statuses})
 
-		if version == self.manifestVersion:
-			logging.debug("Reusing manifest from cache.")
-			return self.manifest
+		versionFile = os.path.join(files, "version.dat")
+		if not os.path.isfile(versionFile):
+			with open(versionFile, "wb") as f:
+				f.write(struct.pack("<I", version))
+			#endwith
 		#endif
 
-		properties = {
-			"gameID": self.GAME_ID,
-			"version": version
-		}
+		# Deletions wait for the apply.
+		self.updateFileSystem(files, {fn: status for fn, status in statuses.items() if status != "delete"})
+		todo, _ = self.diffInstallation(files, {"files": changes}, version)
 
-		# First download the hash
-		hashURL = self.BASE_URL + self.HASH_URL.format(**properties)
+		logging.info("Staging {} of {} changed files in {}".format(len(todo), len(changes), files))
 
-		conn = self._getURL(hashURL, "hash file (" + hashURL + ")", "patch server")
+		return files, todo
+	#enddef
 
-		properties["hash"] = conn.read().strip().decode("utf8")
+	def finishStage(self, path, changes):
+		""" Mark the staged update ready to apply, if every file made it. """
+		stage = os.path.join(path, self.STAGE_DIR)
+		isDir = lambda data: bool(len(data["objects"]) and data["objects"][0] == "__DIR__")
 
-		logging.debug("Hash downloaded.")
+		left, _ = self.diffManifestWithFileSystem(os.path.join(stage, "files"),
+			{"files": {fn: data for fn, data in changes.items() if not isDir(data)}})
+		if left:
+			raise PatchServerError("{} files couldn't be staged. Stage the update again to retry them.".format(len(left)))
+		#endif
 
-		# Now download the manifest
-		manifestURL = self.BASE_URL + self.MANIFEST_URL.format(**properties)
+		plan = self._readPlan(stage)
+		plan["complete"] = True
+		self._writePlan(stage, plan)
 
-		conn = self._getURL(manifestURL, "manifest file (" + manifestURL + ")", "patch server")
-		
-		manifest = conn.read()
-		manifest = zlib.decompress(manifest)
-		# TODO: handle zlib errors
+		logging.info("Staged version {}, ready to apply.".format(plan["version"]))
+	#enddef
 
-		logging.debug("Manifest decompressed.")
+	def _missingDirs(self, paths):
+		""" The folders that would have to be made for paths to exist, parents first. """
+		missing = []
+		for path in paths:
+			todo = []
+			while path and path not in missing and not os.path.isdir(path):
+				todo.append(path)
+				path = os.path.dirname(path)
+			#endwhile
+			missing.extend(reversed(todo))
+		#endfor
+		return missing
+	#enddef
 
-		manifest = json.loads(manifest.decode("utf8"))
+	def _movesDone(self, moves):
+		""" How many of moves, done in order until something stopped them, were done. Every source existed and no
+		    destination was in the way beforehand, so the last one done is the last with its file at the destination only. """
+		for i in range(len(moves) - 1, -1, -1):
+			src, dst = moves[i]
+			if os.path.lexists(dst) and not os.path.lexists(src): return i + 1
+		#endfor
+		return 0
+	#enddef
 
-		# Decode filenames.
-		files = manifest["files"]
-		keys = list(files.keys())
-		encoding = manifest["filepath_encoding"]
-		for key in keys:
-			# Decode the filename.
-			filename = os.path.join(*base64.b64decode(key).decode(encoding).split("\\"))
-			files[filename] = files[key]
-			del files[key]
+	def _undoMoves(self, moves, made, partial=False):
+		""" Put back what was moved, newest first, then remove the folders made for it. If partial, some moves may
+		    not have happened, and only those whose file is at the destination but not the source are put back.
+		    Returns how many couldn't be. """
+		failed = 0
+		for src, dst in reversed(moves):
+			if partial and not (os.path.lexists(dst) and not os.path.lexists(src)): continue
+			try:
+				os.makedirs(os.path.dirname(src), exist_ok=True)
+				os.replace(dst, src)
+			except OSError as err:
+				logging.error("Couldn't move {} back to {}: {}".format(dst, src, str(err)))
+				failed += 1
+			#endtry
 		#endfor
 
-		self.manifest = manifest
-		self.manifestVersion = version
+		for path in reversed(made):
+			try: os.rmdir(path)
+			except OSError: pass
+		#endfor
 
-		return manifest
+		return failed
 	#enddef
 
-	def dumpManifest(self, filename, manifest=None):
-		""" Dump the given or last retrieved manifest to a file. """
-		manifest = manifest or self.manifest
+	def applyStage(self, path):
+		""" Swap a staged update into the installation. This is only renames, and if any fails the rest are undone.
+		    The renames are written to the plan before the first one, so an apply cut short by a crash can be
+		    finished by applying again or undone by rollbackStage.
+		    The replaced files are kept in the staging area until the next staging, so rollbackStage can undo it. """
+		stage = os.path.join(path, self.STAGE_DIR)
+		files, backup = os.path.join(stage, "files"), os.path.join(stage, "backup")
+		isDir = lambda data: bool(len(data["objects"]) and data["objects"][0] == "__DIR__")
+
+		plan = self._readPlan(stage)
+		if not plan or not plan["complete"]:
+			raise PatchServerError("There's no finished staged update at " + stage)
+		elif plan["applied"]:
+			raise PatchServerError("The staged update to version {} was already applied.".format(plan["version"]))
+		#endif
 
-		with open(filename, "w") as f:
-			json.dump(manifest, f, indent=4, sort_keys=True)
-		#endwith
-	#enddef
+		statuses = plan["statuses"]
+		names = [fn for fn, status in statuses.items() if status != "delete" and not isDir(plan["files"][fn])]
+		names.append("version.dat")
 
-	def diffManifests(self, m1, m2):
-		""" Diff two manifests' files and return whether to create, update, or delete each changed file. """
-		f1, f2 = m1["files"], m2["files"]
-		changes, statuses = {}, {}
-		updated, created, deleted = 0, 0, 0
+		if plan.get("applying"):
+			moves, made = [tuple(move) for move in plan["applying"]["moves"]], plan["applying"]["made"]
+			deleted = [fn for fn in statuses if statuses[fn] == "delete" and (os.path.join(path, fn), os.path.join(backup, fn)) in moves]
+			start = self._movesDone(moves)
+			logging.warn("Finishing an interrupted apply, {} of {} renames were done.".format(start, len(moves)))
+		else:
+			dirs = [os.path.join(path, fn) for fn, status in statuses.items() if status != "delete" and isDir(plan["files"][fn])]
+			deleted = [fn for fn, status in statuses.items() if status == "delete" and os.path.isfile(os.path.join(path, fn))]
 
-		for fn, d2 in f2.items():
-			if fn in f1:
-				# Both versions have this file, compare mtime.
-				d1 = f1[fn]
-				if d1["mtime"] != d2["mtime"]:
-					changes[fn] = d2
-					statuses[fn] = "update"
-					updated += 1
-				#endif
-			else:
-				# This is a new file.
-				changes[fn] = d2
-				statuses[fn] = "create"
-				created += 1
-			#endif
-		#endfor
+			if os.path.exists(backup): shutil.rmtree(backup)
 
-		for fn in f1.keys():
-			if fn not in f2:
-				# This file was deleted.
-				statuses[fn] = "delete"
-				deleted += 1
+			moves = [(os.path.join(path, fn), os.path.join(backup, fn)) for fn in names + deleted if os.path.lexists(os.path.join(path, fn))]
+			moves += [(os.path.join(files, fn), os.path.join(path, fn)) for fn in names]
+			made = self._missingDirs(dirs + [os.path.dirname(dst) for src, dst in moves])
+			start = 0
+
+			plan["applying"] = {"moves": moves, "made": made}
+			self._writePlan(stage, plan)
+		#endif
+
+		done = start
+		began = time.perf_counter()
+		try:
+			for folder in made: os.makedirs(folder, exist_ok=True)
+			for src, dst in moves[start:]:
+				os.replace(src, dst)
+				done += 1
+			#endfor
+		except OSError as err:
+			failed = self._undoMoves(moves[:done], made)
+			if failed:
+				# Leave the plan of renames, so rollbackStage can try the rest again.
+				raise PatchServerError("Applying failed ({}) and {} files couldn't be put back, see above.".format(str(err), failed))
 			#endif
-		#endfor
+			plan["applying"] = None
+			self._writePlan(stage, plan)
+			raise PatchServerError("Applying failed, the installation is unchanged: " + str(err))
+		#endtry
+		took = time.perf_counter() - began
 
-		logging.info("Files/dirs affected between the specified manifests: {} to update, {} to create, {} to delete".format(updated, created, deleted))
+		plan["applied"], plan["applying"] = plan["applying"], None
+		self._writePlan(stage, plan)
 
-		return changes, statuses
-	#enddef
+		state = self.openState(path)
+		if state:
+			for fn in names[:-1]: state.record(fn, plan["version"], plan["files"][fn])
+			for fn in deleted: state.forget(fn)
+			state.seal()
+		#endif
 
-	def diffManifestWithFileSystem(self, base, manifest=None):
-		""" Check the manifest against the path for updating. """
-		manifest = manifest or self.manifest
-		files = manifest["files"]
-		changes, statuses = {}, {}
-		updated, created = 0, 0
+		logging.info("Applied version {} with {} renames in {:.3f}s.".format(plan["version"], len(moves), took))
+	#enddef
 
-		for fn, data in files.items():
-			path = os.path.join(base, fn)
-			try:
-				fsize = os.path.getsize(path)
-				mtime = int(os.path.getmtime(path))
-				if mtime != data["mtime"] or fsize != data["fsize"]:
-					changes[fn] = data
-					statuses[fn] = "update"
-					updated += 1
-				#endif
+	def rollbackStage(self, path):
+		""" Undo the last applied staged update, or one whose apply was cut short, putting its files back in the staging area. """
+		stage = os.path.join(path, self.STAGE_DIR)
+		plan = self._readPlan(stage)
+		if not plan or not (plan["applied"] or plan.get("applying")):
+			raise PatchServerError("There's no applied update to roll back at " + stage)
+		#endif
 
-			except (FileNotFoundError, NotADirectoryError):
-				changes[fn] = data
-				statuses[fn] = "create"
-				created += 1
-			#endtry
-		#endfor
+		# Renames an interrupted apply didn't get to, or already put back, are skipped.
+		partial = not plan["applied"]
+		applied = plan["applied"] or plan["applying"]
+		failed = self._undoMoves([tuple(move) for move in applied["moves"]], applied["made"], partial)
 
-		logging.info("Files/dirs affected in update: {} to update, {} to create".format(updated, created))
+		# Let the journal find out what's there now.
+		state = self.openState(path)
+		if state:
+			for fn in plan["statuses"]: state.forget(fn)
+			state.seal()
+		#endif
 
-		return changes, statuses
-	#enddef
+		if failed:
+			raise PatchServerError("{} files couldn't be put back, see above.".format(failed))
+		#endif
 
-	def downloadFiles(self, path, files):
-		""" The file list to download to path. """
-		for fn, data in files.items():
-			# Download parts.
-			fsize = data["objects_fsize"]
+		plan["applied"], plan["applying"] = None, None
+		self._writePlan(stage, plan)
 
-			fpath = os.path.join(path, fn)
+		logging.info("Rolled back to before version {}.".format(plan["version"]))
+	#enddef
 
-			# Don't worry about creating new folders, whatever checks the statuses should do that.
-			try:
-				if len(data["objects"]) and data["objects"][0] == "__DIR__":
-					os.makedirs(fpath, exist_ok=True)
-					continue
-				#endif
+	def prefetch(self, base, version, hash=None):
+		""" Download the objects that updating from base to version needs into the object cache. Returns how many were fetched. """
+		old = self.selectFiles(self.getManifest(base))
+		if hash:
+			new = self.selectFiles(self._manifestFor({"gameID": self.GAME_ID, "version": version, "hash": hash}))
+		else:
+			new = self.selectFiles(self.getManifest(version))
+		#endif
 
-				with open(fpath, "wb") as f:
-					logging.info("Downloading file " + fn)
-					for i, obj in enumerate(data["objects"]):
-						url = self.BASE_URL + self.PART_URL.format(gameID = self.GAME_ID, part = obj)
-						conn = self._getURL(url, obj, "patch server")
+		changes, statuses = self.diffManifests(old, new)
+		if self.peers and not self.objectHashWorks(changes): logging.warn("Not using peers, their parts can't be checked.")
+		objects = {}
+		for data in changes.values():
+			if len(data["objects"]) and data["objects"][0] == "__DIR__": continue
+			objects.update(zip(data["objects"], data["objects_fsize"]))
+		#endfor
 
-						compressed = conn.read()
-						clen = len(compressed)
+		# Whatever an earlier prefetch (perhaps of another hash) got is still good, objects never change.
+		missing = [obj for obj in objects if not self.cache.has(self.PART_URL.format(gameID = self.GAME_ID, part = obj))]
+		logging.info("Prefetching {} objects for version {}, {} are already cached.".format(len(missing), version, len(objects) - len(missing)))
+
+		failed = 0
+		# Parts are checked as they're decoded, but only the cached copy is kept.
+		with ThreadPoolExecutor(max_workers=self.connections) as pool:
+			for future in [pool.submit(self._runPart, self._fetchPart, obj, None, 0, objects[obj]) for obj in missing]:
+				try:
+					future.result()
+				except PatchServerError as err:
+					logging.error(str(err))
+					failed += 1
+				#endtry
+			#endfor
+		#endwith
 
-						logging.info("  Downloaded part " + obj)
+		self.cache.trim()
+		if failed: raise PatchServerError("{} objects couldn't be prefetched.".format(failed))
+		return len(missing)
+	#enddef
 
-						decompressed = zlib.decompress(compressed)
-						logging.debug("  Decompressed part " + obj)
+	def watch(self, path=None, interval=None):
+		""" Poll for new patches and prefetch what they change into the object cache, forever.
+		    What's been seen is kept in the cache folder, so it carries on where it left off after a restart.
+		    The patch is diffed against the installation at path if given, else the version before it. """
+		if not self.cache: raise PatchServerError("Watching needs an object cache to prefetch into.")
+		interval = interval or self.WATCH_INTERVAL
+		stateFile = os.path.join(self.cache.root, "watch.json")
+		state = loadJSON(stateFile) or {"seen": {}, "version": None, "hash": None, "base": None, "done": True}
 
-						dlen = len(decompressed)
+		while True:
+			try:
+				latest = self.pollLatestVersion(state["seen"])
 
-						# I dunno man
-						if clen != fsize[i] and dlen != fsize[i]:
-							logging.warn("  Unexpected filesize {} for part {}, expecting {}.".format(dlen, obj, fsize[i]))
-						#endif
+				# The next version's hash tends to show up before the patch info admits to it.
+				try:
+					version, hash = latest + 1, self.pollManifestHash(latest + 1, state["seen"])
+				except PatchServerError:
+					version, hash = latest, self.pollManifestHash(latest, state["seen"])
+				#endtry
 
-						f.write(decompressed)
-						del decompressed
-					#endfor
-				#endwith
+				if state["version"] is not None and version != state["version"]:
+					state["base"] = state["version"]
+				#endif
 
-				# TODO: Check fsize
+				# Before any version change has been seen, the version before this one is the best guess.
+				base = state["base"]
+				if base is None: base = latest if version == latest + 1 else version - 1
 
-				# TODO: Don't change access time
-				os.utime(fpath, times=(data["mtime"], data["mtime"]))
+				if path:
+					try: base = self.getLocalVersion(path)
+					except PatchServerError: pass
+				#endif
 
+				if (version, hash) != (state["version"], state["hash"]) or not state["done"]:
+					if (version, hash) != (state["version"], state["hash"]):
+						logging.info("Version {} has manifest {}.".format(version, hash))
+					#endif
+					state.update(version = version, hash = hash, done = False)
+					saveJSON(stateFile, state)
+
+					# Nothing to do until there's something newer than what's installed.
+					if base is not None and base < version:
+						fetched = self.prefetch(base, version, hash)
+						logging.info("Prefetched {} objects for {} to {}.".format(fetched, base, version))
+					#endif
+					state["done"] = True
+				#endif
 			except PatchServerError as err:
-				logging.error("Failed to download file {}: {}".format(fn, str(err)))
-				try: os.remove(path)
-				except OSError: pass
-			except IsADirectoryError:
-				logging.error("Tried to overwrite a folder with the file " + fn)
+				logging.error("Watch failed, will try again: " + str(err))
 			#endtry
-		#endfor
+
+			saveJSON(stateFile, state)
+			time.sleep(interval)
+		#endwhile
 	#enddef
 
-	def updateFileSystem(self, base, statuses):
-		""" Create new directories and delete files. """
-		for fn, action in statuses.items():
-			if action in ["create", "update"]:
-				path = os.path.join(base, os.path.dirname(fn))
-				os.makedirs(path, exist_ok=True)
-			elif action == "delete":
-				path = os.path.join(base, fn)
-				try: os.remove(path)
-				except OSError: pass
+	def objectHashWorks(self, files):
+		""" Whether object IDs are the OBJECT_HASH of their parts, checked once with the smallest part among files. """
+		if self.objectHashOK is not None: return self.objectHashOK
+
+		parts = [(size, obj) for data in files.values() if not (len(data["objects"]) and data["objects"][0] == "__DIR__")
+			for obj, size in zip(data["objects"], data["objects_fsize"])]
+		if not parts: return True
+		size, obj = min(parts)
+
+		decoder = PartDecoder(self, obj, None, 0)
+		decoder.verify = True
+		decoder.restart()
+		try:
+			self._fetchFromMirrors(obj, self.PART_URL.format(gameID = self.GAME_ID, part = obj), decoder)
+			decoder.finish()
+		except PatchServerError as err:
+			if isinstance(err, PartDecoderError) and decoder.decompressor.eof and decoder.hasher.hexdigest() != obj:
+				logging.warn("Object IDs aren't the {} of their parts, part {} hashes to {}.".format(
+					self.OBJECT_HASH, obj, decoder.hasher.hexdigest()))
+				self.objectHashOK = False
+				return False
 			#endif
+
+			# The part didn't come through whole, so nothing was learned. Try again next time.
+			logging.warn("Couldn't check object IDs: " + str(err))
+			return False
+		#endtry
+
+		self.objectHashOK = True
+		return True
+	#enddef
+
+	def verify(self, path, version=None):
+		""" Check every file of the installation part by part, and redownload the parts that are damaged.
+		    Returns how many files were checked, their total size, how long that took and how many were damaged. """
+		if not version:
+			try: version = self.local_version or self.getLocalVersion(path)
+			except PatchServerError: version = self.target_version or self.getLatestVersion()
+		#endif
+
+		manifest = self.selectFiles(self.getManifest(version))
+		files = {fn: data for fn, data in manifest["files"].items()
+			if not (len(data["objects"]) and data["objects"][0] == "__DIR__")}
+		state = self.openState(path)
+
+		# Hashing parts is only worth it if their IDs are what the hash says, otherwise every file looks damaged.
+		algorithm = self.OBJECT_HASH if self.objectHashWorks(files) else None
+		if algorithm is None: logging.warn("Only checking file and part sizes, object IDs can't be checked.")
+
+		damaged, skip, statuses = {}, {}, {}
+		total = 0
+		start = time.perf_counter()
+
+		with ProcessPoolExecutor(max_workers=self.verifyProcesses) as pool:
+			results = pool.map(verifyFile,
+				[os.path.join(path, fn) for fn in files.keys()],
+				[data["objects"] for data in files.values()],
+				[data["objects_fsize"] for data in files.values()],
+				[algorithm] * len(files),
+				chunksize=16)
+
+			for (fn, data), (bad, mtime) in zip(files.items(), results):
+				if bad is None:
+					logging.info("Missing file " + fn)
+					damaged[fn] = data
+					statuses[fn] = "create"
+					continue
+				#endif
+
+				total += data["fsize"]
+
+				if bad:
+					logging.info("Damaged file {}: {} of {} parts bad".format(fn, len(bad), len(data["objects"])))
+					damaged[fn] = data
+					statuses[fn] = "update"
+					skip[fn] = set(range(len(data["objects"]))) - set(bad)
+				else:
+					if mtime != data["mtime"]:
+						os.utime(os.path.join(path, fn), times=(data["mtime"], data["mtime"]))
+					#endif
+					if state: state.record(fn, version, data)
+				#endif
+			#endfor
+		#endwith
+
+		summary = {"files": len(files), "bytes": total, "seconds": time.perf_counter() - start, "damaged": len(damaged)}
+
+		# Directories are cheap, just make sure they're all there.
+		statuses.update((fn, "create") for fn in manifest["files"].keys() if fn not in files)
+		self.updateFileSystem(path, statuses)
+		for fn in manifest["files"].keys():
+			if fn not in files: os.makedirs(os.path.join(path, fn), exist_ok=True)
 		#endfor
+
+		if damaged:
+			refetch = sum(len(data["objects"]) - len(skip.get(fn, ())) for fn, data in damaged.items())
+			logging.info("Downloading {} parts.".format(refetch))
+			self.downloadFiles(path, damaged, version, skip)
+		elif state:
+			state.seal()
+		#endif
+
+		return summary
 	#enddef
 
 	# Right now the dumb patcher system downloads from 183_full.pack and all the x_to_y.pack files after that
@@ -318,14 +3597,15 @@ class PatchServer:
 		""" Update the installation. """
 		ver = self.getLatestVersion()
 
-		manifest = self.getManifest(ver)
+		old = self._installedFiles(path, ver)
+		manifest = self.selectFiles(self.getManifest(ver))
 
-		changes, statuses = self.diffManifestWithFileSystem(path, manifest)
-		self.updateFileSystem(path, statuses)
+		changes, statuses = self.diffInstallation(path, manifest, ver)
+		reuse = self.deltaParts(path, old, changes, statuses) if old else {}
 
 		# FUTURE?: Select only local_to_latest.pack if available.
 
-		self.downloadFiles(path, changes)
+		self.writeChanges(path, changes, statuses, ver, reuse)
 	#enddef
 
 	def _ver(self, path, f, t):
@@ -348,59 +3628,161 @@ class PatchServer:
 		""" Download patch f_to_t. """
 		f, t = self._ver(path, f, t)
 
-		m1 = self.getManifest(f)
-		m2 = self.getManifest(t)
+		m1 = self.selectFiles(self.getManifest(f))
+		m2 = self.selectFiles(self.getManifest(t))
 
 		changes, statuses = self.diffManifests(m1, m2)
-		self.updateFileSystem(path, statuses)
+		reuse = self.deltaParts(path, m1["files"], changes, statuses) if self.delta else {}
 
 		# FUTURE?: Select only f_to_t.pack if available.
 
-		self.downloadFiles(path, changes)
+		self.writeChanges(path, changes, statuses, t, reuse, keepJournal=False)
 	#enddef
 
 	def downloadFull(self, path, version=None):
 		""" Download all the files for this version. """
 		version = version or self.target_version or self.getLatestVersion()
 
-		manifest = self.getManifest(version)
+		manifest = self.selectFiles(self.getManifest(version))
 
 		files = manifest["files"]
 
 		statuses = {name: "create" for name in files.keys()}
-		self.updateFileSystem(path, statuses)
 
 		# FUTURE?: Select only version_full.pack if available.
 
-		self.downloadFiles(path, files)
+		self.writeChanges(path, files, statuses, version, keepJournal=False)
 	#enddef
 
 	def continueDownload(self, path, f=None, t=None):
 		""" Continue downloading an update. """
 		f, t = self._ver(path, f, t)
 
-		m1 = self.getManifest(f)
-		m2 = self.getManifest(t)
+		m1 = self.selectFiles(self.getManifest(f))
+		m2 = self.selectFiles(self.getManifest(t))
 
 		changes, statuses = self.diffManifests(m1, m2)
-		changes, statuses = self.diffManifestWithFileSystem(path, {"files": changes})
-		self.updateFileSystem(path, statuses)
+		changes, statuses = self.diffInstallation(path, {"files": changes}, t)
+		reuse = self.deltaParts(path, m1["files"], changes, statuses) if self.delta else {}
+
+		self.writeChanges(path, changes, statuses, t, reuse)
+	#enddef
+
+	def _shareFile(self, fn, data, src, dst):
+		""" Place one downloaded file into another installation. Returns how, or None if it couldn't be. """
+		spath = os.path.join(src, fn)
+		try:
+			st = os.stat(spath)
+			if int(st.st_mtime) != data["mtime"] or st.st_size != data["fsize"]:
+				logging.error("Not placing {} into {}, it didn't download.".format(fn, dst))
+				return None
+			#endif
+
+			how = self._placeFile(spath, os.path.join(dst, fn), data)
+		except (OSError, EOFError) as err:
+			logging.error("Failed to place {} into {}: {}".format(fn, dst, str(err)))
+			return None
+		#endtry
+
+		self.metrics.add("copied_bytes" if how == "copied" else "shared_bytes", data["fsize"])
+		return how
+	#enddef
+
+	def updateMany(self, paths, version=None):
+		""" Update several installations, downloading what any of them needs once and sharing it with the rest.
+		    Returns a summary of what was done and saved. """
+		version = version or self.target_version or self.getLatestVersion()
+		manifest = self.selectFiles(self.getManifest(version))
+		files = manifest["files"]
+		isDir = lambda data: bool(len(data["objects"]) and data["objects"][0] == "__DIR__")
+
+		# Each installation gets its own journal, so they can all be checked at once.
+		states = [InstallState(path) if self.journal else None for path in paths]
+		try:
+			with ThreadPoolExecutor(max_workers=len(paths)) as pool:
+				diffs = list(pool.map(lambda job: self.diffInstallation(job[0], manifest, version, job[1]), zip(paths, states)))
+			#endwith
+		finally:
+			for state in states:
+				if state: state.close()
+			#endfor
+		#endtry
+
+		# The first installation that needs a file downloads it, the others get it from there.
+		needs = {}
+		for path, (changes, statuses) in zip(paths, diffs):
+			self.updateFileSystem(path, statuses)
+			for fn in changes: needs.setdefault(fn, []).append(path)
+		#endfor
+
+		downloaded = self.metrics.counters["downloaded_bytes"]
+		for path in paths:
+			own = {fn: files[fn] for fn, targets in needs.items() if targets[0] == path}
+			if own: self.downloadFiles(path, own, version)
+		#endfor
+		downloaded = self.metrics.counters["downloaded_bytes"] - downloaded
+
+		placed = {}
+		jobs = []
+		for fn, targets in needs.items():
+			data = files[fn]
+			for target in targets[1:]:
+				if isDir(data): os.makedirs(os.path.join(target, fn), exist_ok=True)
+				else: jobs.append((fn, data, targets[0], target))
+			#endfor
+		#endfor
+
+		with ThreadPoolExecutor(max_workers=self.SCAN_THREADS) as pool:
+			for (fn, data, src, dst), how in zip(jobs, pool.map(lambda job: self._shareFile(*job), jobs)):
+				if how: placed.setdefault(dst, {})[fn] = (data, how)
+			#endfor
+		#endwith
+
+		if self.journal:
+			for target, done in placed.items():
+				state = self.openState(target)
+				for fn, (data, how) in done.items(): state.record(fn, version, data)
+				state.seal()
+			#endfor
+		#endif
+
+		size = lambda fn: 0 if isDir(files[fn]) else files[fn]["fsize"]
+		once = sum(size(fn) for fn in needs)
+		total = sum(size(fn) * len(targets) for fn, targets in needs.items())
+		hows = [how for done in placed.values() for data, how in done.values()]
+		sharedBytes = sum(data["fsize"] for done in placed.values() for data, how in done.values() if how != "copied")
+
+		summary = {
+			"installations": len(paths),
+			"needed_bytes": total,
+			"downloaded_once_bytes": once,
+			# Estimated from how well this download compressed.
+			"download_saved_bytes": int((total - once) * downloaded / once) if once else 0,
+			"write_saved_bytes": sharedBytes,
+			"linked": hows.count("linked"),
+			"cloned": hows.count("cloned"),
+			"copied": hows.count("copied"),
+		}
+
+		logging.info("Placed {} files into other installations: {} hard linked, {} reflinked, {} copied.".format(
+			len(hows), summary["linked"], summary["cloned"], summary["copied"]))
 
-		self.downloadFiles(path, changes)
+		return summary
 	#enddef
 
 	def continueDownloadFull(self, path, version=None):
 		""" Continue downloading an update. """
 		version = version or self.target_version or self.getLatestVersion()
 
-		manifest = self.getManifest(version)
+		old = self._installedFiles(path, version)
+		manifest = self.selectFiles(self.getManifest(version))
 
-		changes, statuses = self.diffManifestWithFileSystem(path, manifest)
-		self.updateFileSystem(path, statuses)
+		changes, statuses = self.diffInstallation(path, manifest, version)
+		reuse = self.deltaParts(path, old, changes, statuses) if old else {}
 
 		# FUTURE?: Select only local_to_latest.pack if available.
 
-		self.downloadFiles(path, changes)
+		self.writeChanges(path, changes, statuses, version, reuse)
 	#enddef
 #endclass
 
@@ -417,10 +3799,72 @@ def main(args):
 		help="Consider the installation to be this version.")
 	parser.add_argument("-m", "--manifest", action="store_true",
 		help="Download the manifest to manifest.json")
+	parser.add_argument("-c", "--connections", type=int, default=PatchServer.CONNECTIONS,
+		help="Number of parts to download at once.")
+	parser.add_argument("--cache", default=None,
+		help="Keep downloaded objects in this folder and reuse them.")
+	parser.add_argument("--cache-size", type=int, default=ObjectCache.LIMIT // 1024 ** 2,
+		help="Size limit of the object cache, in MiB.")
+	parser.add_argument("--manifest-store", default=None,
+		help="Keep decoded manifests in this folder and reuse them.")
+	parser.add_argument("--manifest-store-count", type=int, default=ManifestStore.COUNT,
+		help="How many manifests to keep in the store.")
+	parser.add_argument("--manifest-store-size", type=int, default=ManifestStore.LIMIT // 1024 ** 2,
+		help="Size limit of the manifest store, in MiB.")
+	parser.add_argument("--rescan", action="store_true",
+		help="Check every file of the installation instead of trusting the patch state journal.")
+	parser.add_argument("--no-journal", dest="journal", action="store_false",
+		help="Don't keep a patch state journal in the installation.")
+	parser.add_argument("--verify", action="store_true",
+		help="Check every file of the installation and redownload damaged parts.")
+	parser.add_argument("--verify-processes", type=int, default=None,
+		help="Number of processes to check files with. Defaults to one per CPU.")
+	parser.add_argument("--mirror", dest="mirrors", action="append", default=[],
+		help="Another base URL to download from. May be given more than once.")
+	parser.add_argument("--limit", type=parseRate, default=0,
+		help="Cap total download speed, in bytes per second. Accepts K, M and G, like 2.5M.")
+	parser.add_argument("--limit-file", default=None,
+		help="File holding the speed cap. It's reread when changed, so the cap can be adjusted mid-run.")
+	parser.add_argument("--host-connections", type=int, default=None,
+		help="Most requests to have in progress to any one host.")
+	parser.add_argument("--order", choices=("largest", "smallest", "manifest"), default="largest",
+		help="Which files to start first. Defaults to largest.")
+	parser.add_argument("--writers", type=int, default=PatchServer.WRITERS,
+		help="Number of threads writing to disk. 0 writes on the download threads.")
+	parser.add_argument("--drop-cache", action="store_true",
+		help="Drop each file from the OS page cache once it's written, to leave room for other programs.")
+	parser.add_argument("--delta", action="store_true",
+		help="Build updated files from the parts of the installed ones that didn't change, and only download the rest.")
+	parser.add_argument("--stage", action="store_true",
+		help="Download changed files into a staging area in the installation instead of over the live files.")
+	parser.add_argument("--apply", action="store_true",
+		help="Swap the staged update into the installation.")
+	parser.add_argument("--rollback", action="store_true",
+		help="Undo the last applied staged update.")
+	parser.add_argument("--link", choices=("reflink", "hard", "copy"), default="reflink",
+		help="How to share files between installations updated together. Defaults to reflink, which copies where unsupported.")
+	parser.add_argument("--watch", action="store_true",
+		help="Keep running, and prefetch each new patch into the object cache (--cache) as soon as it's published.")
+	parser.add_argument("--interval", type=float, default=PatchServer.WATCH_INTERVAL,
+		help="Seconds between checks for a new patch when watching.")
+	parser.add_argument("--serve", default=None, metavar="[HOST:]PORT",
+		help="Serve the object cache (--cache) to other patchers on the network, until stopped.")
+	parser.add_argument("--peer", dest="peers", action="append", default=[],
+		help="URL of another patcher's --serve to get parts from before the mirrors. May be given more than once, tried in order.")
+	parser.add_argument("--include", action="append", default=[],
+		help="Only work on files matching this glob, or in folders matching it. May be given more than once.")
+	parser.add_argument("--exclude", action="append", default=[],
+		help="Leave out files matching this glob, or in folders matching it. May be given more than once.")
+	parser.add_argument("--progress", action="store_true",
+		help="Show a live progress line.")
+	parser.add_argument("--stats", default=None,
+		help="Write the run's statistics to this JSON file at the end.")
+	parser.add_argument("--prometheus", default=None,
+		help="Write the run's metrics to this file for node_exporter's textfile collector.")
 	parser.add_argument("-v", "--verbose", action="count",
 		help="Print extra information.")
-	parser.add_argument("path", nargs="?", default="",
-		help="Base Mabinogi installation directory.")
+	parser.add_argument("path", nargs="*", default=[],
+		help="Base Mabinogi installation directory. Several may be updated together with -u.")
 	if NexonAPI:
 		parser.add_argument("-u", "--username", default=None,
 			help="Username to log in with.")
@@ -446,7 +3890,68 @@ def main(args):
 		NexonAPI.login(username, password)
 	#endif
 
-	patcher = PatchServer()
+	cache = ObjectCache(args.cache, args.cache_size * 1024 ** 2) if args.cache else None
+	manifests = ManifestStore(args.manifest_store, args.manifest_store_count, args.manifest_store_size * 1024 ** 2) if args.manifest_store else None
+	limiter = RateLimiter(args.limit, args.limit_file) if args.limit or args.limit_file else None
+	paths = PathFilter(args.include, args.exclude) if args.include or args.exclude else None
+	patcher = PatchServer(args.connections, cache, manifests, args.journal, args.rescan, args.verify_processes, args.mirrors,
+		limiter, args.host_connections, args.order, args.progress, paths, args.writers, args.drop_cache, args.delta,
+		args.stage, args.link, args.peers)
+
+	targets = args.path or [os.getcwd()]
+	path = targets[0]
+
+	if len(targets) > 1 and not args.update:
+		logging.error("Only updates (-u) can be given several installations.")
+		return 1
+	elif len(targets) > 1:
+		# These only make sense for one installation, or aren't supported with several yet.
+		unsupported = [name for name, given in (("-d", args.download), ("-F", args.fromVer), ("-f", args.full),
+			("--verify", args.verify), ("--delta", args.delta), ("--stage", args.stage), ("--apply", args.apply),
+			("--rollback", args.rollback), ("--watch", args.watch)) if given]
+		if unsupported:
+			logging.error("{} can't be used when updating several installations.".format(", ".join(unsupported)))
+			return 1
+		#endif
+	#endif
+
+	# These only move files around.
+	if args.apply or args.rollback:
+		if args.apply:
+			patcher.applyStage(path)
+			print("Update applied.")
+		else:
+			patcher.rollbackStage(path)
+			print("Update rolled back.")
+		#endif
+
+		if patcher.state: patcher.state.close()
+		return 0
+	#endif
+
+	if args.serve or args.watch:
+		server = None
+		if args.serve:
+			if not cache:
+				logging.error("Serving needs an object cache, give one with --cache.")
+				return 1
+			#endif
+			host, _, port = args.serve.rpartition(":")
+			server = PartServer(cache, (host, int(port)))
+			server.start()
+		#endif
+
+		try:
+			if args.watch: patcher.watch(args.path and path, args.interval)
+			else: server.wait()
+		finally:
+			if server:
+				server.stop()
+				print(server.summary())
+			#endif
+		#endtry
+		return 0
+	#endif
 
 	if not args.download and not patcher.getWebLaunchStatus():
 		answer = input(
@@ -457,8 +3962,6 @@ def main(args):
 		if answer.upper()[:1] != "Y": return 0
 	#endif
 
-	path = args.path or os.getcwd()
-
 	try:
 		target = int(args.download)
 		version = (int(args.fromVer), target)
@@ -467,32 +3970,63 @@ def main(args):
 		return 1
 	#endtry
 
-	if args.manifest:
-		patcher.getManifest(target)
-		patcher.dumpManifest(os.path.join(path, "manifest.json"))
-
-		print("Dumpped manifest to manifest.json")
-	#endif
+	succeeded = False
+	try:
+		if args.manifest:
+			patcher.getManifest(target)
+			patcher.dumpManifest(os.path.join(path, "manifest.json"))
 
-	if args.update:
-		if args.full:
-			patcher.continueDownloadFull(path, target)
-		elif args.download:
-			patcher.continueDownload(path, *version)
-		else:
-			patcher.update(path)
+			print("Dumpped manifest to manifest.json")
 		#endif
 
-		print("Update complete.")
-	else:
-		if args.full:
-			patcher.downloadFull(path, target)
+		if args.verify:
+			summary = patcher.verify(path, target)
+
+			print("Checked {} files ({:.1f} MiB) in {:.1f}s, {:.1f} MiB/s. {} needed repair.".format(
+				summary["files"], summary["bytes"] / 1024 ** 2, summary["seconds"],
+				summary["bytes"] / 1024 ** 2 / max(summary["seconds"], 1e-9), summary["damaged"]))
+			print("Verify complete.")
+		elif len(targets) > 1:
+			summary = patcher.updateMany(targets, target)
+
+			print("Updated {} installations, downloading {:.1f} MiB of files once for {:.1f} MiB of changes.".format(
+				summary["installations"], summary["downloaded_once_bytes"] / 1024 ** 2, summary["needed_bytes"] / 1024 ** 2))
+			print("Saved about {:.1f} MiB of downloads and {:.1f} MiB of disk writes ({} hard linked, {} reflinked, {} copied).".format(
+				summary["download_saved_bytes"] / 1024 ** 2, summary["write_saved_bytes"] / 1024 ** 2,
+				summary["linked"], summary["cloned"], summary["copied"]))
+		elif args.update:
+			if args.full:
+				patcher.continueDownloadFull(path, target)
+			elif args.download:
+				patcher.continueDownload(path, *version)
+			else:
+				patcher.update(path)
+			#endif
+
+			print("Update staged, apply it with --apply." if args.stage else "Update complete.")
 		else:
-			patcher.download(path, *version)
+			if args.full:
+				patcher.downloadFull(path, target)
+			else:
+				patcher.download(path, *version)
+			#endif
+
+			print("Download staged, apply it with --apply." if args.stage else "Download complete.")
 		#endif
+		succeeded = True
+	finally:
+		# Failed runs are the ones most worth having numbers for.
+		patcher.metrics.stopProgress()
+		stats = patcher.runStats()
+		stats["last_run_success"] = int(succeeded)
+		if args.stats: patcher.metrics.writeJSON(args.stats, stats)
+		if args.prometheus: patcher.metrics.writePrometheus(args.prometheus, stats)
+	#endtry
 
-		print("Download complete.")
-	#endif
+	patcher.pool.report()
+	patcher.getMirrors().report()
+	if cache: cache.report()
+	if patcher.state: patcher.state.close()
 
 	return 0
 #enddef
@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 #-*- coding:utf-8 -*-
 
-import urllib2, re, sys, ftplib, os, hashlib, struct, socket
+import urllib2, re, sys, ftplib, os, hashlib, struct, socket, time, zipfile
 from zipfile import ZipFile
 
 FILEBASE = ""
@@ -255,91 +255,151 @@ def verify_file(fn, size, md5):
 	return True
 #enddef
 
+class ChunkedFile(object):
+	""" Read a list of files as if they were one, for ZipFile. """
+	def __init__(self, chunks):
+		self.chunks = chunks # [(filename, size), ...]
+		self.size = sum(size for fn, size in chunks)
+		self.pos = 0
+		self.cur = None
+		self.f = None
+	#enddef
+
+	def seek(self, offset, whence=0):
+		if whence == 1: offset += self.pos
+		elif whence == 2: offset += self.size
+		self.pos = max(0, offset)
+	#enddef
+
+	def tell(self): return self.pos
+
+	def read(self, n=-1):
+		if n is None or n < 0: n = self.size - self.pos
+		ret = []
+		start = 0
+		for i, (fn, size) in enumerate(self.chunks):
+			if n <= 0: break
+			if self.pos < start + size:
+				if self.cur != i:
+					if self.f: self.f.close()
+					self.f = open(fn, "rb")
+					self.cur = i
+				#endif
+				self.f.seek(self.pos - start)
+				data = self.f.read(min(n, start + size - self.pos))
+				if not data: break
+				ret.append(data)
+				self.pos += len(data)
+				n -= len(data)
+			#endif
+			start += size
+		#endfor
+		return b"".join(ret)
+	#enddef
+
+	def close(self):
+		if self.f: self.f.close()
+		self.f = self.cur = None
+	#enddef
+#endclass
+
+def copy_member(src, dst, info, name, keepalive):
+	""" Copy a member's compressed data into dst under a new name, without unpacking it. """
+	src.fp.seek(info.header_offset)
+	fheader = struct.unpack(zipfile.structFileHeader, src.fp.read(zipfile.sizeFileHeader))
+	src.fp.seek(fheader[zipfile._FH_FILENAME_LENGTH] + fheader[zipfile._FH_EXTRA_FIELD_LENGTH], 1)
+
+	zinfo = zipfile.ZipInfo(name, info.date_time)
+	zinfo.compress_type = info.compress_type
+	zinfo.comment = info.comment
+	zinfo.create_system = info.create_system
+	zinfo.external_attr = info.external_attr
+	# Sizes go in the header now, so there's no data descriptor.
+	zinfo.flag_bits = info.flag_bits & ~0x08
+	zinfo.CRC = info.CRC
+	zinfo.compress_size = info.compress_size
+	zinfo.file_size = info.file_size
+	zinfo.header_offset = dst.fp.tell()
+	dst.fp.write(zinfo.FileHeader())
+
+	left = info.compress_size
+	while left > 0:
+		data = src.fp.read(min(left, 1048576))
+		if not data: raise zipfile.BadZipfile("Truncated member: " + info.filename)
+		dst.fp.write(data)
+		left -= len(data)
+		keepalive()
+	#endwhile
+
+	dst.filelist.append(zinfo)
+	dst.NameToInfo[name] = zinfo
+	dst._didModify = True
+	if hasattr(dst, "start_dir"): dst.start_dir = dst.fp.tell()
+#enddef
+
 def make_patch(ftp, path, fn, ver):
 	basename = fn.split(".", 1)[0]
 	print "Making patch for " + basename
-	# Concat
 	path2 = os.path.join(path, "patch")
-	unpackdir = os.path.join(path2, basename)
 	zipfn = os.path.join(path2, basename + ".zip")
-	try: os.makedirs(unpackdir)
+	try: os.makedirs(path2)
 	except OSError as err:
 		if err.errno != 17: raise
 	#endtry
 
-	f2 = open(zipfn, "wb")
-	def tmp(fn, size, md5):
-		f1 = open(os.path.join(path, fn), "rb")
-		while True:
-			data = f1.read(1048576)
-			if not data: break
-			f2.write(data)
+	# Keep the FTP connection from timing out, without a NOOP per megabyte.
+	last = [time.time()]
+	def keepalive():
+		if time.time() - last[0] >= 30:
 			ftp.sendcmd("NOOP")
-		#endwhile
-		f1.close()
-	#enddef
-	print "Merging..."
-	read_verify(os.path.join(path, fn), tmp)
-	f2.close()
-
-	# Unpack
-	print "Unpacking..."
-	zf = ZipFile(zipfn, allowZip64=True)
-	try: os.makedirs(unpackdir)
-	except OSError as err:
-		if err.errno != 17: raise
-	#endtry
-	for zfn in zf.namelist():
-		to = os.path.join(*([unpackdir] + zfn.split("\\")[0:-1]))
-		zf.extract(zfn, to)
-		os.rename(os.path.join(to, zfn), os.path.join(to, zfn.split("\\")[-1]))
-		ftp.sendcmd("NOOP")
-	#endfor
-	zf.close()
-
-	# If there isn't a language pack, add one.
-	print "Extracting language pack..."
-	packdir = os.path.join(unpackdir, "package")
-	if not os.path.isfile(os.path.join(packdir, "language.pack")):
-		langzip = os.path.join(path2, ver + "_language.zip")
-		langp_ = os.path.join(path, ver + "_language.p_")
-		if os.path.isfile(langzip):
-			lz = ZipFile(langzip)
-			lz.extractall(packdir)
-		elif os.path.isfile(langp_):
-			ff = open(langp_, "rb")
-			ft = open(langzip, "wb")
-			ft.write(ff.read())
-			ff.close()
-			ft.close()
-			lz = ZipFile(langzip)
-			lz.extractall(packdir)
-		else:
-			print "No language pack found."
+			last[0] = time.time()
 		#endif
-	#endif
+	#enddef
 
-	# Makever
-	print "Creating version.dat..."
-	f = open(os.path.join(unpackdir, "version.dat"), "wb")
-	f.write(struct.pack("<I", int(ver)))
-	f.close()
+	# The downloaded parts are read in place as one zip.
+	chunks = []
+	def tmp(fn, size, md5): chunks.append((os.path.join(path, fn), size))
+	read_verify(os.path.join(path, fn), tmp)
 
-	# Repack
 	print "Repacking..."
-	os.unlink(zipfn)
-	zf = ZipFile(zipfn, "w", allowZip64=True)
-	for root, dirs, files in os.walk(unpackdir, False):
-		for fn in files:
-			p = os.path.join(root, fn)
-			zf.write(p, p[len(unpackdir):])
-			os.unlink(p)
-			ftp.sendcmd("NOOP")
+	src = ChunkedFile(chunks)
+	zf = ZipFile(src, allowZip64=True)
+	out = ZipFile(zipfn, "w", allowZip64=True)
+	try:
+		names = set()
+		for info in zf.infolist():
+			name = info.filename.replace("\\", "/")
+			copy_member(zf, out, info, name, keepalive)
+			names.add(name)
 		#endfor
-		for d in dirs: os.rmdir(os.path.join(root, d))
-	#endfor
-	zf.close()
-	os.rmdir(unpackdir)
+		zf.close()
+		src.close()
+
+		# If there isn't a language pack, add one.
+		if "package/language.pack" not in names:
+			print "Adding language pack..."
+			langzip = os.path.join(path2, ver + "_language.zip")
+			langp_ = os.path.join(path, ver + "_language.p_")
+			if os.path.isfile(langzip): lz = ZipFile(langzip)
+			elif os.path.isfile(langp_): lz = ZipFile(langp_)
+			else:
+				print "No language pack found."
+				lz = None
+			#endif
+			if lz:
+				for info in lz.infolist():
+					copy_member(lz, out, info, "package/" + info.filename.replace("\\", "/"), keepalive)
+				#endfor
+				lz.close()
+			#endif
+		#endif
+
+		print "Adding version.dat..."
+		out.writestr("version.dat", struct.pack("<I", int(ver)))
+	finally:
+		out.close()
+		src.close()
+	#endtry
 
 	print "Patch complete."
 #enddef
@@ -0,0 +1,133 @@
+import os, sys, shutil, struct
+
+import pytest
+
+# The patcher is a script at the top of the repository, not an installed package.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bench
+from download import PatchServer, InstallState, verifyFile
+
+def pytest_configure(config):
+	# The patcher logs with logging.warn throughout.
+	config.addinivalue_line("filterwarnings", "ignore:The 'warn' function is deprecated:DeprecationWarning")
+#enddef
+
+@pytest.fixture
+def www(tmp_path):
+	""" Versions 1 and 2 of a small game, in the patch server's layout. """
+	root = str(tmp_path / "www")
+	os.makedirs(root)
+	bench.FakePatchFiles(root).generate(40, fileSize=4096, partSize=1024, perDir=10)
+	return root
+#enddef
+
+@pytest.fixture
+def serve():
+	""" Start a stand-in patch server for a folder. They're all stopped after the test. """
+	servers = []
+	def start(root):
+		servers.append(bench.FakePatchServer(root))
+		return servers[-1]
+	#enddef
+	yield start
+	for server in servers: server.stop()
+#enddef
+
+@pytest.fixture
+def server(www, serve):
+	return serve(www)
+#enddef
+
+@pytest.fixture
+def makePatcher(server):
+	""" Make patchers that download from the stand-in server, or from the given mirrors, first one first. """
+	patchers = []
+	def make(*urls, **kwargs):
+		urls = urls or (server.url,)
+		patcher = PatchServer(2, mirrors=list(urls[1:]), **kwargs)
+		patcher.BASE_URL = urls[0]
+		patcher.RETRY_DELAY = 0
+		patchers.append(patcher)
+		return patcher
+	#enddef
+	yield make
+	for patcher in patchers:
+		if patcher.state: patcher.state.close()
+		patcher.pool.close()
+	#endfor
+#enddef
+
+def partPath(root, obj):
+	""" Where a part is stored under a stand-in server's folder. """
+	return os.path.join(root, *PatchServer.PART_URL.format(gameID = PatchServer.GAME_ID, part = obj).split("/"))
+#enddef
+
+@pytest.fixture
+def damaged(www, tmp_path):
+	""" Copy the game to another folder and damage some of its parts there.
+	    how is "corrupt" to flip bytes in the middle, "truncate" to cut it short, or "missing". """
+	def damage(objects, how="corrupt"):
+		root = str(tmp_path / "damaged")
+		if not os.path.exists(root): shutil.copytree(www, root)
+		for obj in objects:
+			path = partPath(root, obj)
+			with open(path, "rb") as f: data = bytearray(f.read())
+			if how == "missing":
+				os.remove(path)
+				continue
+			elif how == "truncate":
+				data = data[: len(data) // 2]
+			else:
+				for i in range(2, len(data) - 4): data[i] ^= 0x55
+			#endif
+			with open(path, "wb") as f: f.write(data)
+		#endfor
+		return root
+	#enddef
+	return damage
+#enddef
+
+@pytest.fixture
+def damagedFiles():
+	""" The files under a folder that don't match their file table entries, part by part. """
+	def check(path, files):
+		bad = []
+		for fn, data in files.items():
+			if data["objects"][:1] == ["__DIR__"]:
+				if not os.path.isdir(os.path.join(path, fn)): bad.append(fn)
+				continue
+			#endif
+			parts, mtime = verifyFile(os.path.join(path, fn), data["objects"], data["objects_fsize"], PatchServer.OBJECT_HASH)
+			if parts is None or parts or mtime != data["mtime"]: bad.append(fn)
+		#endfor
+		return bad
+	#enddef
+	return check
+#enddef
+
+@pytest.fixture
+def install(makePatcher, tmp_path):
+	""" An installation of version 1. """
+	path = str(tmp_path / "install")
+	makePatcher(journal=False).downloadFull(path, 1)
+	with open(os.path.join(path, "version.dat"), "wb") as f: f.write(struct.pack("<I", 1))
+	return path
+#enddef
+
+@pytest.fixture
+def snapshot():
+	""" The contents of every file in an installation, leaving out the patcher's own. """
+	def take(path):
+		files = {}
+		for root, dirs, names in os.walk(path):
+			dirs[:] = [d for d in dirs if d not in (PatchServer.STAGE_DIR, PatchServer.OLD_DIR)]
+			for name in names:
+				if name.startswith(InstallState.FILENAME): continue
+				with open(os.path.join(root, name), "rb") as f: files[os.path.relpath(os.path.join(root, name), path)] = f.read()
+			#endfor
+		#endfor
+		return files
+	#enddef
+	return take
+#enddef
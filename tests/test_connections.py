@@ -0,0 +1,81 @@
+""" Connections and their per-host slots must go back to the pool however a response ends. """
+
+import socket, threading, http.client
+
+import pytest
+
+from download import ConnectionPool, HTTPStatusError
+
+def serve(responses):
+	""" A server that sends each canned response in turn, one per connection, then hangs up. """
+	listener = socket.socket()
+	listener.bind(("127.0.0.1", 0))
+	listener.listen(len(responses))
+
+	def run():
+		for response in responses:
+			conn, addr = listener.accept()
+			conn.recv(65536)
+			conn.sendall(response)
+			conn.close()
+		#endfor
+		listener.close()
+	#enddef
+
+	threading.Thread(target=run, daemon=True).start()
+	return "http://127.0.0.1:{}/".format(listener.getsockname()[1])
+#enddef
+
+def slotFree(pool, url):
+	slots = pool.hostSlots[("http", url.split("/")[2])]
+	if not slots.acquire(blocking=False): return False
+	slots.release()
+	return True
+#enddef
+
+SHORT = b"HTTP/1.1 200 OK\r\nContent-Length: 100\r\n\r\n" + b"x" * 10
+
+def test_failed_read_releases_slot():
+	url = serve([SHORT])
+	pool = ConnectionPool(timeout=5, hostLimit=1)
+	with pytest.raises(http.client.IncompleteRead):
+		pool.request(url).read()
+	#endwith
+	assert slotFree(pool, url)
+#enddef
+
+def test_failed_readinto_releases_slot():
+	url = serve([SHORT])
+	pool = ConnectionPool(timeout=5, hostLimit=1)
+	response = pool.request(url)
+	with pytest.raises(http.client.IncompleteRead):
+		while response.readinto(bytearray(64)): pass
+	#endwith
+	assert slotFree(pool, url)
+#enddef
+
+def test_failed_error_drain_releases_slot():
+	url = serve([b"HTTP/1.1 404 Not Found\r\nContent-Length: 100\r\n\r\nshort"])
+	pool = ConnectionPool(timeout=5, hostLimit=1)
+	with pytest.raises((http.client.IncompleteRead, HTTPStatusError)):
+		pool.request(url)
+	#endwith
+	assert slotFree(pool, url)
+#enddef
+
+def test_failed_redirect_drain_releases_slot():
+	url = serve([b"HTTP/1.1 302 Found\r\nLocation: /elsewhere\r\nContent-Length: 100\r\n\r\nshort"])
+	pool = ConnectionPool(timeout=5, hostLimit=1)
+	with pytest.raises(http.client.IncompleteRead):
+		pool.request(url)
+	#endwith
+	assert slotFree(pool, url)
+#enddef
+
+def test_full_read_keeps_connection():
+	url = serve([b"HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhello"])
+	pool = ConnectionPool(timeout=5, hostLimit=1)
+	assert pool.request(url).read() == b"hello"
+	assert slotFree(pool, url)
+	assert sum(len(conns) for conns in pool.idle.values()) == 1
+#enddef
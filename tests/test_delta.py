@@ -0,0 +1,111 @@
+""" Installed files set aside by a delta update must be put back if it's cut short. """
+
+import os, asyncio
+
+import pytest
+
+import bench
+from download import PatchServer
+from async_download import AsyncPatchServer
+
+class Crash(BaseException):
+	""" Stands in for the process being killed. """
+#endclass
+
+@pytest.fixture
+def edited(www, install, makePatcher):
+	""" Version 3, which is version 1 with the start of some files changed, so the rest of their parts can be reused. """
+	fake = bench.FakePatchFiles(www)
+	files = dict(makePatcher().getManifest(1)["files"].items())
+	names = [fn for fn, data in files.items() if data["objects"][:1] != ["__DIR__"]][5:15]
+	for fn in names:
+		with open(os.path.join(install, fn), "rb") as f: content = f.read()
+		files[fn] = fake.addFile(b"edited" + content[6:], files[fn]["mtime"] + 1, 1024)
+	#endfor
+	fake.addManifest(3, {fn.replace(os.sep, "\\"): data for fn, data in files.items()})
+	return names
+#enddef
+
+def asideFiles(install):
+	aside = os.path.join(install, PatchServer.OLD_DIR)
+	return [os.path.relpath(os.path.join(root, name), aside) for root, dirs, names in os.walk(aside) for name in names]
+#enddef
+
+def crashDelta(makePatcher, install, journal, monkeypatch):
+	""" Run a delta update to version 3 that dies while copying the first reused part. """
+	def crash(*args): raise Crash()
+	monkeypatch.setattr(PatchServer, "_copyOld", crash)
+	patcher = makePatcher(journal=journal, delta=True)
+	with pytest.raises(Crash):
+		patcher.continueDownload(install, 1, 3)
+	#endwith
+	monkeypatch.undo()
+
+	# Dying loses what the journal hadn't committed.
+	if patcher.state: patcher.state.db.rollback()
+	return asideFiles(install)
+#enddef
+
+def test_delta_update(edited, install, makePatcher, damagedFiles):
+	patcher = makePatcher(delta=True)
+	patcher.continueDownload(install, 1, 3)
+	assert damagedFiles(install, patcher.getManifest(3)["files"]) == []
+	assert patcher.metrics.counters["reused_bytes"]
+	assert not os.path.exists(os.path.join(install, PatchServer.OLD_DIR))
+#enddef
+
+@pytest.mark.parametrize("journal", [False, True])
+@pytest.mark.parametrize("deltaAgain", [False, True])
+def test_interrupted_delta_update(journal, deltaAgain, edited, install, makePatcher, snapshot, damagedFiles, monkeypatch):
+	before = snapshot(install)
+
+	aside = crashDelta(makePatcher, install, journal, monkeypatch)
+	assert aside
+	for fn in aside:
+		# The file's new version is unfinished, while the whole old one waits to be put back.
+		with open(os.path.join(install, PatchServer.OLD_DIR, fn), "rb") as f: assert f.read() == before[fn]
+	#endfor
+
+	# The next run puts them back before looking at the installation, delta or not.
+	patcher = makePatcher(journal=journal, delta=deltaAgain)
+	patcher.continueDownload(install, 1, 3)
+	assert damagedFiles(install, patcher.getManifest(3)["files"]) == []
+	assert not os.path.exists(os.path.join(install, PatchServer.OLD_DIR))
+#enddef
+
+def test_restore_aside(edited, install, makePatcher, snapshot, monkeypatch):
+	before = snapshot(install)
+
+	aside = crashDelta(makePatcher, install, False, monkeypatch)
+	makePatcher(journal=False)._restoreAside(install)
+	after = snapshot(install)
+	assert aside and all(after[fn] == before[fn] for fn in aside)
+	assert not os.path.exists(os.path.join(install, PatchServer.OLD_DIR))
+#enddef
+
+def test_async_interrupted_delta_update(edited, install, makePatcher, snapshot, damagedFiles, monkeypatch):
+	before = snapshot(install)
+
+	def crash(*args): raise Crash()
+	monkeypatch.setattr(PatchServer, "_copyOld", crash)
+	patcher = AsyncPatchServer(2, journal=False, delta=True)
+	patcher.patcher.BASE_URL = makePatcher().BASE_URL
+	async def run():
+		try: await patcher.continueDownload(install, 1, 3)
+		finally: patcher.close()
+	#enddef
+	with pytest.raises(Crash):
+		asyncio.run(run())
+	#endwith
+	monkeypatch.undo()
+
+	aside = asideFiles(install)
+	assert aside
+	for fn in aside:
+		with open(os.path.join(install, PatchServer.OLD_DIR, fn), "rb") as f: assert f.read() == before[fn]
+	#endfor
+
+	patcher = makePatcher(journal=False, delta=True)
+	patcher.continueDownload(install, 1, 3)
+	assert damagedFiles(install, patcher.getManifest(3)["files"]) == []
+#enddef
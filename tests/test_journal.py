@@ -0,0 +1,99 @@
+""" An interrupted file must resume from the parts the patch state journal says were written. """
+
+import os, logging
+
+import pytest
+
+from download import InstallState
+
+def victim(patcher):
+	""" A file that version 2 changes, with several parts, and its last part, the one to lose. """
+	changes, statuses = patcher.diffManifests(patcher.getManifest(1), patcher.getManifest(2))
+	fn = next(fn for fn, data in changes.items() if len(data["objects"]) >= 3 and data["objects"][0] != "__DIR__")
+	return fn, changes[fn]["objects"][-1]
+#enddef
+
+def downloaded(caplog):
+	""" The parts downloaded since the log was last cleared. """
+	parts = {record.getMessage().split()[-1] for record in caplog.records if record.getMessage().startswith("  Downloaded part ")}
+	caplog.clear()
+	return parts
+#enddef
+
+@pytest.fixture
+def broken(makePatcher, damaged, serve):
+	""" A server missing the last part of a changed file, that file and that part. """
+	fn, obj = victim(makePatcher())
+	return serve(damaged([obj], "missing")), fn, obj
+#enddef
+
+def test_update_resumes_parts(broken, install, makePatcher, damagedFiles, caplog):
+	caplog.set_level(logging.INFO)
+	bad, fn, obj = broken
+
+	patcher = makePatcher(bad.url)
+	patcher.continueDownload(install, 1, 2)
+	assert patcher.metrics.counters["files_failed"] == 1
+	assert damagedFiles(install, patcher.getManifest(2)["files"]) == [fn]
+	caplog.clear()
+
+	# Everything else is vouched for by the journal, and of the file only its missing part is fetched.
+	patcher = makePatcher()
+	patcher.continueDownload(install, 1, 2)
+	messages = [record.getMessage() for record in caplog.records]
+	assert any(message.startswith("Checking 1 of") for message in messages)
+	assert any(message.startswith("Resuming file {} ".format(fn)) for message in messages)
+	assert downloaded(caplog) == {obj}
+	assert damagedFiles(install, patcher.getManifest(2)["files"]) == []
+#enddef
+
+def test_download_folder_resumes_parts(broken, makePatcher, damagedFiles, tmp_path, caplog):
+	caplog.set_level(logging.INFO)
+	bad, fn, obj = broken
+	path = str(tmp_path / "download")
+
+	patcher = makePatcher(bad.url)
+	patcher.downloadFull(path, 2)
+	assert patcher.metrics.counters["files_failed"] == 1
+	# Kept so -fud can resume.
+	assert os.path.exists(os.path.join(path, InstallState.FILENAME))
+	caplog.clear()
+
+	patcher = makePatcher()
+	patcher.continueDownloadFull(path, 2)
+	assert downloaded(caplog) == {obj}
+	assert damagedFiles(path, patcher.getManifest(2)["files"]) == []
+#enddef
+
+def test_download_folder_journal_removed(makePatcher, tmp_path):
+	path = str(tmp_path / "download")
+	makePatcher().downloadFull(path, 2)
+	assert not os.path.exists(os.path.join(path, InstallState.FILENAME))
+#enddef
+
+def test_changed_parts_not_resumed(broken, install, makePatcher, damagedFiles, caplog):
+	""" Parts recorded for another version of the file don't count. """
+	caplog.set_level(logging.INFO)
+	bad, fn, obj = broken
+	makePatcher(bad.url).continueDownload(install, 1, 2)
+
+	state = InstallState(install)
+	data = dict(makePatcher().getManifest(2)["files"][fn])
+	assert state.completedParts(fn, data) == set(range(len(data["objects"]) - 1))
+	data["objects"] = ["0" * 40] + data["objects"][1:]
+	assert 0 not in state.completedParts(fn, data)
+	data["objects_fsize"] = [data["objects_fsize"][0] + 1] + data["objects_fsize"][1:]
+	assert state.completedParts(fn, data) == set()
+	state.close()
+#enddef
+
+def test_untrusted_journal_rescans(install, makePatcher, caplog):
+	""" Once something else writes version.dat, the journal can't vouch for anything. """
+	caplog.set_level(logging.INFO)
+	makePatcher().continueDownload(install, 1, 2)
+	with open(os.path.join(install, "version.dat"), "ab") as f: f.write(b"\0")
+	caplog.clear()
+
+	makePatcher().diffInstallation(install, makePatcher().getManifest(2), 2)
+	assert any(record.getMessage() == "Checking every file in the installation." for record in caplog.records)
+#enddef
@@ -0,0 +1,125 @@
+""" The streaming manifest decoder and the column table diff must give what the originals did. """
+
+import io, json, zlib, base64, random
+
+import pytest
+
+import download
+from download import PatchServer, ManifestDecoder, ManifestFiles, ManifestDecoderError
+
+NAMES = ["data", "package", "local", "Ünïcödé", "日本語", "a b", "x"]
+
+def randomEntry(rng):
+	""" A file or folder entry, sometimes with extra keys or missing the usual ones. """
+	kind = rng.random()
+	if kind < 0.1:
+		return {"fsize": 0, "mtime": rng.randrange(2 ** 31), "objects": ["__DIR__"], "objects_fsize": [0]}
+	elif kind < 0.15:
+		# Doesn't fit the columns.
+		return {"mtime": rng.randrange(2 ** 31), "odd": True}
+	#endif
+
+	sizes = [rng.randrange(1, 2 ** 20) for i in range(rng.randrange(0, 5))]
+	entry = {
+		"fsize": sum(sizes),
+		"mtime": rng.randrange(2 ** 31),
+		"objects": ["{:040x}".format(rng.getrandbits(160)) for size in sizes],
+		"objects_fsize": sizes,
+	}
+	if kind > 0.95: entry["extra"] = [rng.random(), "more"]
+	return entry
+#enddef
+
+def randomFiles(rng, count):
+	files = {}
+	while len(files) < count:
+		depth = rng.randrange(1, 4)
+		files["\\".join(rng.choice(NAMES) + str(rng.randrange(50)) for i in range(depth))] = randomEntry(rng)
+	#endwhile
+	return files
+#enddef
+
+def encodeManifest(rng, files, encoding="utf-16le"):
+	""" Compressed manifest text, with the keys in a random order and random whitespace. """
+	encoded = {base64.b64encode(fn.encode(encoding)).decode("ascii"): entry for fn, entry in files.items()}
+	keys = [("filepath_encoding", encoding), ("files", encoded), ("version", rng.randrange(1000)), ("note", {"a": [1, 2]})]
+	rng.shuffle(keys)
+
+	indent = rng.choice([None, 1, "\t"])
+	text = json.dumps(dict(keys), indent=indent, ensure_ascii=rng.random() < 0.5)
+	return zlib.compress(text.encode("utf8"))
+#enddef
+
+def streamDecode(data, rng):
+	""" Decode with ManifestDecoder, fed in chunks of random sizes. """
+	decoder = ManifestDecoder()
+	pos = 0
+	while pos < len(data):
+		n = rng.choice([1, 2, 7, 64, 1000, 65536])
+		decoder.feed(data[pos : pos + n])
+		pos += n
+	#endwhile
+	return decoder.finish()
+#enddef
+
+@pytest.mark.parametrize("seed", range(20))
+def test_decoder_matches_legacy(seed):
+	rng = random.Random(seed)
+	data = encodeManifest(rng, randomFiles(rng, rng.randrange(0, 300)))
+
+	legacy = PatchServer().legacyDecodeManifest(io.BytesIO(data))
+	streamed = streamDecode(data, rng)
+
+	assert {key: value for key, value in streamed.items() if key != "files"} == {key: value for key, value in legacy.items() if key != "files"}
+	assert isinstance(streamed["files"], ManifestFiles)
+	assert list(streamed["files"]) == list(legacy["files"])
+	assert dict(streamed["files"].items()) == legacy["files"]
+#enddef
+
+@pytest.mark.parametrize("cut", [0.1, 0.5, 0.99])
+def test_decoder_rejects_truncated(cut):
+	rng = random.Random(1)
+	data = encodeManifest(rng, randomFiles(rng, 50))
+	text = zlib.decompress(data)
+	with pytest.raises(ManifestDecoderError):
+		streamDecode(zlib.compress(text[:int(len(text) * cut)]), rng)
+	#endwith
+#enddef
+
+def mutate(rng, files):
+	""" A later version of a file table: some files changed, added and removed. """
+	new = {}
+	for fn, entry in files.items():
+		r = rng.random()
+		if r < 0.1: continue
+		elif r < 0.3: entry = dict(entry, mtime=entry["mtime"] + 1)
+		new[fn] = entry
+	#endfor
+	new.update(randomFiles(rng, len(files) // 10))
+	if rng.random() < 0.5:
+		# Usually the order is kept, but not always.
+		items = list(new.items())
+		rng.shuffle(items)
+		new = dict(items)
+	#endif
+	return new
+#enddef
+
+@pytest.mark.parametrize("useNumpy", [False, True])
+@pytest.mark.parametrize("seed", range(20))
+def test_table_diff_matches_dict_diff(seed, useNumpy, monkeypatch):
+	if useNumpy and download.numpy is None: pytest.skip("NumPy isn't installed")
+	monkeypatch.setattr(ManifestFiles, "NUMPY", useNumpy)
+
+	rng = random.Random(seed)
+	old = randomFiles(rng, rng.randrange(0, 300))
+	new = old if seed == 0 else mutate(rng, old)
+
+	patcher = PatchServer()
+	changes, statuses = patcher.diffManifests({"files": old}, {"files": new})
+	tableChanges, tableStatuses = patcher.diffManifests({"files": ManifestFiles(old)}, {"files": ManifestFiles(new)})
+
+	assert list(tableStatuses.items()) == list(statuses.items())
+	assert list(tableChanges) == list(changes)
+	assert dict(tableChanges.items()) == changes
+#enddef
@@ -0,0 +1,71 @@
+""" Damaged parts from a mirror must not end a run. """
+
+import os, asyncio
+
+import pytest
+
+from async_download import AsyncPatchServer
+
+def smallestPart(files):
+	return min((size, obj) for data in files.values() if data["objects"][:1] != ["__DIR__"]
+		for obj, size in zip(data["objects"], data["objects_fsize"]))[1]
+#enddef
+
+def test_object_hash_works(makePatcher):
+	patcher = makePatcher()
+	assert patcher.objectHashWorks(patcher.getManifest(2)["files"])
+	assert patcher.objectHashOK
+#enddef
+
+def test_object_hash_probe_damaged(makePatcher, damaged, serve):
+	files = makePatcher().getManifest(2)["files"]
+	for how in ("corrupt", "truncate"):
+		bad = serve(damaged([smallestPart(files)], how))
+		patcher = makePatcher(bad.url)
+		assert not patcher.objectHashWorks(files)
+		# A damaged probe says nothing about the hash, so it's tried again next time.
+		assert patcher.objectHashOK is None
+	#endfor
+#enddef
+
+def fileParts(files):
+	""" The parts of the first few files, the ones to damage. """
+	return [obj for data in list(files.values())[5:15] for obj in data["objects"] if obj != "__DIR__"]
+#enddef
+
+@pytest.mark.parametrize("how", ["corrupt", "truncate", "missing"])
+def test_failover_from_damaged_mirror(how, makePatcher, damaged, serve, damagedFiles, tmp_path, caplog):
+	files = makePatcher().getManifest(2)["files"]
+	bad = serve(damaged(fileParts(files), how))
+
+	patcher = makePatcher(bad.url, makePatcher().BASE_URL)
+	# Start with the damaged mirror.
+	patcher.getMirrors().mirrors[1].until = float("inf")
+	path = str(tmp_path / "install")
+	patcher.downloadFull(path, 2)
+
+	assert damagedFiles(path, files) == []
+	assert patcher.metrics.counters["files_failed"] == 0
+	failed = [record for record in caplog.records if "failed on {}".format(patcher.mirrors.mirrors[0].host) in record.getMessage()]
+	assert failed
+#enddef
+
+def test_async_failover_from_damaged_mirror(makePatcher, damaged, serve, damagedFiles, tmp_path, caplog):
+	files = makePatcher().getManifest(2)["files"]
+	bad = serve(damaged(fileParts(files), "corrupt"))
+
+	patcher = AsyncPatchServer(2, mirrors=[makePatcher().BASE_URL])
+	patcher.patcher.BASE_URL = bad.url
+	patcher.patcher.RETRY_DELAY = 0
+	patcher.patcher.getMirrors().mirrors[1].until = float("inf")
+	path = str(tmp_path / "install")
+	async def run():
+		try: await patcher.downloadFull(path, 2)
+		finally: patcher.close()
+	#enddef
+	asyncio.run(run())
+
+	assert damagedFiles(path, files) == []
+	assert patcher.patcher.metrics.counters["files_failed"] == 0
+	assert any("failed on {}".format(patcher.patcher.mirrors.mirrors[0].host) in record.getMessage() for record in caplog.records)
+#enddef
@@ -0,0 +1,73 @@
+""" --include and --exclude must select a file when a pattern matches it or any folder it's in, and nothing else. """
+
+import os, random, fnmatch
+
+import pytest
+
+from download import PathFilter, ManifestFiles
+
+PATTERNS = ["data", "data/gfx", "data\\local\\*", "*.dat", "package/0?", "data/[gs]*", "/data/", "data/*/file00000[0-4]*",
+	"nothing", "dat", "*/001", "package\\"]
+
+def randomFiles(rng, count):
+	dirs = ["data", "package", "data\\gfx", "data\\sound", "data\\local", "database", "pack"]
+	files = {}
+	for d in dirs:
+		files[os.path.join(*d.split("\\"))] = {"fsize": 0, "mtime": 1, "objects": ["__DIR__"], "objects_fsize": []}
+	#endfor
+	while len(files) < count:
+		fn = os.path.join(*rng.choice(dirs).split("\\"), "{:03}".format(rng.randrange(3)), "file{:07}.{}".format(rng.randrange(100), rng.choice(["dat", "pack", "txt"])))
+		files[fn] = {"fsize": 1, "mtime": 1, "objects": ["0" * 40], "objects_fsize": [1]}
+	#endfor
+	return files
+#enddef
+
+def selects(pattern, fn):
+	""" Whether pattern matches fn or a folder it's in, checked the slow way. """
+	pattern = os.path.normcase(os.path.normpath(os.path.join(*[p for p in pattern.replace("\\", "/").split("/") if p])))
+	parts = os.path.normcase(fn).split(os.sep)
+	return any(fnmatch.fnmatchcase(os.sep.join(parts[:i]), pattern) for i in range(1, len(parts) + 1))
+#enddef
+
+@pytest.mark.parametrize("table", [dict, ManifestFiles])
+@pytest.mark.parametrize("seed", range(10))
+def test_filter_matches_globbing(seed, table):
+	rng = random.Random(seed)
+	files = randomFiles(rng, 200)
+	include = rng.sample(PATTERNS, rng.randrange(0, 3))
+	exclude = rng.sample(PATTERNS, rng.randrange(0, 2))
+
+	expected = [fn for fn in files
+		if (not include or any(selects(pattern, fn) for pattern in include))
+		and not any(selects(pattern, fn) for pattern in exclude)]
+
+	selected = PathFilter(include, exclude).select(table(files))
+	assert list(selected) == expected
+	assert all(selected[fn] == files[fn] for fn in expected)
+#enddef
+
+def test_filter_folders():
+	files = randomFiles(random.Random(1), 100)
+	selected = PathFilter(["data"], ["data/gfx"]).select(files)
+	assert selected
+	for fn in selected:
+		assert fn.split(os.sep)[0] == "data"
+		assert not fn.startswith(os.path.join("data", "gfx"))
+	#endfor
+	# A pattern is a whole name, so data doesn't select database.
+	assert not any(fn.startswith("database") for fn in selected)
+#enddef
+
+def test_update_only_selected(makePatcher, damagedFiles, tmp_path):
+	path = str(tmp_path / "install")
+	patcher = makePatcher(journal=False, paths=PathFilter(["data/gfx"], ["*file000002?.dat"]))
+	patcher.downloadFull(path, 2)
+
+	files = makePatcher().getManifest(2)["files"]
+	wanted = {fn: data for fn, data in files.items() if fn.startswith(os.path.join("data", "gfx")) and not fnmatch.fnmatch(fn, "*file000002?.dat")}
+	assert wanted and len(wanted) < len([fn for fn in files if fn.startswith(os.path.join("data", "gfx"))])
+	assert damagedFiles(path, wanted) == []
+
+	found = {os.path.relpath(os.path.join(root, name), path) for root, dirs, names in os.walk(path) for name in names}
+	assert found == {fn for fn, data in wanted.items() if data["objects"][:1] != ["__DIR__"]}
+#enddef
@@ -0,0 +1,27 @@
+""" The installation scan must find the same changes as checking one file at a time. """
+
+import os
+
+import bench
+from download import PatchServer
+
+def test_scan_matches_legacy(tmp_path):
+	base = str(tmp_path)
+	manifest = bench.makeTree(base, 1000, perDir=30)
+	# A directory that's a file, and files in a directory that doesn't exist.
+	with open(os.path.join(base, "notadir"), "wb"): pass
+	manifest["files"][os.path.join("notadir", "file.dat")] = {"fsize": 0, "mtime": 0, "objects": [], "objects_fsize": []}
+	manifest["files"][os.path.join("missing", "file.dat")] = {"fsize": 0, "mtime": 0, "objects": [], "objects_fsize": []}
+
+	patcher = PatchServer()
+	expected = patcher.legacyDiffManifestWithFileSystem(base, manifest)
+	for threads in (1, 4):
+		patcher.SCAN_THREADS = threads
+		assert patcher.diffManifestWithFileSystem(base, manifest) == expected
+	#endfor
+	assert len(expected[0]) == 22
+#enddef
+
+def test_scan_empty(tmp_path):
+	assert PatchServer().scanFileSystem(str(tmp_path), {}) == {}
+#enddef
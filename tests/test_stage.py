@@ -0,0 +1,100 @@
+""" Staged updates must leave the installation either wholly at the old version or wholly at the new one. """
+
+import os, itertools
+
+import pytest
+
+from download import PatchServerError
+
+class Crash(BaseException):
+	""" Stands in for the process being killed. """
+#endclass
+
+def stage(makePatcher, install, **kwargs):
+	patcher = makePatcher(stage=True, **kwargs)
+	patcher.download(install, 1, 2)
+	return patcher
+#enddef
+
+@pytest.mark.parametrize("journal", [False, True])
+def test_apply_and_rollback(journal, makePatcher, install, snapshot, damagedFiles):
+	before = snapshot(install)
+	patcher = stage(makePatcher, install, journal=journal)
+	assert snapshot(install) == before
+
+	patcher.applyStage(install)
+	assert patcher.getLocalVersion(install) == 2
+	assert damagedFiles(install, patcher.getManifest(2)["files"]) == []
+
+	patcher.rollbackStage(install)
+	assert snapshot(install) == before
+#enddef
+
+def test_failed_apply_is_undone(makePatcher, install, snapshot):
+	before = snapshot(install)
+	patcher = stage(makePatcher, install, journal=False)
+	plan = patcher._readPlan(os.path.join(install, patcher.STAGE_DIR))
+
+	# The last file to be moved in goes missing, so every rename before it has to be undone.
+	last = [fn for fn, status in plan["statuses"].items() if status != "delete" and plan["files"][fn]["objects"][:1] != ["__DIR__"]][-1]
+	os.remove(os.path.join(install, patcher.STAGE_DIR, "files", last))
+
+	with pytest.raises(PatchServerError, match="unchanged"):
+		patcher.applyStage(install)
+	#endwith
+	assert snapshot(install) == before
+	assert not patcher._readPlan(os.path.join(install, patcher.STAGE_DIR))["applying"]
+#enddef
+
+@pytest.mark.parametrize("finish", [True, False])
+def test_interrupted_apply(finish, makePatcher, install, snapshot, damagedFiles, monkeypatch):
+	""" Kill the apply before each of its renames in turn, then finish it or roll it back. """
+	before = snapshot(install)
+	files = makePatcher().getManifest(2)["files"]
+	replace = os.replace
+
+	for crashAt in itertools.count():
+		patcher = stage(makePatcher, install, journal=False)
+
+		renames = [0]
+		def crashingReplace(src, dst):
+			# Saving the plan goes through a temporary file, that's not one of the renames.
+			if not src.endswith(".tmp"):
+				if renames[0] == crashAt: raise Crash()
+				renames[0] += 1
+			#endif
+			replace(src, dst)
+		#enddef
+
+		monkeypatch.setattr(os, "replace", crashingReplace)
+		try:
+			patcher.applyStage(install)
+			crashed = False
+		except Crash:
+			crashed = True
+		finally:
+			monkeypatch.setattr(os, "replace", replace)
+		#endtry
+
+		patcher = makePatcher(journal=False)
+		if crashed:
+			# Nothing else may be staged over it until it's been dealt with.
+			with pytest.raises(PatchServerError, match="interrupted"):
+				stage(makePatcher, install, journal=False)
+			#endwith
+		#endif
+
+		if finish:
+			if crashed: patcher.applyStage(install)
+			assert patcher.getLocalVersion(install) == 2
+			assert damagedFiles(install, files) == []
+		#endif
+
+		patcher.rollbackStage(install)
+		assert snapshot(install) == before, crashAt
+		if not crashed: break
+	#endfor
+
+	# Every rename, moving old files out and new ones in, was interrupted once.
+	assert crashAt > 3
+#enddef